@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark the components that every message goes through.
+
+Measures the throughput of `Consumer.message_received_cb`,
+`Batcher.message_received_cb`, `ParametersMapper.map` and
+`Database.batch_ready_cb` (against in-memory SQLite) with synthetic messages of
+varying width and nesting, as well as the cost of sending a signal to a single
+receiver (`dispatch` compared with plain blinker in `dispatch-blinker`). For
+each component and message shape it reports messages per second, cost per
+message and peak memory.
+
+Results can be saved as JSON and compared against the results of a previous
+run, in which case the exit code is 1 if any component got slower than the
+threshold.
+
+Usage::
+
+    $ PYTHONPATH=src python3 benchmarks/bench_components.py \\
+        --output benchmark.json
+    $ PYTHONPATH=src python3 benchmarks/bench_components.py \\
+        --baseline benchmark.json
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+
+import blinker
+
+from rabbithole.aio import AsyncioConsumer
+from rabbithole.batcher import Batcher
+from rabbithole.scheduler import Scheduler
+from rabbithole.signals import Signal
+from rabbithole.sql import (
+    Database,
+    DictParametersMapper,
+)
+
+#: Message shapes: number of filler fields per level and nesting depth
+SHAPES = {
+    'narrow': (5, 1),
+    'wide': (50, 1),
+    'nested': (10, 4),
+}
+
+QUERY = (
+    'INSERT INTO logs (timestamp, host, message) '
+    'VALUES (:timestamp, :host, :message)'
+)
+
+
+def create_payload(index, width, depth):
+    """Create message with filler fields and the text nested `depth` levels.
+
+    :param index: Message index
+    :type index: int
+    :param width: Number of filler fields in each level
+    :type width: int
+    :param depth: Nesting level of the message text
+    :type depth: int
+    :returns: Message
+    :rtype: dict(str)
+
+    """
+    def filler(level):
+        """Create filler fields for a level."""
+        return {
+            'field_{}_{}'.format(level, field): 'value {}'.format(field)
+            for field in range(width)
+        }
+
+    node = {'text': 'Hello world {}'.format(index)}
+    for level in range(depth - 1):
+        node = dict(filler(level), nested=node)
+    payload = filler(depth)
+    payload.update({
+        'timestamp': '2017-05-04T12:00:00',
+        'host': 'host-{}'.format(index % 10),
+        'message': node,
+    })
+    return payload
+
+
+def get_parameters(depth):
+    """Get query parameters for messages with a given nesting depth.
+
+    :param depth: Nesting level of the message text
+    :type depth: int
+    :returns: Mapping from query parameter to message field
+    :rtype: dict(str, str)
+
+    """
+    return {
+        'timestamp': 'timestamp',
+        'host': 'host',
+        'message': '.'.join(['message'] + ['nested'] * (depth - 1) + ['text']),
+    }
+
+
+class Frame(object):
+
+    """Method frame with the fields used by the consumer."""
+
+    exchange = 'bench'
+    delivery_tag = 1
+    content_type = 'application/json'
+
+
+class Channel(object):
+
+    """Channel that ignores acknowledgements."""
+
+    def basic_ack(self, delivery_tag):
+        """Ignore acknowledgement."""
+
+    def basic_nack(self, delivery_tag, requeue):
+        """Ignore negative acknowledgement."""
+
+
+def discard(sender, **kwargs):
+    """Receiver that discards messages and batches."""
+    return True
+
+
+def consumer_benchmark(payloads, bodies, parameters, batch_size):
+    """Decode and project message bodies."""
+    loop = asyncio.new_event_loop()
+    consumer = AsyncioConsumer('amqp://', loop=loop)
+    fields = DictParametersMapper(parameters).fields
+    consumer(Frame.exchange, fields=fields).connect(discard, weak=False)
+    channel, frame = Channel(), Frame()
+
+    def run():
+        """Receive all messages."""
+        for body in bodies:
+            consumer.message_received_cb(channel, frame, frame, body)
+
+    return run
+
+
+def batcher_benchmark(payloads, bodies, parameters, batch_size):
+    """Group messages in batches."""
+    batcher = Batcher(
+        size_limit=batch_size,
+        time_limit=3600,
+        scheduler=Scheduler(autostart=False),
+        name='bench',
+    )
+    batcher.batch_ready.connect(discard, weak=False)
+
+    def run():
+        """Add all messages to batches."""
+        for payload in payloads:
+            batcher.message_received_cb(None, payload)
+
+    return run
+
+
+def dispatch_benchmark(signal_class):
+    """Send messages through a signal with a single receiver."""
+    def create(payloads, bodies, parameters, batch_size):
+        """Create signal and connect receiver."""
+        signal = signal_class()
+        signal.connect(discard, weak=False)
+
+        def run():
+            """Send all messages."""
+            for payload in payloads:
+                signal.send(None, payload=payload)
+
+        return run
+
+    return create
+
+
+def mapper_benchmark(payloads, bodies, parameters, batch_size):
+    """Map messages to query parameters."""
+    mapper = DictParametersMapper(parameters)
+    batches = split(payloads, batch_size)
+
+    def run():
+        """Map all batches."""
+        for batch in batches:
+            mapper.map(batch)
+
+    return run
+
+
+def database_benchmark(multirow):
+    """Write batches to in-memory SQLite."""
+    def create(payloads, bodies, parameters, batch_size):
+        """Create database and callback."""
+        database = Database('sqlite://')
+        database.connection.execute(
+            'CREATE TABLE logs (timestamp TEXT, host TEXT, message TEXT)')
+        callback = database(QUERY, parameters, multirow=multirow)
+        batches = split(payloads, batch_size)
+
+        def run():
+            """Write all batches."""
+            for batch in batches:
+                callback(None, batch=batch)
+
+        return run
+
+    return create
+
+
+BENCHMARKS = [
+    ('consumer', consumer_benchmark),
+    ('batcher', batcher_benchmark),
+    ('dispatch', dispatch_benchmark(Signal)),
+    ('dispatch-blinker', dispatch_benchmark(blinker.Signal)),
+    ('mapper', mapper_benchmark),
+    ('database', database_benchmark(multirow=False)),
+    ('database-multirow', database_benchmark(multirow=True)),
+]
+
+
+def split(payloads, batch_size):
+    """Split messages in batches."""
+    return [
+        payloads[start:start + batch_size]
+        for start in range(0, len(payloads), batch_size)
+    ]
+
+
+def measure(run, messages, repeat):
+    """Measure throughput and peak memory of a benchmark.
+
+    :param run: Function that processes all messages once
+    :type run: callable
+    :param messages: Number of messages processed by the function
+    :type messages: int
+    :param repeat: Number of times the function is timed
+    :type repeat: int
+    :returns: Messages per second, microseconds per message and peak KiB
+    :rtype: dict(str, float)
+
+    """
+    run()  # warm up caches
+    elapsed = min(timeit.repeat(run, repeat=repeat, number=1))
+
+    tracemalloc.start()
+    run()
+    _size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'messages_per_second': messages / elapsed,
+        'us_per_message': elapsed / messages * 1e6,
+        'peak_memory_kib': peak / 1024.0,
+    }
+
+
+def run_benchmarks(messages, batch_size, repeat, pattern=None):
+    """Run benchmarks for every component and message shape.
+
+    :param messages: Number of messages per benchmark
+    :type messages: int
+    :param batch_size: Number of messages per batch
+    :type batch_size: int
+    :param repeat: Number of times each benchmark is timed
+    :type repeat: int
+    :param pattern: Substring that benchmark names must contain
+    :type pattern: str | None
+    :returns: Results by benchmark name (`component/shape`)
+    :rtype: dict(str, dict(str, float))
+
+    """
+    results = {}
+    for shape, (width, depth) in sorted(SHAPES.items()):
+        payloads = [
+            create_payload(index, width, depth) for index in range(messages)
+        ]
+        bodies = [json.dumps(payload).encode('utf-8') for payload in payloads]
+        parameters = get_parameters(depth)
+        for component, create in BENCHMARKS:
+            name = '{}/{}'.format(component, shape)
+            if pattern is not None and pattern not in name:
+                continue
+            run = create(payloads, bodies, parameters, batch_size)
+            results[name] = result = measure(run, messages, repeat)
+            print('{:<26} {:12,.0f} msg/s {:8.3f} us/msg {:10.1f} KiB'.format(
+                name,
+                result['messages_per_second'],
+                result['us_per_message'],
+                result['peak_memory_kib'],
+            ))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print throughput change against a baseline.
+
+    :param results: Results of the current run
+    :type results: dict(str, dict(str, float))
+    :param baseline: Results of a previous run
+    :type baseline: dict(str, dict(str, float))
+    :param threshold: Maximum throughput loss before a regression is reported
+    :type threshold: float
+    :returns: Names of the benchmarks that regressed
+    :rtype: list(str)
+
+    """
+    regressions = []
+    print()
+    for name in sorted(set(results) & set(baseline)):
+        current = results[name]['messages_per_second']
+        previous = baseline[name]['messages_per_second']
+        change = current / previous - 1
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print('{:<26} {:+7.1%}{}'.format(
+            name, change, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main(argv=None):
+    """Run benchmarks and optionally save or compare results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--messages', type=int, default=10000,
+        help='Messages per benchmark (%(default)s by default)')
+    parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help='Messages per batch (%(default)s by default)')
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Times each benchmark is timed (%(default)s by default)')
+    parser.add_argument(
+        '--filter', dest='pattern',
+        help='Run only benchmarks whose name contains this text')
+    parser.add_argument('--output', help='Path to save results as JSON')
+    parser.add_argument('--baseline', help='Path to results to compare with')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='Throughput loss reported as regression (%(default)s by default)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.messages, args.batch_size, args.repeat, args.pattern)
+
+    if args.output:
+        with open(args.output, 'w') as file_:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'messages': args.messages,
+                'batch_size': args.batch_size,
+                'results': results,
+            }, file_, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as file_:
+            baseline = json.load(file_)
+        if (baseline['messages'], baseline['batch_size']) != (
+                args.messages, args.batch_size):
+            print('Warning: baseline run with {} messages in batches of {}'
+                  .format(baseline['messages'], baseline['batch_size']))
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
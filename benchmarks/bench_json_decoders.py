@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark JSON decoder backends.
+
+Compares the per-message cost of decoding representative message bodies with
+every backend that is installed.
+
+Usage::
+
+    $ PYTHONPATH=src python benchmarks/bench_json_decoders.py
+
+"""
+
+from __future__ import print_function
+
+import json
+import timeit
+
+from rabbithole.decoders import (
+    DECODER_MODULES,
+    get_decoder,
+)
+
+PAYLOADS = {
+    'small': {
+        'timestamp': '2017-05-04T12:00:00',
+        'level': 'info',
+        'message': 'Hello world',
+    },
+    'nested': {
+        'timestamp': '2017-05-04T12:00:00',
+        'level': 'info',
+        'source': {'host': 'localhost', 'pid': 1234},
+        'message': {'text': 'Hello world', 'tags': ['a', 'b']},
+        'context': {'request': {'user': 'admin', 'path': '/'}},
+    },
+    'large': {
+        'timestamp': '2017-05-04T12:00:00',
+        'level': 'error',
+        'message': 'Traceback (most recent call last):\n' * 50,
+        'values': list(range(200)),
+        'fields': {'field_{}'.format(index): index for index in range(50)},
+    },
+}
+
+
+def main(number=20000, repeat=5):
+    """Print per-message cost for each installed backend."""
+    bodies = {
+        name: json.dumps(payload).encode('utf-8')
+        for name, payload in PAYLOADS.items()
+    }
+    for backend in sorted(DECODER_MODULES):
+        try:
+            _name, loads = get_decoder(backend)
+        except ImportError:
+            print('{:<12} not installed'.format(backend))
+            continue
+        results = []
+        for name in sorted(bodies):
+            body = bodies[name]
+            assert loads(body) == PAYLOADS[name]
+            elapsed = min(timeit.repeat(
+                lambda: loads(body), repeat=repeat, number=number))
+            results.append(
+                '{} {:7.3f} us'.format(name, elapsed / number * 1e6))
+        print('{:<12} {}'.format(backend, '  '.join(results)))
+
+
+if __name__ == '__main__':
+    main()
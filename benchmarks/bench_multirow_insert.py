@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark writing batches with multi-row INSERT statements.
+
+Compares the per-row cost of executing the query once per row (executemany)
+against rewriting it into chunked multi-row INSERT statements on SQLite.
+
+Usage::
+
+    $ PYTHONPATH=src python benchmarks/bench_multirow_insert.py
+
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from sqlalchemy import (
+    create_engine,
+    text,
+)
+
+from rabbithole.bulk import MultiRowInsert
+
+QUERY = (
+    'INSERT INTO logs (timestamp, level, host, message) '
+    'VALUES (:timestamp, :level, :host, :message)'
+)
+
+
+def main(batch_size=1000, repeat=5, number=20):
+    """Print per-row cost for both strategies."""
+    engine = create_engine('sqlite://')
+    engine.execute(
+        'CREATE TABLE logs (timestamp TEXT, level TEXT, host TEXT, '
+        'message TEXT)')
+    connection = engine.connect()
+
+    batch = [
+        {
+            'timestamp': '2017-05-04T12:00:00',
+            'level': 'info',
+            'host': 'localhost',
+            'message': 'Hello world {}'.format(index),
+        }
+        for index in range(batch_size)
+    ]
+    query = text(QUERY)
+    insert = MultiRowInsert(QUERY)
+
+    rows = batch_size * number
+    for name, function in (
+            ('executemany', lambda: connection.execute(query, batch)),
+            ('multirow', lambda: insert.execute(connection, batch)),
+            ):
+        elapsed = min(timeit.repeat(function, repeat=repeat, number=number))
+        print('{:<12} {:8.3f} us/row'.format(name, elapsed / rows * 1e6))
+
+
+if __name__ == '__main__':
+    main()
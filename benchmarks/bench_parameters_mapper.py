@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark mapping messages to query parameters.
+
+Compares the per-row cost of the compiled parameter mappers against the
+previous implementation, which split every dotted path for every field of
+every message.
+
+Usage::
+
+    $ PYTHONPATH=src python benchmarks/bench_parameters_mapper.py
+
+"""
+
+from __future__ import print_function
+
+import json
+import timeit
+
+import six
+
+from rabbithole.sql import DictParametersMapper
+
+PARAMETERS = {
+    'timestamp': 'timestamp',
+    'level': 'level',
+    'host': 'source.host',
+    'pid': 'source.pid',
+    'message': 'message.text',
+    'tags': 'message.tags',
+    'user': 'context.request.user',
+    'unknown': 'context.unknown',
+}
+
+MESSAGE = {
+    'timestamp': '2017-05-04T12:00:00',
+    'level': 'info',
+    'source': {'host': 'localhost', 'pid': 1234},
+    'message': {'text': 'Hello world', 'tags': ['a', 'b']},
+    'context': {'request': {'user': 'admin', 'path': '/'}},
+}
+
+
+def legacy_map_parameter(parameter, message):
+    """Map parameter splitting the path for every message."""
+    keys = parameter.split('.')
+    value = message
+    for key in keys:
+        if isinstance(value, dict):
+            value = value.get(key)
+        else:
+            return None
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+    return value
+
+
+def legacy_map(parameters, batch):
+    """Map batch creating the mapping for every batch."""
+    return [
+        {
+            key: legacy_map_parameter(parameter, message)
+            for key, parameter in six.iteritems(parameters)
+        }
+        for message in batch
+    ]
+
+
+def main(batch_size=1000, repeat=5, number=20):
+    """Print per-row cost for both implementations."""
+    batch = [MESSAGE] * batch_size
+    mapper = DictParametersMapper(PARAMETERS)
+    assert legacy_map(PARAMETERS, batch) == mapper.map(batch)
+
+    rows = batch_size * number
+    for name, function in (
+            ('legacy', lambda: legacy_map(PARAMETERS, batch)),
+            ('compiled', lambda: mapper.map(batch)),
+            ):
+        elapsed = min(timeit.repeat(function, repeat=repeat, number=number))
+        print('{:<10} {:8.3f} us/row'.format(name, elapsed / rows * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark projecting messages to the fields used by a flow.
+
+Compares keeping whole messages in a batch against keeping only the fields
+used as query parameters, both in per-message cost (decoding, projection and
+parameters mapping) and in memory held by a batch of wide messages.
+
+Usage::
+
+    $ PYTHONPATH=src python3 benchmarks/bench_projection.py
+
+"""
+
+from __future__ import print_function
+
+import json
+import timeit
+import tracemalloc
+
+from rabbithole.decoders import get_decoder
+from rabbithole.projection import (
+    compile_projection,
+    project,
+)
+from rabbithole.sql import DictParametersMapper
+
+PARAMETERS = {
+    'timestamp': 'timestamp',
+    'host': 'source.host',
+    'message': 'message.text',
+    'tags': 'message.tags',
+}
+
+
+def create_message(index):
+    """Create wide telemetry message."""
+    message = {
+        'timestamp': '2017-05-04T12:00:00',
+        'source': {'host': 'host-{}'.format(index), 'pid': index},
+        'message': {'text': 'Hello world {}'.format(index), 'tags': ['a']},
+    }
+    for group in range(3):
+        message['metrics_{}'.format(group)] = {
+            'metric_{}'.format(metric): {
+                'value': metric * 1.5,
+                'unit': 'ms',
+                'labels': ['label-a', 'label-b'],
+            }
+            for metric in range(15)
+        }
+    for field in range(30):
+        message['field_{}'.format(field)] = 'value {}'.format(field)
+    return message
+
+
+def batch_memory(bodies, loads, tree):
+    """Get memory held by a batch of decoded messages."""
+    tracemalloc.start()
+    if tree is None:
+        batch = [loads(body) for body in bodies]
+    else:
+        batch = [project(loads(body), tree) for body in bodies]
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del batch
+    return size
+
+
+def main(batch_size=1000, repeat=5, number=5):
+    """Print per-message cost and batch memory with and without projection."""
+    bodies = [
+        json.dumps(create_message(index)).encode('utf-8')
+        for index in range(batch_size)
+    ]
+    mapper = DictParametersMapper(PARAMETERS)
+    tree = compile_projection(mapper.fields)
+
+    for backend in ('json', 'auto'):
+        name, loads = get_decoder(backend)
+
+        def whole():
+            """Decode and map whole messages."""
+            return mapper.map([loads(body) for body in bodies])
+
+        def projected():
+            """Decode, project and map messages."""
+            return mapper.map([project(loads(body), tree) for body in bodies])
+
+        assert whole() == projected()
+        for label, function, batch_tree in (
+                ('whole', whole, None),
+                ('projected', projected, tree),
+                ):
+            elapsed = min(
+                timeit.repeat(function, repeat=repeat, number=number))
+            memory = batch_memory(bodies, loads, batch_tree)
+            print('{:<8} {:<10} {:8.3f} us/message {:10.1f} KiB/batch'.format(
+                name,
+                label,
+                elapsed / (batch_size * number) * 1e6,
+                memory / 1024.0,
+            ))
+
+
+if __name__ == '__main__':
+    main()
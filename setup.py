@@ -83,5 +83,7 @@ setup(
     cmdclass={'test': PyTest},
     extras_require={
         'postgresql': ['psycopg2'],
+        'orjson': ['orjson'],
+        'ujson': ['ujson'],
     },
 )
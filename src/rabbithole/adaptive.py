@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""Adaptive: adjust batcher limits to the output and the incoming traffic.
+
+The strategy to adjust the limits after every batch is written is:
+    - track the write latency (time from the batch being sent until the output
+      is done with it) and the rate at which messages arrive
+    - decrease the size limit multiplicatively when a write fails or is slower
+      than the target latency, since the output can't keep up
+    - otherwise, increase it additively when the batch was sent because it was
+      full, since larger batches are written more efficiently
+    - set the time limit to the target latency minus the write latency and
+      cap the size limit to the messages expected within that time, so that
+      messages don't wait longer than the target when traffic is light
+
+"""
+
+import logging
+import threading
+
+from typing import (  # noqa
+    Optional,
+    Tuple,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AimdPolicy(object):
+
+    """Additive increase, multiplicative decrease of the batch size limit.
+
+    :param target_latency:
+        Maximum time in seconds from a message being received until the batch
+        it belongs to has been written
+    :type target_latency: float
+    :param min_size: Minimum size limit in number of messages
+    :type min_size: int
+    :param max_size: Maximum size limit in number of messages
+    :type max_size: int
+    :param increase:
+        Messages added to the size limit after a full batch is written
+        (2% of the range between the minimum and maximum by default)
+    :type increase: int | None
+    :param decrease: Factor applied to the size limit when the output is slow
+    :type decrease: float
+    :param smoothing:
+        Weight of the last sample in the moving averages of the write latency
+        and the message rate
+    :type smoothing: float
+
+    """
+
+    def __init__(
+            self,
+            target_latency,  # type: float
+            min_size=1,  # type: int
+            max_size=10000,  # type: int
+            increase=None,  # type: Optional[int]
+            decrease=0.5,  # type: float
+            smoothing=0.2,  # type: float
+            ):
+        # type: (...) -> None
+        """Initialize limits."""
+        if not 0 < min_size <= max_size:
+            raise ValueError(
+                'Invalid size bounds: {} - {}'.format(min_size, max_size))
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self.max_size = max_size
+        self.increase = increase or max(1, (max_size - min_size) // 50)
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+
+        self.size_limit = min_size
+        self.time_limit = target_latency / 2.0
+        self.latency = None  # type: Optional[float]
+        self.rate = None  # type: Optional[float]
+
+    def batch_written(self, size, reason, fill_time, latency, success):
+        # type: (int, str, float, float, bool) -> Tuple[int, float]
+        """Update limits once a batch has been written.
+
+        :param size: Number of messages in the batch
+        :type size: int
+        :param reason: Why the batch was sent (`size`, `time` or `queued`)
+        :type reason: str
+        :param fill_time:
+            Time in seconds from the first message in the batch being received
+            until the batch was sent
+        :type fill_time: float
+        :param latency:
+            Time in seconds from the batch being sent until it was written
+        :type latency: float
+        :param success: Whether the batch was written
+        :type success: bool
+        :returns: New size and time limits
+        :rtype: tuple(int, float)
+
+        """
+        with self.lock:
+            self.latency = self.average(self.latency, latency)
+            if fill_time > 0:
+                self.rate = self.average(self.rate, size / fill_time)
+
+            if not success or latency > self.target_latency:
+                size_limit = int(self.size_limit * self.decrease)
+            elif reason == 'size':
+                size_limit = self.size_limit + self.increase
+            else:
+                size_limit = self.size_limit
+
+            # Leave room for the write in the target latency
+            time_limit = min(
+                self.target_latency,
+                max(
+                    self.target_latency * 0.1,
+                    self.target_latency - self.latency,
+                ),
+            )
+            if self.rate is not None:
+                # Don't wait for more messages than expected in time
+                size_limit = min(size_limit, int(self.rate * time_limit))
+            size_limit = max(self.min_size, min(self.max_size, size_limit))
+
+            if size_limit != self.size_limit:
+                LOGGER.debug(
+                    'Batch size limit changed: %d -> %d '
+                    '(latency: %.3f, rate: %.1f)',
+                    self.size_limit,
+                    size_limit,
+                    self.latency,
+                    self.rate or 0,
+                )
+            self.size_limit = size_limit
+            self.time_limit = time_limit
+            return size_limit, time_limit
+
+    def average(self, current, sample):
+        # type: (Optional[float], float) -> float
+        """Update exponential moving average with a new sample.
+
+        :param current: Current average (None if there are no samples yet)
+        :type current: float | None
+        :param sample: New sample
+        :type sample: float
+        :returns: New average
+        :rtype: float
+
+        """
+        if current is None:
+            return sample
+        return current + self.smoothing * (sample - current)
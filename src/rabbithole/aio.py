@@ -0,0 +1,813 @@
+# -*- coding: utf-8 -*-
+
+"""Asyncio runtime: run all flows in a single event loop.
+
+This runtime is an alternative to the default one, in which every input block
+runs in its own thread and every batch time limit is handled by a timer
+thread. Here:
+    - messages are consumed using pika's asyncio connection adapter
+    - batch time limits are handled by the event loop
+    - output callbacks run in a thread pool executor, so that database writes
+      don't block the event loop
+    - on SIGTERM, the event loop is stopped and flows are drained in it before
+      exiting
+
+Note that this module is only available in python 3.
+
+"""
+
+import asyncio
+import logging
+import signal
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import pika
+import six
+
+from pika.adapters.asyncio_connection import AsyncioConnection  # type: ignore  # noqa
+from typing import (  # noqa
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from rabbithole.amqp import (
+    Acknowledger,
+    Consumer,
+    get_bind_kwargs,
+)
+from rabbithole.batcher import Batcher
+from rabbithole.decoders import get_decoder
+from rabbithole.logs import RateLimiter
+from rabbithole.routing import Binding
+from rabbithole.signals import Signal  # noqa
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncioConsumer(Consumer):
+
+    """AMQP message consumer driven by an asyncio event loop.
+
+    Exchanges can be requested before the connection has been established.
+    They are declared and bound to the queue as soon as the channel is open.
+    If the connection is lost, the consumer reconnects after a delay.
+
+    :param url: AMQP server connection string
+    :type server: str
+    :param ack_after_commit:
+        Acknowledge messages only after they have been written to the output
+    :type ack_after_commit: bool
+    :param prefetch_count:
+        Maximum number of unacknowledged messages delivered by the server
+    :type prefetch_count: int | None
+    :param decoder:
+        JSON decoder backend name or `auto` to use the fastest one installed
+    :type decoder: str
+    :param payload_log_rate:
+        Maximum number of message payloads logged per second at debug level
+    :type payload_log_rate: int
+    :param requeue:
+        Whether messages whose batch couldn't be written are requeued instead
+        of being dropped (or dead-lettered if the queue has a dead letter
+        exchange). Only used if `ack_after_commit` is enabled. Rows that fail
+        on their own are rejected by the output and don't fail the batch.
+    :type requeue: bool
+    :param loop: Event loop used to consume messages
+    :type loop: asyncio.AbstractEventLoop
+
+    """
+
+    RECONNECT_DELAY = 5
+
+    # pylint:disable=super-init-not-called
+    def __init__(
+            self,
+            url,  # type: str
+            ack_after_commit=False,  # type: bool
+            prefetch_count=None,  # type: Optional[int]
+            decoder='auto',  # type: str
+            payload_log_rate=10,  # type: int
+            requeue=True,  # type: bool
+            loop=None,  # type: Optional[asyncio.AbstractEventLoop]
+            ):
+        # type: (...) -> None
+        """Initialize internal data structures."""
+        self.payload_log = RateLimiter(payload_log_rate)
+        self.decoder, self.decode = get_decoder(decoder)
+        self.url = url
+        self.ack_after_commit = ack_after_commit
+        self.requeue = requeue
+        self.prefetch_count = prefetch_count
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.connection = None  # type: Any
+        self.channel = None  # type: Any
+        self.queue_name = None  # type: Optional[str]
+        self.acknowledger = None  # type: Optional[Acknowledger]
+        self.acknowledgers = {}  # type: Dict[object, Acknowledger]
+        self.signals = {}  # type: Dict[Tuple[Optional[str], str, Tuple], Signal]  # noqa
+        self.routes = {}  # type: Dict[Tuple[Optional[str], str], List[Tuple[Binding, Signal]]]  # noqa
+        self.named_queues = {}  # type: Dict[str, bool]
+        self.exchange_fields = {}  # type: Dict[str, Optional[Set[str]]]
+        self.projections = {}  # type: Dict[str, Dict[str, Any]]
+        self.metrics = {}  # type: Dict[str, Tuple[Any, Any, Any]]
+        self.exchanges = {}  # type: Dict[str, Dict[str, Any]]
+        self.consumer_tags = []  # type: List[str]
+        self.closed = None  # type: Optional[asyncio.Future]
+
+    def __call__(
+            self,
+            exchange,  # type: str
+            consumers=None,  # type: Optional[int]
+            fields=None,  # type: Optional[List[str]]
+            routing_keys=None,  # type: Union[str, List[str], None]
+            arguments=None,  # type: Optional[Dict[str, Any]]
+            queue=None,  # type: Optional[str]
+            **kwargs  # type: Any
+            ):
+        # type: (...) -> Signal
+        """Create signal to send when a message from a exchange is received.
+
+        :param exchange: Exchange name to bind to the queue
+        :type exchange: str
+        :param consumers:
+            Dedicated consumers aren't supported in the asyncio runtime, since
+            all messages are already consumed in the same event loop
+        :type consumers: int | None
+        :param fields:
+            Dotted paths to the message fields used by the flow or None if
+            the whole messages are used
+        :type fields: list(str) | None
+        :param routing_keys:
+            Routing keys (or topic patterns) with which the queue is bound to
+            the exchange. If not set, all messages are received.
+        :type routing_keys: str | list(str) | None
+        :param arguments:
+            Binding arguments, such as the headers to match in a `headers`
+            exchange
+        :type arguments: dict(str) | None
+        :param queue:
+            Name of a durable queue whose messages are shared with any other
+            consumer of the same queue. If not set, the anonymous queue shared
+            by all exchanges is used.
+        :type queue: str | None
+        :param kwargs:
+            Additional parameters to pika.channel.Channel.exchange_declare
+        :type kwargs: dict(str)
+        :returns: The signal that will be send, so that it can be connected
+        :rtype: :class:`rabbithole.signals.Signal`
+
+        """
+        self.add_fields(exchange, fields)
+        binding = Binding(kwargs.get('exchange_type'), routing_keys, arguments)
+        if (queue, exchange, binding.key) in self.signals:
+            return self.signals[queue, exchange, binding.key]
+
+        if consumers is not None:
+            LOGGER.warning(
+                'Dedicated consumers ignored for exchange %r', exchange)
+        self.exchanges.setdefault(exchange, kwargs)
+        signal = self.add_signal(queue, exchange, binding)
+        if self.queue_name is not None:
+            if queue is None:
+                self.bind(exchange, self.exchanges[exchange], binding)
+            elif queue not in self.named_queues:
+                # Bound with the rest of flows once it has been declared
+                self.declare_queue(queue)
+            elif self.named_queues[queue]:
+                self.bind(exchange, self.exchanges[exchange], binding, queue)
+
+        self.add_metrics(exchange)
+        return signal
+
+    def start(self):
+        # type: () -> None
+        """Connect to the AMQP server.
+
+        Messages will be consumed by the event loop once the connection has
+        been established.
+
+        """
+        if self.closed is not None:
+            return
+        LOGGER.info('Connecting to %r...', self.url)
+        self.queue_name = None
+        self.named_queues = {}
+        self.consumer_tags = []
+        self.connection = AsyncioConnection(
+            pika.URLParameters(self.url),
+            on_open_callback=self.connection_open_cb,
+            on_open_error_callback=self.connection_error_cb,
+            on_close_callback=self.connection_error_cb,
+            custom_ioloop=self.loop,
+        )
+
+    def connection_open_cb(self, connection):
+        # type: (AsyncioConnection) -> None
+        """Open channel once connection is ready.
+
+        :param connection: Connection with the AMQP server
+        :type connection: pika.adapters.asyncio_connection.AsyncioConnection
+
+        """
+        connection.channel(on_open_callback=self.channel_open_cb)
+
+    def connection_error_cb(self, connection, error):
+        # type: (AsyncioConnection, Exception) -> None
+        """Schedule reconnection when the connection fails or is closed.
+
+        :param connection: Connection with the AMQP server
+        :type connection: pika.adapters.asyncio_connection.AsyncioConnection
+        :param error: Reason why the connection failed
+        :type error: Exception
+
+        """
+        if self.closed is not None:
+            LOGGER.debug('Connection to %r closed', self.url)
+            if not self.closed.done():
+                self.closed.set_result(None)
+            return
+        LOGGER.error(
+            'Connection to %r lost (%s). Reconnecting in %d seconds...',
+            self.url,
+            error,
+            self.RECONNECT_DELAY,
+        )
+        self.loop.call_later(self.RECONNECT_DELAY, self.start)
+
+    def channel_open_cb(self, channel):
+        # type: (Any) -> None
+        """Declare queue once channel is ready.
+
+        :param channel: Channel with the AMQP server
+        :type channel: pika.channel.Channel
+
+        """
+        self.channel = channel
+        if self.prefetch_count is not None:
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+
+        # Use a single queue to process messages from all exchanges
+        channel.queue_declare(
+            '', auto_delete=True, callback=self.queue_declared_cb)
+
+    def queue_declared_cb(self, frame):
+        # type: (Any) -> None
+        """Bind exchanges and start consuming once queue is ready.
+
+        :param frame: Queue declaration response
+        :type frame: pika.frame.Method
+
+        """
+        queue_name = frame.method.queue
+        LOGGER.debug('Declared queue %r', queue_name)
+        self.queue_name = queue_name
+
+        if self.ack_after_commit:
+            # Acknowledgements are scheduled like in a blocking connection
+            callbacks = LoopCallbacks(self.loop)  # type: Any
+            self.acknowledger = Acknowledger(
+                callbacks, self.channel, self.requeue)
+        queues = set()  # type: Set[str]
+        for (queue, exchange), routes in six.iteritems(self.routes):
+            if queue is not None:
+                queues.add(queue)
+                continue
+            for binding, _signal in routes:
+                self.bind(exchange, self.exchanges[exchange], binding)
+        for queue in sorted(queues):
+            self.declare_queue(queue)
+
+        self.consumer_tags.append(
+            self.channel.basic_consume(queue_name, self.message_received_cb))
+        LOGGER.info('Waiting for messages...')
+
+    def declare_queue(self, queue):
+        # type: (str) -> None
+        """Declare durable queue and start consuming from it.
+
+        :param queue: Queue name
+        :type queue: str
+
+        """
+        def queue_declared_cb(_frame):
+            # type: (Any) -> None
+            """Bind exchanges and start consuming once queue is ready."""
+            LOGGER.debug('Declared durable queue %r', queue)
+            self.named_queues[queue] = True
+            for (route_queue, exchange), routes in six.iteritems(self.routes):
+                if route_queue != queue:
+                    continue
+                for binding, _signal in routes:
+                    self.bind(
+                        exchange, self.exchanges[exchange], binding, queue)
+            self.consumer_tags.append(self.channel.basic_consume(
+                queue, partial(self.message_received_cb, queue=queue)))
+
+        self.named_queues[queue] = False
+        self.channel.queue_declare(
+            queue, durable=True, callback=queue_declared_cb)
+
+    def stop_consuming(self):
+        # type: () -> asyncio.Future
+        """Cancel every consumer, so that no more messages are delivered.
+
+        :returns: Future done once the server has confirmed every cancellation
+        :rtype: asyncio.Future
+
+        """
+        LOGGER.info('Stopping consumer...')
+        futures = []  # type: List[asyncio.Future]
+        if self.channel is not None and self.channel.is_open:
+            for consumer_tag in self.consumer_tags:
+                future = self.loop.create_future()
+                self.channel.basic_cancel(
+                    consumer_tag,
+                    callback=partial(set_result_cb, future),
+                )
+                futures.append(future)
+        self.consumer_tags = []
+        return asyncio.gather(*futures)
+
+    def close_connection(self):
+        # type: () -> asyncio.Future
+        """Close connection instead of reconnecting.
+
+        Messages that haven't been acknowledged yet are delivered again
+        by the server once the connection is closed.
+
+        :returns: Future done once the connection has been closed
+        :rtype: asyncio.Future
+
+        """
+        self.closed = self.loop.create_future()
+        if self.connection is None or self.connection.is_closed:
+            self.closed.set_result(None)
+        elif not self.connection.is_closing:
+            self.connection.close()
+        return self.closed
+
+    def bind(self, exchange, kwargs, binding, queue=None):
+        # type: (str, Dict[str, Any], Binding, Optional[str]) -> None
+        """Declare exchange and bind it to the queue.
+
+        :param exchange: Exchange name to bind to the queue
+        :type exchange: str
+        :param kwargs:
+            Additional parameters to pika.channel.Channel.exchange_declare
+        :type kwargs: dict(str)
+        :param binding: Routing keys and arguments used to bind the queue
+        :type binding: rabbithole.routing.Binding
+        :param queue: Named queue (the shared queue by default)
+        :type queue: str | None
+
+        """
+        queue_name = queue or self.queue_name
+
+        def exchange_declared_cb(_frame):
+            # type: (Any) -> None
+            """Bind exchange to queue once it has been declared."""
+            for bind_kwargs in get_bind_kwargs(binding):
+                self.channel.queue_bind(queue_name, exchange, **bind_kwargs)
+                LOGGER.debug(
+                    'Queue %r bound to exchange %r %s',
+                    queue_name,
+                    exchange,
+                    bind_kwargs,
+                )
+
+        self.channel.exchange_declare(
+            exchange=exchange,
+            callback=exchange_declared_cb,
+            **kwargs
+        )
+
+
+class LoopCallbacks(object):
+
+    """Schedule acknowledgements to run in the event loop.
+
+    :param loop: Event loop in which the channel is used
+    :type loop: asyncio.AbstractEventLoop
+
+    """
+
+    def __init__(self, loop):
+        # type: (asyncio.AbstractEventLoop) -> None
+        """Store event loop."""
+        self.loop = loop
+
+    def add_callback_threadsafe(self, callback):
+        # type: (Callable[[], None]) -> None
+        """Run callback in the event loop.
+
+        :param callback: Function to run
+        :type callback: callable
+
+        """
+        self.loop.call_soon_threadsafe(callback)
+
+
+class AsyncioScheduler(object):
+
+    """Schedule batcher time limits in an asyncio event loop.
+
+    :param loop: Event loop used to handle the time limit
+    :type loop: asyncio.AbstractEventLoop
+
+    """
+
+    def __init__(self, loop):
+        # type: (asyncio.AbstractEventLoop) -> None
+        """Store event loop."""
+        self.loop = loop
+
+    def schedule(self, delay, callback):
+        # type: (float, Callable[[], None]) -> asyncio.TimerHandle
+        """Schedule callback to run after a delay.
+
+        :param delay: Delay in seconds
+        :type delay: float
+        :param callback: Function to run
+        :type callback: callable
+        :returns: Handle that can be cancelled
+        :rtype: asyncio.TimerHandle
+
+        """
+        return self.loop.call_later(delay, callback)
+
+
+class AsyncioBatcher(Batcher):
+
+    """Batcher whose time limit is handled by an asyncio event loop.
+
+    :param size_limit: Capacity of the batcher in number of messages
+    :type size_limit: int
+    :param time_limit: Time before sending batch to the output in seconds
+    :type time_limit: float
+    :param loop: Event loop used to handle the time limit
+    :type loop: asyncio.AbstractEventLoop
+    :param name: Name of the flow used to label the batcher metrics
+    :type name: str | None
+    :param bytes_limit: Capacity of the batcher in bytes of the raw messages
+    :type bytes_limit: int | None
+    :param adaptive: Parameters of the policy used to adjust the limits
+    :type adaptive: dict(str) | None
+
+    """
+
+    def __init__(
+            self,
+            size_limit=None,  # type: Optional[int]
+            time_limit=None,  # type: Optional[float]
+            loop=None,  # type: Optional[asyncio.AbstractEventLoop]
+            name=None,  # type: Optional[str]
+            bytes_limit=None,  # type: Optional[int]
+            adaptive=None,  # type: Optional[Dict[str, Any]]
+            ):
+        # type: (...) -> None
+        """Initialize internal data structures."""
+        # Time limits are scheduled like in the scheduler thread
+        scheduler = AsyncioScheduler(
+            loop or asyncio.get_event_loop())  # type: Any
+        super(AsyncioBatcher, self).__init__(
+            size_limit,
+            time_limit,
+            scheduler,
+            name=name,
+            bytes_limit=bytes_limit,
+            adaptive=adaptive,
+        )
+
+
+class ExecutorOutput(object):
+
+    """Run output block callbacks in an executor.
+
+    :param block: Output block instance
+    :type block: object
+    :param executor: Executor in which callbacks are run
+    :type executor: concurrent.futures.Executor
+    :param loop: Event loop to which results are returned
+    :type loop: asyncio.AbstractEventLoop
+
+    """
+
+    def __init__(self, block, executor, loop):
+        # type: (Any, ThreadPoolExecutor, asyncio.AbstractEventLoop) -> None
+        """Store block, executor and event loop."""
+        self.block = block
+        self.executor = executor
+        self.loop = loop
+        self.pending = set()  # type: Set[asyncio.Future]
+
+    def __call__(self, *args, **kwargs):
+        # type: (*Any, **Any) -> Callable
+        """Return callback that runs the output block callback in an executor.
+
+        :param args: Positional arguments to the output block
+        :type args: list
+        :param kwargs:
+            Keyword arguments to the output block. The `ordering_key` is
+            ignored, since a single thread is used per output block. If `wait`
+            is false, messages are settled without waiting for their batches
+            to be written.
+        :type kwargs: dict(str)
+
+        """
+        kwargs.pop('ordering_key', None)
+        wait = kwargs.pop('wait', True)
+        callback = self.block(*args, **kwargs)
+        if not wait:
+            return partial(self.run_best_effort, callback)
+        return partial(self.run_in_executor, callback)
+
+    def fields(self, *args, **kwargs):
+        # type: (*Any, **Any) -> Optional[List[str]]
+        """Get the message fields read by the output block callback.
+
+        :param args: Positional arguments to the output block
+        :type args: list
+        :param kwargs: Keyword arguments to the output block
+        :type kwargs: dict(str)
+        :returns: Dotted paths or None if the whole messages are needed
+        :rtype: list(str) | None
+
+        """
+        kwargs.pop('ordering_key', None)
+        kwargs.pop('wait', None)
+        fields_method = getattr(self.block, 'fields', None)
+        if fields_method is None:
+            return None
+        return fields_method(*args, **kwargs)
+
+    def run_in_executor(self, callback, sender, **kwargs):
+        # type: (Callable, object, **Any) -> asyncio.Future
+        """Run callback in the executor.
+
+        :param callback: Output block callback
+        :type callback: callable
+        :param sender: The batcher who sent the batch_ready signal
+        :type sender: rabbithole.batcher.Batcher
+        :param kwargs: Keyword arguments sent with the signal
+        :type kwargs: dict(str)
+        :returns: Future for the callback result
+        :rtype: asyncio.Future
+
+        """
+        future = self.loop.run_in_executor(
+            self.executor, partial(callback, sender, **kwargs))
+        future.add_done_callback(self.callback_done_cb)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+
+    def run_best_effort(self, callback, sender, **kwargs):
+        # type: (Callable, object, **Any) -> None
+        """Run callback in the executor without waiting for its result.
+
+        :param callback: Output block callback
+        :type callback: callable
+        :param sender: The batcher who sent the batch_ready signal
+        :type sender: rabbithole.batcher.Batcher
+        :param kwargs: Keyword arguments sent with the signal
+        :type kwargs: dict(str)
+
+        """
+        self.run_in_executor(callback, sender, **kwargs)
+
+    @staticmethod
+    def callback_done_cb(future):
+        # type: (asyncio.Future) -> None
+        """Log unexpected errors raised by the output callback.
+
+        :param future: Future for the callback result
+        :type future: asyncio.Future
+
+        """
+        if not future.cancelled() and future.exception() is not None:
+            LOGGER.error(
+                'Output callback error',
+                exc_info=future.exception(),
+            )
+
+
+def set_result_cb(future, _frame):
+    # type: (asyncio.Future, Any) -> None
+    """Mark future as done when the server confirms an operation.
+
+    :param future: Future waiting for the confirmation
+    :type future: asyncio.Future
+    :param _frame: Confirmation received from the server
+    :type _frame: pika.frame.Method
+
+    """
+    if not future.done():
+        future.set_result(None)
+
+
+def drain_flows(namespace, batchers, timeout, loop):
+    # type: (Dict[str, Any], List[Batcher], float, asyncio.AbstractEventLoop) -> asyncio.Future  # noqa
+    """Stop flows without losing the messages that are being processed.
+
+    Same strategy as :func:`rabbithole.cli.drain_flows`, but chaining loop
+    callbacks on futures instead of joining threads. Output blocks are closed
+    in their executors, so that the event loop keeps sending acknowledgements
+    meanwhile.
+
+    :param namespace: Block instances namespace
+    :type namespace: dict(str, instance)
+    :param batchers: Batchers for all the flows
+    :type batchers: list(rabbithole.batcher.Batcher)
+    :param timeout: Maximum number of seconds to wait for the whole process
+    :type timeout: float
+    :param loop: Event loop in which flows run
+    :type loop: asyncio.AbstractEventLoop
+    :returns: Future done once flows have been drained
+    :rtype: asyncio.Future
+
+    """
+    # Imported here to avoid circular imports
+    from rabbithole.cli import close_block
+
+    LOGGER.info('Draining flows (timeout: %.2f seconds)...', timeout)
+    deadline = loop.time() + timeout
+    drained = loop.create_future()
+    consumers = [
+        block_instance for block_instance in namespace.values()
+        if isinstance(block_instance, AsyncioConsumer)
+    ]
+    outputs = [
+        block_instance for block_instance in namespace.values()
+        if isinstance(block_instance, ExecutorOutput)
+    ]
+
+    def remaining():
+        # type: () -> float
+        """Get seconds until the deadline."""
+        return max(0, deadline - loop.time())
+
+    def wait(futures, message, callback):
+        # type: (List[asyncio.Future], str, Callable[[], None]) -> None
+        """Call function once futures are done or the deadline is reached."""
+        pending = set(futures)
+        if not pending:
+            loop.call_soon(callback)
+            return
+
+        def deadline_cb():
+            # type: () -> None
+            """Give up waiting for the futures."""
+            LOGGER.warning(message)
+            pending.clear()
+            callback()
+
+        timer = loop.call_later(remaining(), deadline_cb)
+
+        def future_done_cb(future):
+            # type: (asyncio.Future) -> None
+            """Go on once the last future is done."""
+            if future not in pending:
+                return
+            pending.discard(future)
+            if not pending:
+                timer.cancel()
+                callback()
+
+        for future in futures:
+            future.add_done_callback(future_done_cb)
+
+    def consumers_stopped_cb():
+        # type: () -> None
+        """Send pending messages to the output."""
+        for batcher in batchers:
+            batcher.flush()
+        wait(
+            [future for output in outputs for future in output.pending],
+            'Timeout while waiting for batches to be written',
+            batches_written_cb,
+        )
+
+    def batches_written_cb():
+        # type: () -> None
+        """Close output blocks once their batches have been written."""
+        wait(
+            [
+                loop.run_in_executor(
+                    output.executor,
+                    partial(close_block, output.block, remaining()),
+                )
+                for output in outputs
+            ],
+            'Timeout while waiting for output blocks to close',
+            outputs_closed_cb,
+        )
+
+    def outputs_closed_cb():
+        # type: () -> None
+        """Close connections once acknowledgements have been sent."""
+        wait(
+            [consumer.close_connection() for consumer in consumers],
+            'Timeout while waiting for connection to close',
+            connections_closed_cb,
+        )
+
+    def connections_closed_cb():
+        # type: () -> None
+        """Mark flows as drained."""
+        LOGGER.info('Flows drained')
+        if not drained.done():
+            drained.set_result(None)
+
+    wait(
+        [consumer.stop_consuming() for consumer in consumers],
+        'Timeout while waiting for consumer to stop',
+        consumers_stopped_cb,
+    )
+    return drained
+
+
+def main(config):
+    # type: (Dict[str, Any]) -> int
+    """Run flows in an asyncio event loop.
+
+    :param config: Configuration
+    :type config: dict(str)
+
+    """
+    # Imported here to avoid circular imports
+    from rabbithole.cli import (
+        BLOCK_CLASSES,
+        DEFAULT_SHUTDOWN_TIMEOUT,
+        create_block_instance,
+        create_flow,
+        get_batcher_config,
+        get_output_block_names,
+        start_metrics_server,
+    )
+
+    start_metrics_server(config)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    block_classes = dict(BLOCK_CLASSES)
+    block_classes['amqp'] = partial(AsyncioConsumer, loop=loop)
+    namespace = {
+        block['name']: create_block_instance(block, block_classes)
+        for block in config['blocks']
+    }
+
+    # Each output block gets a single thread executor
+    # since blocks aren't expected to be thread safe
+    executors = []  # type: List[ThreadPoolExecutor]
+    for name in get_output_block_names(config['flows']):
+        executor = ThreadPoolExecutor(max_workers=1)
+        executors.append(executor)
+        namespace[name] = ExecutorOutput(namespace[name], executor, loop)
+
+    batcher_config = get_batcher_config(config)
+    batcher_factory = partial(AsyncioBatcher, loop=loop)
+    batchers = {}  # type: Dict[Tuple[int, str], Batcher]
+    for flow in config['flows']:
+        create_flow(
+            flow, namespace, batcher_config, batcher_factory, batchers)
+
+    for name, block_instance in six.iteritems(namespace):
+        if isinstance(block_instance, AsyncioConsumer):
+            block_instance.start()
+        elif hasattr(block_instance, 'run'):
+            LOGGER.error(
+                'Input block %r not supported by the asyncio runtime', name)
+
+    def terminate():
+        # type: () -> None
+        """Stop event loop, so that flows are drained."""
+        LOGGER.info('Terminated')
+        loop.stop()
+
+    loop.add_signal_handler(signal.SIGTERM, terminate)
+    try:
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            LOGGER.info('Interrupted by user')
+        loop.run_until_complete(drain_flows(
+            namespace,
+            list(batchers.values()),
+            config.get('shutdown_timeout', DEFAULT_SHUTDOWN_TIMEOUT),
+            loop,
+        ))
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
+        loop.close()
+
+    return 0
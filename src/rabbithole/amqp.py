@@ -6,20 +6,84 @@ The strategy to get messages is:
     - connect to the amqp server
     - bind a queue to the desired exchanges
 
-Note that it's assumed that the exchanges will have `fanout` type and that the
-routing key isn't relevant in this case.
+By default, a single queue is used for all the exchanges. To avoid head-of-line
+blocking, an exchange can be isolated with a dedicated queue that is consumed
+by one or more dedicated connections, each one running in its own thread.
+
+Both of them are anonymous queues that are deleted when the consumer exits.
+To share the messages of a flow between several processes or hosts and keep
+them while no process is running, a named durable queue can be used instead.
+Every consumer of a named queue competes for its messages, so each one gets
+a share of them, and messages that haven't been acknowledged are delivered
+again to another consumer if one of them exits.
+
+Flows can set the routing keys (or topic patterns for `topic` exchanges) and
+the header arguments (for `headers` exchanges) they need, so that the rest of
+messages are dropped by the server. Each binding gets its own signal and the
+messages received are sent only through the signals of the bindings they
+match (see :mod:`rabbithole.routing`). Flows that don't set any of them get
+all the messages in the exchange, which is the expected usage for `fanout`
+exchanges.
+
+By default, messages are acknowledged as soon as they are received. When
+`ack_after_commit` is enabled, the delivery tag of each message is sent along
+with the payload and messages are only acknowledged (using a single
+`basic_ack` with `multiple=True` whenever possible) after the batch they
+belong to has been successfully written to the output. Messages whose batch
+couldn't be written (for example, because the database is down) are requeued,
+so that they are delivered again once the output recovers.
+
+Flows can be added and removed while the consumer is running. Since channels
+aren't thread safe, queues are declared, bound and unbound in the connection
+thread, and dedicated connections whose queue isn't bound anymore stop
+consuming and are closed once their messages have been settled.
+
+Message bodies are decoded with the fastest JSON backend available unless a
+specific one is set with the `decoder` parameter (see
+:mod:`rabbithole.decoders`). When the flows for an exchange only use some of
+the message fields, the rest of them are discarded as soon as the message is
+decoded (see :mod:`rabbithole.projection`).
 
 """
 
-import json
 import logging
+import threading
 
+from functools import partial
 from pprint import pformat
 
-import blinker
 import pika
 
-from typing import Dict  # noqa
+from six.moves import range  # pylint:disable=redefined-builtin
+
+from typing import (  # noqa
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from rabbithole.decoders import get_decoder
+from rabbithole.logs import RateLimiter
+from rabbithole.metrics import (
+    DECODE_ERRORS,
+    DECODE_SECONDS,
+    MESSAGES_RECEIVED,
+    perf_counter,
+)
+from rabbithole.projection import (
+    compile_projection,
+    project,
+)
+from rabbithole.routing import Binding
+from rabbithole.scheduler import monotonic
+from rabbithole.signals import Signal
+from rabbithole.writer import Future
 
 LOGGER = logging.getLogger(__name__)
 
@@ -30,16 +94,57 @@ class Consumer(object):
 
     :param url: AMQP server connection string
     :type server: str
+    :param ack_after_commit:
+        Acknowledge messages only after they have been written to the output
+    :type ack_after_commit: bool
+    :param prefetch_count:
+        Maximum number of unacknowledged messages delivered by the server
+    :type prefetch_count: int | None
+    :param decoder:
+        JSON decoder backend name or `auto` to use the fastest one installed
+    :type decoder: str
+    :param payload_log_rate:
+        Maximum number of message payloads logged per second at debug level
+    :type payload_log_rate: int
+    :param requeue:
+        Whether messages whose batch couldn't be written are requeued instead
+        of being dropped (or dead-lettered if the queue has a dead letter
+        exchange). Only used if `ack_after_commit` is enabled. Rows that fail
+        on their own are rejected by the output and don't fail the batch.
+    :type requeue: bool
 
     """
 
-    def __init__(self, url):
-        # type: (str) -> None
+    # Seconds between checks for the consumer being closed while draining
+    DRAIN_INTERVAL = 0.1
+
+    def __init__(
+            self,
+            url,  # type: str
+            ack_after_commit=False,  # type: bool
+            prefetch_count=None,  # type: Optional[int]
+            decoder='auto',  # type: str
+            payload_log_rate=10,  # type: int
+            requeue=True,  # type: bool
+            ):
+        # type: (...) -> None
         """Configure queue."""
+        self.payload_log = RateLimiter(payload_log_rate)
+        self.decoder, self.decode = get_decoder(decoder)
+        LOGGER.debug('Using %r JSON decoder', self.decoder)
         LOGGER.info('Connecting to %r...', url)
-        parameters = pika.URLParameters(url)
-        connection = pika.BlockingConnection(parameters)
-        channel = connection.channel()
+        self.parameters = pika.URLParameters(url)
+        self.ack_after_commit = ack_after_commit
+        self.requeue = requeue
+        self.prefetch_count = prefetch_count
+        self.acknowledgers = {}  # type: Dict[object, Acknowledger]
+        self.consuming = {}  # type: Dict[Any, Tuple[pika.BlockingConnection, threading.Event]]  # noqa
+        self.stopping = threading.Event()
+        self.closing = threading.Event()
+        # Set once running to add and remove flows from other threads
+        self.thread = None  # type: Optional[threading.Thread]
+        self.retired = set()  # type: Set[Any]
+        connection, channel = self.connect()
 
         # Use a single queue to process messages from all exchanges
         result = channel.queue_declare(auto_delete=True)
@@ -48,42 +153,440 @@ class Consumer(object):
 
         channel.basic_consume(self.message_received_cb, queue=queue_name)
 
+        self.connection = connection
         self.channel = channel
         self.queue_name = queue_name
-        self.signals = {}  # type: Dict[str, blinker.Signal]
+        self.acknowledger = self.acknowledgers.get(channel)
+        self.signals = {}  # type: Dict[Tuple[Optional[str], str, Tuple], Signal]  # noqa
+        self.routes = {}  # type: Dict[Tuple[Optional[str], str], List[Tuple[Binding, Signal]]]  # noqa
+        self.exchanges = {}  # type: Dict[str, Dict[str, Any]]
+        self.queues = set()  # type: Set[str]
+        self.exchange_fields = {}  # type: Dict[str, Optional[Set[str]]]
+        self.projections = {}  # type: Dict[str, Dict[str, Any]]
+        self.metrics = {}  # type: Dict[str, Tuple[Any, Any, Any]]
+        self.workers = []  # type: List[Tuple[str, Any]]
+        self.queue_channels = {}  # type: Dict[str, List[Any]]
+        self.queue_tags = {}  # type: Dict[str, Any]
+
+    def connect(self):
+        # type: () -> Tuple[pika.BlockingConnection, Any]
+        """Open a new connection and a channel to consume messages.
+
+        :returns: Connection and channel
+        :rtype: tuple(pika.BlockingConnection, pika.channel.Channel)
 
-    def __call__(self, exchange, **kwargs):
-        # type: (str, **str) -> blinker.Signal
+        """
+        connection = pika.BlockingConnection(self.parameters)
+        channel = connection.channel()
+        if self.prefetch_count is not None:
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+        if self.ack_after_commit:
+            self.acknowledgers[channel] = Acknowledger(
+                connection, channel, self.requeue)
+        self.consuming[channel] = (connection, threading.Event())
+        return connection, channel
+
+    def __call__(
+            self,
+            exchange,  # type: str
+            consumers=None,  # type: Optional[int]
+            fields=None,  # type: Optional[List[str]]
+            routing_keys=None,  # type: Union[str, List[str], None]
+            arguments=None,  # type: Optional[Dict[str, Any]]
+            queue=None,  # type: Optional[str]
+            **kwargs  # type: Any
+            ):
+        # type: (...) -> Signal
         """Create signal to send when a message from a exchange is received.
 
         :param exchange: Exchange name to bind to the queue
         :type exchange: str
+        :param consumers:
+            Number of dedicated connections that consume messages from a
+            dedicated queue for this exchange (or from the named queue if
+            set). If not set, messages are received through the queue shared
+            by all exchanges.
+        :type consumers: int | None
+        :param fields:
+            Dotted paths to the message fields used by the flow or None if
+            the whole messages are used
+        :type fields: list(str) | None
+        :param routing_keys:
+            Routing keys (or topic patterns) with which the queue is bound to
+            the exchange. If not set, all messages are received.
+        :type routing_keys: str | list(str) | None
+        :param arguments:
+            Binding arguments, such as the headers to match in a `headers`
+            exchange
+        :type arguments: dict(str) | None
+        :param queue:
+            Name of a durable queue whose messages are shared with any other
+            consumer of the same queue. If not set, an anonymous queue is used.
+        :type queue: str | None
         :param kwargs:
             Additional parameters to pika.channel.Channel.exchange_declare
         :type kwargs: dict(str)
         :returns: The signal that will be send, so that it can be connected
-        :rtype: :class:`blinker.Signal`
+        :rtype: :class:`rabbithole.signals.Signal`
+        :raises ValueError: If the number of consumers is lower than one
 
         """
-        if exchange in self.signals:
-            return self.signals[exchange]
+        if consumers is not None and consumers < 1:
+            raise ValueError(
+                'Unexpected number of consumers for exchange {!r}: {} '
+                '(at least one is required)'.format(exchange, consumers))
+        self.add_fields(exchange, fields)
+        binding = Binding(kwargs.get('exchange_type'), routing_keys, arguments)
+        if (queue, exchange, binding.key) in self.signals:
+            return self.signals[queue, exchange, binding.key]
+        if not self.in_connection_thread():
+            return self.call_threadsafe(partial(
+                self.__call__,
+                exchange,
+                consumers,
+                fields,
+                routing_keys,
+                arguments,
+                queue,
+                **kwargs
+            ))
 
-        self.channel.exchange_declare(exchange=exchange, **kwargs)
-        self.channel.queue_bind(exchange=exchange, queue=self.queue_name)
-        LOGGER.debug(
-            'Queue %r bound to exchange %r', self.queue_name, exchange)
+        if exchange not in self.exchanges:
+            self.channel.exchange_declare(exchange=exchange, **kwargs)
+            self.exchanges[exchange] = kwargs
+        # Deliveries are only matched against the bindings of their queue
+        route_queue = queue
+        if queue is not None:
+            queue_name = queue
+            if queue in self.queues:
+                # Already consumed by the connections of another flow
+                consumers = 0
+            else:
+                self.channel.queue_declare(queue=queue, durable=True)
+                self.queues.add(queue)
+                LOGGER.debug('Declared durable queue %r', queue)
+                if consumers is None:
+                    self.queue_tags[queue] = self.channel.basic_consume(
+                        partial(self.message_received_cb, queue=queue),
+                        queue=queue,
+                    )
+        elif consumers is None:
+            queue_name = self.queue_name
+        else:
+            result = self.channel.queue_declare(auto_delete=True)
+            queue_name = route_queue = result.method.queue
+            LOGGER.debug(
+                'Declared queue %r for exchange %r', queue_name, exchange)
+        for bind_kwargs in get_bind_kwargs(binding):
+            self.channel.queue_bind(
+                exchange=exchange, queue=queue_name, **bind_kwargs)
+            LOGGER.debug(
+                'Queue %r bound to exchange %r %s',
+                queue_name,
+                exchange,
+                bind_kwargs,
+            )
+
+        callback = self.message_received_cb
+        if route_queue is not None:
+            callback = partial(self.message_received_cb, queue=route_queue)
+        for index in range(consumers or 0):
+            _connection, channel = self.connect()
+            channel.basic_consume(callback, queue=queue_name)
+            name = '{}-{}'.format(queue or exchange, index)
+            self.workers.append((name, channel))
+            self.queue_channels.setdefault(queue_name, []).append(channel)
+            if self.thread is not None:
+                self.start_worker(name, channel)
+
+        self.add_metrics(exchange)
+        return self.add_signal(queue, exchange, binding, route_queue)
+
+    def add_signal(self, queue, exchange, binding, route_queue=None):
+        # type: (Optional[str], str, Binding, Optional[str]) -> Signal
+        """Create signal for the messages that match a binding.
 
-        signal = blinker.Signal()
-        self.signals[exchange] = signal
+        :param queue: Named queue or None for anonymous queues
+        :type queue: str | None
+        :param exchange: Exchange name
+        :type exchange: str
+        :param binding: Binding of the queue to the exchange
+        :type binding: rabbithole.routing.Binding
+        :param route_queue:
+            Queue from which the messages are consumed if it isn't the named
+            queue, such as a dedicated anonymous queue, or None for the shared
+            queue
+        :type route_queue: str | None
+        :returns: The signal that will be send, so that it can be connected
+        :rtype: :class:`rabbithole.signals.Signal`
+
+        """
+        if route_queue is None:
+            route_queue = queue
+        signal = Signal()
+        self.signals[queue, exchange, binding.key] = signal
+        self.routes.setdefault(
+            (route_queue, exchange), []).append((binding, signal))
         return signal
 
+    def remove_signal(self, signal):
+        # type: (Signal) -> None
+        """Unbind the queue for a signal that no flow uses anymore.
+
+        Dedicated connections (and the consumer of a named queue) stop
+        consuming once their queue has no bindings left.
+
+        :param signal: Signal returned when the flow was added
+        :type signal: :class:`rabbithole.signals.Signal`
+
+        """
+        if not self.in_connection_thread():
+            self.call_threadsafe(partial(self.remove_signal, signal))
+            return
+        for (queue, exchange, key), value in list(self.signals.items()):
+            if value is signal:
+                del self.signals[queue, exchange, key]
+                break
+        else:
+            return
+
+        for (route_queue, _exchange), routes in list(self.routes.items()):
+            for binding, route_signal in routes:
+                if route_signal is signal:
+                    break
+            else:
+                continue
+            routes.remove((binding, signal))
+            if not routes:
+                del self.routes[route_queue, exchange]
+            break
+
+        queue_name = self.queue_name if route_queue is None else route_queue
+        for bind_kwargs in get_bind_kwargs(binding):
+            self.channel.queue_unbind(
+                exchange=exchange, queue=queue_name, **bind_kwargs)
+            LOGGER.debug(
+                'Queue %r unbound from exchange %r %s',
+                queue_name,
+                exchange,
+                bind_kwargs,
+            )
+        if route_queue is not None and not any(
+                other_queue == route_queue for other_queue, _ in self.routes):
+            self.stop_queue(route_queue)
+
+    def stop_queue(self, queue):
+        # type: (str) -> None
+        """Stop consuming from a dedicated or named queue.
+
+        Note that this is expected to be called in the connection thread.
+
+        :param queue: Queue name
+        :type queue: str
+
+        """
+        LOGGER.debug('Stopping consuming from queue %r', queue)
+        consumer_tag = self.queue_tags.pop(queue, None)
+        if consumer_tag is not None:
+            self.channel.basic_cancel(consumer_tag)
+        for channel in self.queue_channels.pop(queue, []):
+            self.retired.add(channel)
+            connection, _stopped = self.consuming[channel]
+            connection.add_callback_threadsafe(channel.stop_consuming)
+        self.workers = [
+            (name, channel) for name, channel in self.workers
+            if channel not in self.retired
+        ]
+        self.queues.discard(queue)
+
+    def in_connection_thread(self):
+        # type: () -> bool
+        """Check if the channel can be used from the current thread.
+
+        :returns:
+            Whether the consumer isn't running yet or this is its connection
+            thread
+        :rtype: bool
+
+        """
+        return self.thread is None or self.thread is threading.current_thread()
+
+    def call_threadsafe(self, function):
+        # type: (Callable[[], Any]) -> Any
+        """Call function in the connection thread and wait for it.
+
+        :param function: Function that uses the channel
+        :type function: callable
+        :returns: Value returned by the function
+        :rtype: object
+
+        """
+        if self.stopping.is_set():
+            raise RuntimeError('Consumer is stopping')
+        future = Future()
+
+        def callback():
+            # type: () -> None
+            """Pass the outcome on to the waiting thread."""
+            try:
+                future.set_result(function())
+            except Exception as error:  # pylint:disable=broad-except
+                future.set_exception(error)
+
+        self.connection.add_callback_threadsafe(callback)
+        thread = self.thread
+        while not future.done.wait(self.DRAIN_INTERVAL):
+            if thread is not None and not thread.is_alive():
+                raise RuntimeError('Consumer connection is closed')
+        return future.result()
+
+    def add_fields(self, exchange, fields):
+        # type: (str, Optional[List[str]]) -> None
+        """Add fields to keep from the messages received from an exchange.
+
+        Messages are only projected if all the flows for the exchange set the
+        fields they use.
+
+        :param exchange: Exchange name
+        :type exchange: str
+        :param fields: Dotted paths to the fields used by a flow
+        :type fields: list(str) | None
+
+        """
+        if exchange in self.exchange_fields:
+            exchange_fields = self.exchange_fields[exchange]
+        else:
+            exchange_fields = set()
+        if fields is None or exchange_fields is None:
+            self.exchange_fields[exchange] = None
+            self.projections.pop(exchange, None)
+            return
+
+        exchange_fields.update(fields)
+        self.exchange_fields[exchange] = exchange_fields
+        self.projections[exchange] = compile_projection(exchange_fields)
+
+    def add_metrics(self, exchange):
+        # type: (str) -> Tuple[Any, Any, Any]
+        """Get the metrics updated for every message received from an exchange.
+
+        :param exchange: Exchange name
+        :type exchange: str
+        :returns: Received messages, decode time and decode errors metrics
+        :rtype: tuple
+
+        """
+        metrics = (
+            MESSAGES_RECEIVED.labels(exchange),
+            DECODE_SECONDS.labels(exchange),
+            DECODE_ERRORS.labels(exchange),
+        )
+        self.metrics[exchange] = metrics
+        return metrics
+
     def run(self):
         # type: () -> None
-        """Run ioloop and consume messages."""
+        """Run ioloop and consume messages.
+
+        Dedicated connections consume messages in their own threads.
+
+        """
+        self.thread = threading.current_thread()
+        for name, channel in self.workers:
+            self.start_worker(name, channel)
+
         logging.info('Waiting for messages...')
-        self.channel.start_consuming()
+        self.consume(self.channel)
+
+    def start_worker(self, name, channel):
+        # type: (str, Any) -> None
+        """Consume messages from a dedicated connection in its own thread.
+
+        :param name: Thread name
+        :type name: str
+        :param channel: Channel to consume messages from
+        :type channel: pika.channel.Channel
+
+        """
+        thread = threading.Thread(
+            name=name, target=self.consume, args=(channel, ))
+        thread.daemon = True
+        thread.start()
+
+    def consume(self, channel):
+        # type: (Any) -> None
+        """Consume messages from a channel until the consumer is stopped.
+
+        Once consuming has been stopped, the connection keeps processing
+        events, so that messages are still acknowledged as their batches are
+        written, until the consumer is closed (or, for the connections of a
+        queue that isn't bound anymore, until their messages are settled).
+
+        :param channel: Channel to consume messages from
+        :type channel: pika.channel.Channel
+
+        """
+        connection, stopped = self.consuming[channel]
+        channel.start_consuming()
+        stopped.set()
+        retired = channel in self.retired
+        if not self.stopping.is_set() and not retired:
+            return
+
+        acknowledger = self.acknowledgers.get(channel)
+        while not self.closing.is_set():
+            if retired and (acknowledger is None or not acknowledger.pending):
+                break
+            connection.process_data_events(time_limit=self.DRAIN_INTERVAL)
+        # Send acknowledgements scheduled right before closing
+        connection.process_data_events(time_limit=0)
+        LOGGER.debug('Closing connection...')
+        connection.close()
+        if retired:
+            self.consuming.pop(channel, None)
+
+    def stop(self, timeout=None):
+        # type: (Optional[float]) -> None
+        """Stop consuming messages.
+
+        Messages that the server has already delivered are passed on before
+        consuming stops. Those that haven't been acknowledged yet are
+        delivered again once the connection is closed.
+
+        :param timeout: Maximum number of seconds to wait for every channel
+        :type timeout: float | None
+
+        """
+        LOGGER.info('Stopping consumer...')
+        self.stopping.set()
+        consuming = list(self.consuming.items())
+        for channel, (connection, _stopped) in consuming:
+            connection.add_callback_threadsafe(channel.stop_consuming)
+        for _channel, (_connection, stopped) in consuming:
+            if not stopped.wait(timeout):
+                LOGGER.warning('Timeout while waiting for consumer to stop')
+
+    def close(self, timeout=None):
+        # type: (Optional[float]) -> None
+        """Close connections once pending acknowledgements have been sent.
+
+        :param timeout:
+            Maximum number of seconds to wait for the messages being written
+            to be settled
+        :type timeout: float | None
+
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        for acknowledger in list(self.acknowledgers.values()):
+            if not acknowledger.wait(
+                    None if deadline is None
+                    else max(0, deadline - monotonic())):
+                LOGGER.warning(
+                    'Timeout while waiting for messages to be settled')
+        self.closing.set()
 
-    def message_received_cb(self, channel, method_frame, header_frame, body):
+    def message_received_cb(
+            self, channel, method_frame, header_frame, body, queue=None):
         """Handle message received.
 
         :param channel: Connection channel with AMQP server
@@ -93,26 +596,272 @@ class Consumer(object):
         :param header_frame: AMQP message related data
         :type header_frame: pika.spec.BasicProperties
         :param body: Message body
-        :type body: str
+        :type body: bytes
+        :param queue: Queue the message was consumed from or None if shared
+        :type queue: str | None
 
         """
         exchange_name = method_frame.exchange
+        metrics = self.metrics.get(exchange_name)
+        if metrics is None:
+            metrics = self.add_metrics(exchange_name)
+        received, decode_seconds, decode_errors = metrics
+        received.inc()
 
         if header_frame.content_type != 'application/json':
             LOGGER.warning(
                 'Unexpected content type: %r', header_frame.content_type)
 
+        start = perf_counter()
         try:
-            payload = json.loads(body)
+            payload = self.decode(body)
         except ValueError:
+            decode_errors.inc()
             LOGGER.warning('Body decoding error: %r', body)
             channel.basic_nack(method_frame.delivery_tag, requeue=False)
         else:
-            LOGGER.debug(
-                'Message received from %r:\n%s',
-                exchange_name,
-                pformat(payload),
-            )
-            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
-            signal = self.signals[exchange_name]
-            signal.send(self, payload=payload)
+            decode_seconds.observe(perf_counter() - start)
+            projection = self.projections.get(exchange_name)
+            if projection is not None:
+                payload = project(payload, projection)
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                self.log_payload(exchange_name, payload)
+            signals = self.get_signals(
+                queue, exchange_name, method_frame, header_frame)
+            acknowledger = self.acknowledgers.get(channel, self.acknowledger)
+            if acknowledger is None:
+                channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+                for signal in signals:
+                    signal.send(self, payload=payload, size=len(body))
+            else:
+                # Every receiver settles the message separately, so they're
+                # listed first in case flows are reloaded meanwhile
+                receivers = [
+                    receiver
+                    for signal in signals
+                    for receiver in signal.get_receivers(self)
+                ]
+                acknowledger.track(method_frame.delivery_tag, len(receivers))
+                if not receivers:
+                    # No flow will write the message
+                    acknowledger.settle([method_frame.delivery_tag], True)
+                for receiver in receivers:
+                    receiver(
+                        self,
+                        payload=payload,
+                        size=len(body),
+                        delivery_tag=method_frame.delivery_tag,
+                        acknowledger=acknowledger,
+                    )
+
+    def get_signals(self, queue, exchange_name, method_frame, header_frame):
+        # type: (Optional[str], str, Any, Any) -> List[Signal]
+        """Get the signals of the bindings that a message matches.
+
+        :param queue: Queue the message was consumed from or None if shared
+        :type queue: str | None
+        :param exchange_name: Exchange from which the message was received
+        :type exchange_name: str
+        :param method_frame: AMQP method related data
+        :type method_frame: pika.spec.Deliver
+        :param header_frame: AMQP message related data
+        :type header_frame: pika.spec.BasicProperties
+        :returns: Signals through which the message has to be sent
+        :rtype: list(rabbithole.signals.Signal)
+
+        """
+        # Messages in different queues are different copies
+        routes = self.routes.get((queue, exchange_name), [])
+        if len(routes) == 1 and routes[0][0].match_all:
+            return [routes[0][1]]
+        return [
+            signal for binding, signal in routes
+            if binding.matches(method_frame.routing_key, header_frame.headers)
+        ]
+
+    def log_payload(self, exchange_name, payload):
+        # type: (str, object) -> None
+        """Log message payload unless the rate limit has been reached.
+
+        :param exchange_name: Exchange from which the message was received
+        :type exchange_name: str
+        :param payload: Decoded message
+        :type payload: object
+
+        """
+        suppressed = self.payload_log.allow()
+        if suppressed is None:
+            return
+        LOGGER.debug(
+            'Message received from %r (%d messages not logged):\n%s',
+            exchange_name,
+            suppressed,
+            pformat(payload),
+        )
+
+
+class Acknowledger(object):
+
+    """Acknowledge messages once they have been written to the output.
+
+    Delivery tags are tracked as messages are received. When the outcome for a
+    set of messages is known, all the messages that have been settled without
+    any gap since the last acknowledgement are acknowledged at once using a
+    single `basic_ack` with `multiple=True`. Messages that couldn't be written
+    are rejected individually.
+
+    Since channels aren't thread safe, the actual acknowledgements are always
+    scheduled to run in the connection thread.
+
+    :param connection: Connection with the AMQP server
+    :type connection: pika.BlockingConnection
+    :param channel: Channel in which messages were received
+    :type channel: pika.channel.Channel
+    :param requeue: Whether rejected messages should be requeued
+    :type requeue: bool
+
+    """
+
+    def __init__(self, connection, channel, requeue=True):
+        # type: (pika.BlockingConnection, Any, bool) -> None
+        """Initialize internal data structures."""
+        self.connection = connection
+        self.channel = channel
+        self.requeue = requeue
+
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = []  # type: List[int]
+        self.settled = {}  # type: Dict[int, bool]
+        self.expected = {}  # type: Dict[int, Tuple[int, bool]]
+
+    def track(self, delivery_tag, receivers=1):
+        # type: (int, int) -> None
+        """Keep track of a message whose outcome isn't known yet.
+
+        :param delivery_tag: Message delivery tag
+        :type delivery_tag: int
+        :param receivers:
+            Number of receivers that will settle the message, which is only
+            settled once all of them have done it
+        :type receivers: int
+
+        """
+        with self.lock:
+            self.pending.append(delivery_tag)
+            if receivers > 1:
+                self.expected[delivery_tag] = (receivers, True)
+
+    def settle(self, delivery_tags, success):
+        # type: (Iterable[int], bool) -> None
+        """Acknowledge or reject messages depending on the output outcome.
+
+        :param delivery_tags: Delivery tags for the messages in a batch
+        :type delivery_tags: list(int)
+        :param success: Whether the batch was successfully written
+        :type success: bool
+
+        """
+        with self.lock:
+            rejected = []  # type: List[int]
+            for delivery_tag in delivery_tags:
+                tag_success = success
+                if delivery_tag in self.expected:
+                    receivers, previous = self.expected.pop(delivery_tag)
+                    tag_success = previous and success
+                    if receivers > 1:
+                        # Wait for the rest of receivers
+                        self.expected[delivery_tag] = (
+                            receivers - 1, tag_success)
+                        continue
+                self.settled[delivery_tag] = tag_success
+                if not tag_success:
+                    rejected.append(delivery_tag)
+
+            # Acknowledge the longest prefix of settled messages
+            ack_tag = None
+            index = 0
+            for index, delivery_tag in enumerate(self.pending):
+                if delivery_tag not in self.settled:
+                    break
+                if self.settled.pop(delivery_tag):
+                    ack_tag = delivery_tag
+            else:
+                index = len(self.pending)
+            del self.pending[:index]
+            if not self.pending:
+                self.idle.notify_all()
+
+            # Schedule while holding the lock to preserve ordering
+            if rejected:
+                self.connection.add_callback_threadsafe(
+                    partial(self._reject, rejected))
+            if ack_tag is not None:
+                self.connection.add_callback_threadsafe(
+                    partial(self._ack, ack_tag))
+
+    def wait(self, timeout=None):
+        # type: (Optional[float]) -> bool
+        """Wait until every message received has been settled.
+
+        :param timeout: Maximum number of seconds to wait
+        :type timeout: float | None
+        :returns: Whether all the messages were settled in time
+        :rtype: bool
+
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.idle:
+            while self.pending:
+                if deadline is None:
+                    self.idle.wait()
+                    continue
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+    def _ack(self, delivery_tag):
+        # type: (int) -> None
+        """Acknowledge all messages up to a delivery tag.
+
+        :param delivery_tag: Last delivery tag to acknowledge
+        :type delivery_tag: int
+
+        """
+        LOGGER.debug('Acknowledging messages up to %d', delivery_tag)
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+
+    def _reject(self, delivery_tags):
+        # type: (List[int]) -> None
+        """Reject messages that couldn't be written to the output.
+
+        :param delivery_tags: Delivery tags to reject
+        :type delivery_tags: list(int)
+
+        """
+        LOGGER.debug('Rejecting %d messages', len(delivery_tags))
+        for delivery_tag in delivery_tags:
+            self.channel.basic_nack(delivery_tag, requeue=self.requeue)
+
+
+def get_bind_kwargs(binding):
+    # type: (Binding) -> List[Dict[str, Any]]
+    """Get the arguments to bind a queue to an exchange for a binding.
+
+    :param binding: Binding of the queue to the exchange
+    :type binding: rabbithole.routing.Binding
+    :returns: Keyword arguments for each pika.channel.Channel.queue_bind call
+    :rtype: list(dict(str))
+
+    """
+    kwargs = {}  # type: Dict[str, Any]
+    if binding.arguments:
+        kwargs['arguments'] = binding.arguments
+    if not binding.routing_keys:
+        return [kwargs]
+    return [
+        dict(kwargs, routing_key=routing_key)
+        for routing_key in binding.routing_keys
+    ]
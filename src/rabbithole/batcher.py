@@ -4,22 +4,56 @@
 
 The strategy to batch messages is:
     - store them in memory as they are received
-    - send them to the output when either the size or the time limit is
-      exceeded.
+    - send them to the output when either the size (in messages or bytes) or
+      the time limit is exceeded.
+
+Time limits for all batchers are handled by a shared scheduler thread.
+
+Optionally, the limits can be adjusted after every batch is written to the
+write latency and the message rate (see :mod:`rabbithole.adaptive`).
+
+When messages are received with a delivery tag, the tags are kept along with
+the batch and the messages are acknowledged or rejected once the output has
+processed the batch. Batches that no output receives are rejected, so that
+their messages are delivered again.
+
+When flows are reloaded, a batcher can be paused while its output is
+replaced, so that messages are held in the batch until it's resumed, and
+closed once no flow uses it anymore (see :class:`rabbithole.cli.RunningFlows`).
+Messages received by a closed batcher are rejected right away.
 
 """
 
 import logging
 import threading
 
-import blinker
+from collections import defaultdict
+from functools import partial
+
+import six
 
 from typing import (  # noqa
+    Any,
+    Callable,
     Dict,
     List,
     Optional,
+    Tuple,
 )
 
+from rabbithole.adaptive import AimdPolicy
+from rabbithole.metrics import (
+    BATCH_FLUSHES,
+    BATCH_SIZE,
+)
+from rabbithole.scheduler import (  # noqa
+    ScheduledCall,
+    Scheduler,
+    get_default_scheduler,
+    monotonic,
+)
+from rabbithole.signals import Signal
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -33,26 +67,79 @@ class Batcher(object):
     :param size_limit: Capacity of the batcher in number of messages
     :type size_limit: int
     :param time_limit: Time before sending batch to the output in seconds
-    :type time_limit: int
+    :type time_limit: float
+    :param scheduler:
+        Scheduler used to handle the time limit (the one shared by all
+        batchers by default)
+    :type scheduler: rabbithole.scheduler.Scheduler | None
+    :param name: Name of the flow used to label the batcher metrics
+    :type name: str | None
+    :param bytes_limit:
+        Capacity of the batcher in bytes of the raw messages (no limit by
+        default). Batches are sent before a message would exceed it.
+    :type bytes_limit: int | None
+    :param adaptive:
+        Parameters of the :class:`rabbithole.adaptive.AimdPolicy` used to
+        adjust the limits after every batch is written. If set, the size and
+        time limits are only the initial ones.
+    :type adaptive: dict(str) | None
 
     """
 
     DEFAULT_SIZE_LIMIT = 5
     DEFAULT_TIME_LIMIT = 15
 
-    def __init__(self, size_limit=None, time_limit=None):
-        # type: (int, int) -> None
+    def __init__(
+            self,
+            size_limit=None,  # type: Optional[int]
+            time_limit=None,  # type: Optional[float]
+            scheduler=None,  # type: Optional[Scheduler]
+            name=None,  # type: Optional[str]
+            bytes_limit=None,  # type: Optional[int]
+            adaptive=None,  # type: Optional[Dict[str, Any]]
+            ):
+        # type: (...) -> None
         """Initialize internal data structures."""
         self.size_limit = size_limit or self.DEFAULT_SIZE_LIMIT
         self.time_limit = time_limit or self.DEFAULT_TIME_LIMIT
+        self.bytes_limit = bytes_limit
+        self.scheduler = scheduler or get_default_scheduler()
+        self.policy = None  # type: Optional[AimdPolicy]
+        if adaptive is not None:
+            self.policy = policy = AimdPolicy(**adaptive)
+            if size_limit is not None:
+                policy.size_limit = max(
+                    policy.min_size, min(policy.max_size, size_limit))
+            self.size_limit = policy.size_limit
+            self.time_limit = min(
+                time_limit or policy.time_limit, policy.target_latency)
+        self.clock = monotonic
+        self.batch_started = 0.0
+        self.name = name or ''
+        self.batch_size = BATCH_SIZE.labels(self.name)
+        self.flushes = {
+            reason: BATCH_FLUSHES.labels(self.name, reason)
+            for reason in ('size', 'bytes', 'time', 'queued')
+        }
 
         self.batch = []  # type: List[Dict[str, object]]
+        self.batch_bytes = 0
+        self.deliveries = []  # type: List[Tuple[Any, int]]
         self.lock = threading.Lock()
-        self.timer = None  # type: Optional[threading.Timer]
-        self.batch_ready = blinker.Signal()
-
-    def message_received_cb(self, sender, payload):
-        # type: (object, Dict[str, object]) -> None
+        self.timer = None  # type: Optional[ScheduledCall]
+        self.batch_ready = Signal()
+        self.closed = False
+        self.paused = False
+
+    def message_received_cb(
+            self,
+            sender,  # type: object
+            payload,  # type: Dict[str, object]
+            delivery_tag=None,  # type: Optional[int]
+            acknowledger=None,  # type: Any
+            size=None,  # type: Optional[int]
+            ):
+        # type: (...) -> None
         """Handle message received event.
 
         This callback is executed when message is received by the AMQP
@@ -62,11 +149,45 @@ class Batcher(object):
         :type sender: object
         :param payload: Record to send to the output
         :type payload: dict(str)
+        :param delivery_tag: Tag to acknowledge the message after writing it
+        :type delivery_tag: int | None
+        :param acknowledger: Object used to settle the message
+        :type acknowledger: rabbithole.amqp.Acknowledger | None
+        :param size: Size of the raw message in bytes
+        :type size: int | None
 
         """
+        ready = []  # type: List[Tuple[List[Dict[str, object]], List[Tuple[Any, int]], str]]  # noqa
+        size = size or 0
+
         # Use a lock to make sure that callback execution doesn't interleave
         with self.lock:
+            if self.closed:
+                LOGGER.debug('[%x] Message received after closing', id(self))
+                if acknowledger is not None and delivery_tag is not None:
+                    acknowledger.settle([delivery_tag], False)
+                return
+            if (not self.paused and
+                    self.bytes_limit is not None and self.batch and
+                    self.batch_bytes + size > self.bytes_limit):
+                # Send the batch before the message makes it too large
+                LOGGER.debug(
+                    '[%x] Bytes limit (%d) exceeded',
+                    id(self),
+                    self.bytes_limit,
+                )
+                ready.append(self.take_batch() + ('bytes', ))
+                if self.timer is not None:
+                    self.cancel_timer()
+
             self.batch.append(payload)
+            self.batch_bytes += size
+            if len(self.batch) == 1:
+                # Set even if the batch is sent right away to measure its
+                # fill time
+                self.batch_started = self.clock()
+            if acknowledger is not None and delivery_tag is not None:
+                self.deliveries.append((acknowledger, delivery_tag))
             LOGGER.debug(
                 '[%x] Message added to batch (size: %d, capacity: %d)',
                 id(self),
@@ -74,23 +195,38 @@ class Batcher(object):
                 self.size_limit,
             )
 
-            if len(self.batch) == 1:
-                self.start_timer()
+            if self.paused:
+                # Sent once resumed
+                pass
             elif len(self.batch) >= self.size_limit:
                 LOGGER.debug(
                     '[%x] Size limit (%d) exceeded',
                     id(self),
                     self.size_limit,
                 )
-                self.queue_batch()
-                self.cancel_timer()
+                ready.append(self.take_batch() + ('size', ))
+                if self.timer is not None:
+                    self.cancel_timer()
+            elif (self.bytes_limit is not None and
+                    self.batch_bytes >= self.bytes_limit):
+                # Batch is full or message is larger than the limit on its own
+                ready.append(self.take_batch() + ('bytes', ))
+                if self.timer is not None:
+                    self.cancel_timer()
+            elif len(self.batch) == 1:
+                self.start_timer()
+
+        # Send batches without holding the lock,
+        # so that new messages can be added meanwhile
+        for batch, deliveries, reason in ready:
+            self.send_batch(batch, deliveries, reason)
 
     def time_expired_cb(self):
         # type: () -> None
         """Handle time expired event.
 
-        This callback is executed in a timer thread when the time limit for a
-        batch of messages has been exceeded.
+        This callback is executed in the scheduler thread when the time limit
+        for a batch of messages has been exceeded.
 
         """
         # Use a lock to make sure that callback execution doesn't interleave
@@ -103,55 +239,176 @@ class Batcher(object):
             if self.timer is None:
                 LOGGER.warning('[%x] Timer is not active', id(self))
                 return
-            self.queue_batch()
             self.timer = None
+            if self.paused:
+                return
+            batch, deliveries = self.take_batch()
 
-        LOGGER.debug('[%x] Timer thread finished', id(self))
+        self.send_batch(batch, deliveries, 'time')
+        LOGGER.debug('[%x] Timer finished', id(self))
 
     def queue_batch(self):
         # type: () -> None
         """Queue batch before sending to the output.
 
         A batch is queued either by the main thread when the size limit is
-        exceeded or by a timer thread when the time limit is exceeded.
+        exceeded or by the scheduler thread when the time limit is exceeded.
 
-        :param exchange_name: Exchange from which message batch was received
-        :type exchange_name: str
+        """
+        with self.lock:
+            batch, deliveries = self.take_batch()
+        self.send_batch(batch, deliveries, 'queued')
+
+    def flush(self):
+        # type: () -> None
+        """Send pending messages to the output before shutting down.
+
+        The timer is cancelled so that it doesn't fire once the output has
+        been closed. Nothing is sent if the batch is empty.
+
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.cancel_timer()
+            batch, deliveries = self.take_batch()
+        if batch:
+            LOGGER.debug('[%x] Flushing %d messages', id(self), len(batch))
+            self.send_batch(batch, deliveries, 'queued')
+
+    def pause(self):
+        # type: () -> None
+        """Hold messages in the batch, regardless of the limits, until resumed.
+
+        Used to replace the output without any batch being sent to both the
+        old and the new one. Messages are still received meanwhile, so that
+        the input isn't blocked. Note that the batch is still sent when
+        flushed.
+
+        """
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        # type: () -> None
+        """Send the messages held while paused and apply the limits again."""
+        with self.lock:
+            self.paused = False
+        self.flush()
+
+    def close(self):
+        # type: () -> None
+        """Send pending messages and reject the ones received afterwards.
+
+        Used when no flow uses the batcher anymore. The batcher should be
+        disconnected from its input signal first.
+
+        """
+        with self.lock:
+            self.closed = True
+        self.flush()
+
+    def take_batch(self):
+        # type: () -> Tuple[List[Dict[str, object]], List[Tuple[Any, int]]]
+        """Take current batch and start a new one.
+
+        Note that the lock is expected to be held by the caller.
+
+        :returns: Messages in the batch and their deliveries
+        :rtype: tuple(list(dict(str)), list)
+
+        """
+        batch, deliveries = self.batch, self.deliveries
+        self.batch = []
+        self.deliveries = []
+        self.batch_bytes = 0
+        return batch, deliveries
+
+    def send_batch(self, batch, deliveries, reason):
+        # type: (List[Dict[str, object]], List[Tuple[Any, int]], str) -> None
+        """Send batch to the output.
+
+        :param batch: Messages in the batch
+        :type batch: list(dict(str))
+        :param deliveries: Pairs of acknowledger and delivery tag
+        :type deliveries: list((rabbithole.amqp.Acknowledger, int))
+        :param reason:
+            Why the batch is sent (`size`, `bytes` or `time` limit exceeded
+            or `queued` explicitly)
+        :type reason: str
 
         """
-        if not self.batch:
+        if not batch:
             LOGGER.warning('[%x] Nothing to queue', id(self))
             return
-        self.batch_ready.send(self, batch=self.batch)
-        self.batch = []
+        self.batch_size.observe(len(batch))
+        self.flushes[reason].inc()
+        sent = self.clock()
+        results = [
+            result for _, result in self.batch_ready.send(self, batch=batch)
+        ]
+        if not results:
+            LOGGER.warning('[%x] No output for the batch', id(self))
+            results = [False]
+        if deliveries:
+            settle_when_done(deliveries, results)
+        if self.policy is not None:
+            call_when_done(results, partial(
+                self.batch_written_cb,
+                len(batch),
+                reason,
+                sent - self.batch_started,
+                sent,
+            ))
+
+    def batch_written_cb(self, size, reason, fill_time, sent, success):
+        # type: (int, str, float, float, bool) -> None
+        """Adjust limits once a batch has been written.
+
+        :param size: Number of messages in the batch
+        :type size: int
+        :param reason: Why the batch was sent
+        :type reason: str
+        :param fill_time: Time from the first message to the batch being sent
+        :type fill_time: float
+        :param sent: Time at which the batch was sent
+        :type sent: float
+        :param success: Whether the batch was written
+        :type success: bool
+
+        """
+        if self.policy is None:
+            return
+        size_limit, time_limit = self.policy.batch_written(
+            size, reason, fill_time, self.clock() - sent, success)
+        with self.lock:
+            self.size_limit = size_limit
+            self.time_limit = time_limit
 
     def start_timer(self):
         # type: () -> None
-        """Start timer thread.
+        """Start timer.
 
-        A timer thread is started to make sure that the batch will be sent to
-        the output if the time limit is exceeded before the size limit.
+        A timer is scheduled to make sure that the batch will be sent to the
+        output if the time limit is exceeded before the size limit.
 
         """
         if self.timer:
             LOGGER.warning('[%x] Timer already active', id(self))
             return
-        timer = threading.Timer(self.time_limit, self.time_expired_cb)
-        timer.daemon = True
-        timer.start()
+        self.timer = self.scheduler.schedule(
+            self.time_limit, self.time_expired_cb)
         LOGGER.debug(
-            '[%x] Timer thread started (%.2f)',
+            '[%x] Timer started (%.2f)',
             id(self),
             self.time_limit,
         )
-        self.timer = timer
 
     def cancel_timer(self):
         # type: () -> None
-        """Cancel timer thread.
+        """Cancel timer.
 
-        A timer thread might be cancelled if the size limit for a batch is
-        exceeded before the time limit.
+        A timer might be cancelled if the size limit for a batch is exceeded
+        before the time limit.
 
         :param exchange_name: Exchange from which message batch was received
         :type exchange_name: str
@@ -161,5 +418,85 @@ class Batcher(object):
             LOGGER.warning('[%x] Timer is not active', id(self))
             return
         self.timer.cancel()
-        LOGGER.debug('[%x] Timer thread cancelled', id(self))
+        LOGGER.debug('[%x] Timer cancelled', id(self))
         self.timer = None
+
+
+def settle_deliveries(deliveries, success):
+    # type: (List[Tuple[Any, int]], bool) -> None
+    """Acknowledge or reject the messages in a batch.
+
+    :param deliveries: Pairs of acknowledger and delivery tag
+    :type deliveries: list((rabbithole.amqp.Acknowledger, int))
+    :param success: Whether the batch was successfully written
+    :type success: bool
+
+    """
+    delivery_tags = defaultdict(list)  # type: Dict[Any, List[int]]
+    for acknowledger, delivery_tag in deliveries:
+        delivery_tags[acknowledger].append(delivery_tag)
+    for acknowledger, tags in six.iteritems(delivery_tags):
+        acknowledger.settle(tags, success)
+
+
+def settle_when_done(deliveries, results):
+    # type: (List[Tuple[Any, int]], List[Any]) -> None
+    """Settle messages in a batch once the output has processed it.
+
+    Receivers return False when the batch couldn't be written. They might also
+    return a future when the batch is written asynchronously, in which case
+    messages are settled when all the futures are done.
+
+    :param deliveries: Pairs of acknowledger and delivery tag
+    :type deliveries: list((rabbithole.amqp.Acknowledger, int))
+    :param results: Values returned by the batch ready signal receivers
+    :type results: list
+
+    """
+    call_when_done(results, partial(settle_deliveries, deliveries))
+
+
+def call_when_done(results, callback):
+    # type: (List[Any], Callable[[bool], None]) -> None
+    """Call function once the output has processed a batch.
+
+    :param results: Values returned by the batch ready signal receivers
+    :type results: list
+    :param callback:
+        Function called with whether the batch was written once all the
+        futures in the results, if any, are done
+    :type callback: callable
+
+    """
+    futures = [
+        result for result in results
+        if hasattr(result, 'add_done_callback')
+    ]
+    success = all(result is not False for result in results)
+    if not futures:
+        callback(success)
+        return
+
+    state = {
+        'pending': len(futures),
+        'success': success,
+    }  # type: Dict[str, Any]
+    lock = threading.Lock()
+
+    def future_done_cb(future):
+        # type: (Any) -> None
+        """Settle messages when the last future is done."""
+        future_success = (
+            not future.cancelled() and
+            future.exception() is None and
+            future.result() is not False
+        )
+        with lock:
+            state['success'] = state['success'] and future_success
+            state['pending'] -= 1
+            if state['pending']:
+                return
+        callback(state['success'])
+
+    for future in futures:
+        future.add_done_callback(future_done_cb)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+"""Bulk: write batches using multi-row INSERT statements.
+
+The strategy to write a batch is:
+    - rewrite the single row INSERT template into a statement with multiple
+      rows in its VALUES clause
+    - split the batch in chunks so that the number of bound parameters in
+      each statement doesn't exceed the limit for the database dialect, and
+      the rows left in chunks whose size is a power of two
+    - execute one statement per chunk
+
+This way, only the statements for a full chunk and for a few smaller ones are
+ever compiled for each dialect, whatever the batch sizes are.
+
+Dialect specific bulk paths can be plugged in through
+:data:`BULK_INSERT_STRATEGIES`.
+
+"""
+
+import re
+
+from sqlalchemy import text
+from typing import (  # noqa
+    Any,
+    Callable,
+    Dict,
+    List,
+    Tuple,
+    Union,
+)
+
+#: Maximum number of bound parameters per statement
+PARAMETER_LIMITS = {
+    'mssql': 2100,
+    'mysql': 65535,
+    'oracle': 65535,
+    'postgresql': 32767,
+}
+
+#: Limit used for dialects not found in :data:`PARAMETER_LIMITS`
+DEFAULT_PARAMETER_LIMIT = 999
+
+#: Maximum number of rows per statement
+MAX_ROWS = 1000
+
+BIND_PARAMETER = re.compile(r'(?<![:\w\\]):(\w+)')
+VALUES_KEYWORD = re.compile(r'\bVALUES\s*\(', re.IGNORECASE)
+
+
+def get_parameter_limit(dialect):
+    # type: (Any) -> int
+    """Get maximum number of bound parameters per statement.
+
+    :param dialect: Database dialect
+    :type dialect: sqlalchemy.engine.interfaces.Dialect
+    :returns: Maximum number of bound parameters
+    :rtype: int
+
+    """
+    if dialect.name == 'sqlite':
+        # Limit was raised in SQLite 3.32.0
+        version = getattr(dialect.dbapi, 'sqlite_version_info', (0, 0, 0))
+        return 32766 if version >= (3, 32, 0) else 999
+    return PARAMETER_LIMITS.get(dialect.name, DEFAULT_PARAMETER_LIMIT)
+
+
+class MultiRowInsert(object):
+
+    """INSERT statement rewritten to insert multiple rows at once.
+
+    :param query:
+        INSERT query for a single row with named parameters in its VALUES
+        clause (for example, `INSERT INTO t (a, b) VALUES (:a, :b)`)
+    :type query: str
+
+    """
+
+    def __init__(self, query):
+        # type: (str) -> None
+        """Parse query template."""
+        match = VALUES_KEYWORD.search(query)
+        if match is None:
+            raise ValueError('VALUES clause not found: {}'.format(query))
+        start = match.end()
+        end = find_closing_parenthesis(query, start)
+
+        self.query = query
+        self.head = query[:start - 1]
+        self.row = query[start - 1:end + 1]
+        self.tail = query[end + 1:]
+        self.names = []  # type: List[str]
+        for name in BIND_PARAMETER.findall(self.row):
+            if name not in self.names:
+                self.names.append(name)
+        if not self.names:
+            raise ValueError(
+                'No parameters found in VALUES clause: {}'.format(query))
+        self.statements = {}  # type: Dict[Tuple[int, Any], Any]
+
+    def __str__(self):
+        # type: () -> str
+        """Return original query."""
+        return self.query
+
+    def statement(self, rows, dialect=None):
+        # type: (int, Any) -> Any
+        """Get statement to insert a given number of rows.
+
+        When a dialect is passed, the compiled statement is returned instead,
+        so that a statement with thousands of parameters isn't compiled again
+        for every chunk. Only the statements for full chunks and for powers of
+        two rows are cached (see :func:`get_chunk_sizes`), so that the cache
+        doesn't grow with every batch size.
+
+        :param rows: Number of rows
+        :type rows: int
+        :param dialect: Database dialect
+        :type dialect: sqlalchemy.engine.interfaces.Dialect | None
+        :returns: Statement with one VALUES tuple per row
+        :rtype:
+            sqlalchemy.sql.elements.TextClause |
+            sqlalchemy.sql.compiler.Compiled
+
+        """
+        key = (rows, dialect)
+        statement = self.statements.get(key)
+        if statement is None:
+            if dialect is None:
+                values = ', '.join(
+                    BIND_PARAMETER.sub(
+                        r':\g<1>_{}'.format(index), self.row)
+                    for index in range(rows)
+                )
+                statement = text(self.head + values + self.tail)
+            else:
+                statement = self.statement(rows).compile(dialect=dialect)
+            if rows & (rows - 1) == 0 or (
+                    dialect is not None and rows == self.chunk_size(dialect)):
+                self.statements[key] = statement
+        return statement
+
+    def chunk_size(self, dialect):
+        # type: (Any) -> int
+        """Get number of rows per statement for a dialect.
+
+        :param dialect: Database dialect
+        :type dialect: sqlalchemy.engine.interfaces.Dialect
+        :returns: Number of rows
+        :rtype: int
+
+        """
+        rows = get_parameter_limit(dialect) // len(self.names)
+        return max(1, min(rows, MAX_ROWS))
+
+    def parameters(self, rows):
+        # type: (List[Union[Dict[str, Any], List[Any]]]) -> Dict[str, Any]
+        """Get parameters for a statement that inserts multiple rows.
+
+        :param rows:
+            Parameters for each row either as a dictionary or as a list with
+            values in the same order in which parameters appear in the query
+        :type rows: list(dict(str) | list)
+        :returns: Parameters for the statement
+        :rtype: dict(str)
+
+        """
+        parameters = {}  # type: Dict[str, Any]
+        names = self.names
+        for index, row in enumerate(rows):
+            suffix = '_{}'.format(index)
+            if isinstance(row, dict):
+                for name in names:
+                    parameters[name + suffix] = row.get(name)
+            else:
+                for name, value in zip(names, row):
+                    parameters[name + suffix] = value
+        return parameters
+
+    def execute(self, connection, rows):
+        # type: (Any, List[Union[Dict[str, Any], List[Any]]]) -> None
+        """Insert rows using the strategy for the connection dialect.
+
+        :param connection: Database connection
+        :type connection: sqlalchemy.engine.Connection
+        :param rows: Parameters for each row
+        :type rows: list(dict(str) | list)
+
+        """
+        strategy = BULK_INSERT_STRATEGIES.get(
+            connection.dialect.name, execute_multirow)
+        strategy(connection, self, rows)
+
+
+def execute_multirow(connection, insert, rows):
+    # type: (Any, MultiRowInsert, List) -> None
+    """Insert rows in chunks using multi-row INSERT statements.
+
+    :param connection: Database connection
+    :type connection: sqlalchemy.engine.Connection
+    :param insert: Multi-row INSERT statement
+    :type insert: MultiRowInsert
+    :param rows: Parameters for each row
+    :type rows: list(dict(str) | list)
+
+    """
+    start = 0
+    for size in get_chunk_sizes(
+            len(rows), insert.chunk_size(connection.dialect)):
+        chunk = rows[start:start + size]
+        start += size
+        connection.execute(
+            insert.statement(size, connection.dialect),
+            insert.parameters(chunk),
+        )
+
+
+def get_chunk_sizes(rows, chunk_size):
+    # type: (int, int) -> List[int]
+    """Get the number of rows inserted by each statement.
+
+    Rows are inserted in full chunks and the ones left in chunks whose size is
+    a power of two (for example, 25 rows with a chunk size of 10 are inserted
+    in chunks of 10, 10, 4 and 1 rows).
+
+    :param rows: Number of rows
+    :type rows: int
+    :param chunk_size: Maximum number of rows per statement
+    :type chunk_size: int
+    :returns: Number of rows per statement
+    :rtype: list(int)
+
+    """
+    sizes = [chunk_size] * (rows // chunk_size)
+    left = rows % chunk_size
+    while left:
+        size = 1 << (left.bit_length() - 1)
+        sizes.append(size)
+        left -= size
+    return sizes
+
+
+def find_closing_parenthesis(query, start):
+    # type: (str, int) -> int
+    """Find parenthesis that closes the one before a given position.
+
+    Parentheses in quoted strings are ignored.
+
+    :param query: Query
+    :type query: str
+    :param start: Position after the opening parenthesis
+    :type start: int
+    :returns: Position of the closing parenthesis
+    :rtype: int
+
+    """
+    depth = 1
+    quote = None
+    for index in range(start, len(query)):
+        char = query[index]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return index
+    raise ValueError('Unbalanced parentheses: {}'.format(query))
+
+
+#: Functions used to insert rows for a given dialect name. They get the
+#: connection, the :class:`MultiRowInsert` statement and the rows to insert.
+BULK_INSERT_STRATEGIES = {
+}  # type: Dict[str, Callable[[Any, MultiRowInsert, List], None]]
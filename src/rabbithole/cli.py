@@ -3,13 +3,17 @@
 """Store messages from an AMQP server into a SQL database."""
 
 import argparse
+import json
 import logging
 import os
+import signal
 import sys
 import threading
 import time
 import traceback
 
+from collections import OrderedDict
+from functools import partial
 from pprint import pformat
 
 import six
@@ -17,27 +21,52 @@ import yaml
 
 from typing import (  # noqa
     Any,
+    Callable,
     Dict,
     List,
+    Optional,
+    Set,
+    Tuple,
 )
 
 from rabbithole.amqp import Consumer
 from rabbithole.sql import Database
 from rabbithole.batcher import Batcher
+from rabbithole.jsonl import JsonLinesReader
+from rabbithole.logs import (  # noqa
+    QueueListener,
+    start_queue_listener,
+)
+from rabbithole.metrics import start_http_server
+from rabbithole.scheduler import monotonic
+from rabbithole.supervisor import Supervisor
+from rabbithole.writer import (
+    BatchWriter,
+    QueuedOutput,
+)
 
 LOGGER = logging.getLogger(__name__)
+DEFAULT_SHUTDOWN_TIMEOUT = 30
+# Settings applied on reload without replacing any block
+RELOAD_SETTINGS = ('shutdown_timeout', )
+# Settings that only take effect when the process is restarted
+RESTART_SETTINGS = ('metrics_port', 'workers')
+# Running flow: configuration, input signal, batcher key and the receiver
+# connected to the batcher
+FlowRecord = Tuple[List[Dict[str, Any]], Any, Tuple[int, str], Callable]
 BLOCK_CLASSES = {
     'amqp': Consumer,
+    'jsonl': JsonLinesReader,
     'sql': Database,
-}
+}  # type: Dict[str, Callable[..., Any]]
 
 
 def main(argv=None):
-    # type: (List[str]) -> int
+    # type: (Optional[List[str]]) -> int
     """Console script for rabbithole.
 
     :param argv: Command line arguments
-    :type argv: list(str)
+    :type argv: list(str) | None
 
     """
     if argv is None:
@@ -45,37 +74,951 @@ def main(argv=None):
 
     args = parse_arguments(argv)
     config = args['config']
-    configure_logging(args['log_level'], args['log_file'])
-    logging.debug('Configuration:\n%s', pformat(config))
+    listener = configure_logging(args['log_level'], args['log_file'])
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('Configuration:\n%s', pformat(config))
 
-    namespace = {
-        block['name']: create_block_instance(block)
-        for block in config['blocks']
-    }
-    batcher_config = {
-        'size_limit': config.get('size_limit'),
-        'time_limit': config.get('time_limit'),
-    }
-    for flow in config['flows']:
-        create_flow(flow, namespace, batcher_config)
-    run_input_blocks(namespace)
+    if args['runtime'] == 'asyncio':
+        # Imported here since asyncio is only available in python 3
+        from rabbithole.aio import main as run_flows_target
+    else:
+        run_flows_target = run_flows
+
+    # Options set in the command line override the configuration file
+    overrides = {}  # type: Dict[str, Any]
+    metrics_port = args['metrics_port'] or config.get('metrics_port')
+    if metrics_port:
+        overrides['metrics_port'] = metrics_port
+        config = dict(config, **overrides)
+    reload_config = partial(load_config, args['config_file'], overrides)
+
+    workers = args['workers'] or config.get('workers') or 1
+    try:
+        if workers > 1:
+            supervisor = Supervisor(
+                config, workers, run_flows_target, reload_config)
+            return supervisor.run()
+        if run_flows_target is run_flows:
+            return run_flows(config, reload_config)
+        return run_flows_target(config)
+    finally:
+        # Write pending records before exiting
+        if listener is not None:
+            listener.stop()
+
+
+def load_config(path, overrides=None):
+    # type: (str, Optional[Dict[str, Any]]) -> Dict[str, Any]
+    """Load configuration file.
+
+    :param path: Path to the yaml file
+    :type path: str
+    :param overrides: Settings that replace the ones in the file
+    :type overrides: dict(str) | None
+    :returns: Configuration
+    :rtype: dict(str)
+
+    """
+    with open(path) as file_:
+        config = yaml.safe_load(file_)
+    if overrides:
+        config = dict(config, **overrides)
+    return config
+
+
+def run_flows(config, reload_config=None):
+    # type: (Dict[str, Any], Optional[Callable[[], Dict[str, Any]]]) -> int
+    """Run flows in the current process.
+
+    Each input block runs in its own thread and each output block gets its own
+    writer threads.
+
+    On SIGHUP, the configuration is reloaded and only the blocks that changed
+    are replaced (see :class:`RunningFlows`). On SIGTERM or KeyboardInterrupt,
+    flows are drained before exiting (see :func:`drain_flows`).
+
+    :param config: Configuration
+    :type config: dict(str)
+    :param reload_config:
+        Function that loads the configuration again (reloading is disabled if
+        not set)
+    :type reload_config: callable | None
+
+    """
+    stopping = threading.Event()
+    reloading = threading.Event()
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: stopping.set())
+    if reload_config is not None and hasattr(signal, 'SIGHUP'):
+        signal.signal(
+            signal.SIGHUP, lambda _signum, _frame: reloading.set())
+
+    start_metrics_server(config)
+    flows = RunningFlows()
+    flows.update(config)
 
     try:
         # Loop needed to be able to catch KeyboardInterrupt
-        while True:
+        while not stopping.is_set():
             time.sleep(1)
+            if reloading.is_set() and reload_config is not None:
+                reloading.clear()
+                reload_flows(flows, reload_config)
+        LOGGER.info('Terminated')
     except KeyboardInterrupt:
         LOGGER.info('Interrupted by user')
 
+    flows.drain()
     return 0
 
 
-def create_block_instance(block):
-    # type: (Dict[str, Any]) -> object
+def reload_flows(flows, reload_config):
+    # type: (RunningFlows, Callable[[], Dict[str, Any]]) -> None
+    """Apply the configuration loaded again to the running flows.
+
+    If the configuration can't be loaded or applied, the current flows keep
+    running.
+
+    :param flows: Running flows
+    :type flows: RunningFlows
+    :param reload_config: Function that loads the configuration again
+    :type reload_config: callable
+
+    """
+    LOGGER.info('Reloading configuration...')
+    try:
+        flows.update(reload_config())
+    except (Exception, SystemExit):  # pylint:disable=broad-except
+        LOGGER.error(traceback.format_exc())
+        LOGGER.error('Unable to reload configuration, keeping current flows')
+        return
+    LOGGER.info('Configuration reloaded')
+
+
+class RunningFlows(object):
+
+    """Blocks and flows running in the current process.
+
+    The strategy to apply a new configuration is:
+        - find the blocks that changed (see :func:`get_changed_blocks`) and
+          create the new and changed ones with their writer threads
+        - add the new and changed flows, moving the ones whose output block
+          was replaced to the new block
+        - remove the flows that aren't in the configuration anymore from the
+          input blocks that keep running
+        - start the new input blocks
+        - drain the input blocks that were replaced or removed and then close
+          the output blocks that were replaced or removed
+
+    This way, the connections, batchers and writer threads of the blocks and
+    flows that didn't change keep running while the configuration is
+    reloaded, and the replaced blocks are drained only when the new ones are
+    already running.
+
+    Output blocks whose replacement needs a resource they hold (see
+    :func:`get_conflicting_outputs`) are the exception: the batchers of
+    their flows are paused while the old block is closed and the new one is
+    created.
+
+    """
+
+    def __init__(self):
+        # type: () -> None
+        """Initialize internal data structures."""
+        self.config = {'blocks': [], 'flows': []}  # type: Dict[str, Any]
+        self.namespace = {}  # type: Dict[str, Any]
+        self.writers = {}  # type: Dict[str, BatchWriter]
+        self.threads = {}  # type: Dict[str, threading.Thread]
+        self.batchers = {}  # type: Dict[str, Dict[Tuple[int, str], Batcher]]
+        self.flows = {}  # type: Dict[str, FlowRecord]
+
+    def update(self, config):
+        # type: (Dict[str, Any]) -> None
+        """Apply configuration.
+
+        If the configuration can't be applied, the flows that were running
+        are kept.
+
+        :param config: Configuration
+        :type config: dict(str)
+
+        """
+        for key in RESTART_SETTINGS:
+            if self.namespace and (
+                    self.config.get(key) != config.get(key)):
+                LOGGER.warning('%r change ignored until restart', key)
+        changed = get_changed_blocks(self.config, config)
+        blocks = {block['name']: block for block in config['blocks']}
+        timeout = config.get('shutdown_timeout', DEFAULT_SHUTDOWN_TIMEOUT)
+        kept = set(
+            name for name in self.namespace
+            if name in blocks and name not in changed
+        )
+        created = [
+            block['name'] for block in config['blocks']
+            if block['name'] not in kept
+        ]
+        outputs = get_output_block_names(config['flows'])
+        blocking, deferred = get_conflicting_outputs(
+            self.config,
+            config,
+            [name for name in sorted(self.writers) if name not in kept],
+            [name for name in outputs if name not in kept],
+        )
+        batcher_config = get_batcher_config(config)
+        flows = OrderedDict()  # type: Dict[str, List[Dict[str, Any]]]
+        for flow in config['flows']:
+            key = get_flow_key(flow, batcher_config)
+            # Flows configured twice are kept apart
+            index = 1
+            while key in flows:
+                key = '{}#{}'.format(get_flow_key(flow, batcher_config), index)
+                index += 1
+            flows[key] = flow
+
+        namespace = {name: self.namespace[name] for name in kept}
+        writers = {
+            name: writer for name, writer in six.iteritems(self.writers)
+            if name in kept
+        }
+        batchers = {
+            name: input_batchers
+            for name, input_batchers in six.iteritems(self.batchers)
+            if name in kept
+        }
+        records = {}  # type: Dict[str, FlowRecord]
+        added = []  # type: List[str]
+        moved = []  # type: List[str]
+        try:
+            for name in created:
+                if name not in deferred:
+                    namespace[name] = create_block_instance(blocks[name])
+            for name in outputs:
+                if name not in writers and name not in deferred:
+                    writers[name] = create_writer(name, namespace, config)
+            for key, flow in six.iteritems(flows):
+                input_name, output_name = [block['name'] for block in flow]
+                if output_name in deferred:
+                    continue
+                if key in self.flows and input_name in kept:
+                    if output_name in kept:
+                        records[key] = self.flows[key]
+                    else:
+                        records[key] = move_flow(
+                            self.flows[key],
+                            flow,
+                            namespace,
+                            batchers[input_name],
+                            batcher_config,
+                        )
+                        moved.append(key)
+                    continue
+                records[key] = (flow, ) + create_flow(
+                    flow,
+                    namespace,
+                    batcher_config,
+                    batchers=batchers.setdefault(input_name, {}),
+                )
+                added.append(key)
+            if blocking:
+                # Nothing that might fail is done afterwards, since the old
+                # blocks can't be put back once the new ones are running
+                records.update(self.replace_outputs(
+                    blocking,
+                    deferred,
+                    flows,
+                    config,
+                    namespace,
+                    writers,
+                    batchers,
+                    timeout,
+                ))
+        except (Exception, SystemExit):
+            # Put the running flows back as they were
+            for key in moved:
+                input_name = records[key][0][0]['name']
+                swap_receivers(
+                    batchers[input_name][records[key][2]],
+                    records[key][3],
+                    self.flows[key][3],
+                )
+            for key in added:
+                input_name = records[key][0][0]['name']
+                if input_name in kept:
+                    remove_flow(
+                        records[key],
+                        namespace[input_name],
+                        batchers[input_name],
+                    )
+            # Release the resources of the blocks that won't be used
+            for name, writer in six.iteritems(writers):
+                if name not in kept:
+                    writer.close()
+            for name in created:
+                if name in namespace:
+                    close_block(namespace[name], None)
+            raise
+
+        # Flows are added before removing the ones they replace,
+        # so that no message is dropped meanwhile
+        for key, record in six.iteritems(self.flows):
+            input_name = record[0][0]['name']
+            if input_name in kept and key not in records:
+                remove_flow(
+                    record, namespace[input_name], batchers[input_name])
+
+        threads = {
+            name: thread for name, thread in six.iteritems(self.threads)
+            if name in kept
+        }
+        for thread in run_input_blocks(
+                {name: namespace[name] for name in created}):
+            threads[thread.name] = thread
+
+        # Replaced input blocks are drained once the new ones are running
+        # and then the output blocks that no flow uses anymore are closed
+        self.retire([name for name in self.namespace if name not in kept],
+                    timeout)
+        self.config = config
+        self.namespace = namespace
+        self.writers = writers
+        self.threads = threads
+        self.batchers = batchers
+        self.flows = records
+
+    def replace_outputs(
+            self,
+            blocking,  # type: List[str]
+            deferred,  # type: List[str]
+            flows,  # type: Dict[str, List[Dict[str, Any]]]
+            config,  # type: Dict[str, Any]
+            namespace,  # type: Dict[str, Any]
+            writers,  # type: Dict[str, BatchWriter]
+            batchers,  # type: Dict[str, Dict[Tuple[int, str], Batcher]]
+            timeout,  # type: float
+            ):
+        # type: (...) -> Dict[str, FlowRecord]
+        """Replace output blocks that need a resource held by the old ones.
+
+        The batchers of the flows to the old blocks are paused and flushed,
+        the old blocks are closed and the new ones are created with their
+        flows. If that fails, the old blocks and their flows are restored.
+
+        :param blocking: Running output blocks that hold the resources
+        :type blocking: list(str)
+        :param deferred: New output blocks that need the resources
+        :type deferred: list(str)
+        :param flows: Flows configuration by key
+        :type flows: dict(str, list(dict(str)))
+        :param config: Configuration being applied
+        :type config: dict(str)
+        :param namespace: Block instances namespace being created
+        :type namespace: dict(str, instance)
+        :param writers: Writers for the output blocks being created
+        :type writers: dict(str, rabbithole.writer.BatchWriter)
+        :param batchers: Batchers being created by input block
+        :type batchers: dict(str, dict)
+        :param timeout: Maximum number of seconds to wait for the old blocks
+        :type timeout: float
+        :returns: Flows to the new output blocks by key
+        :rtype: dict(str, tuple)
+
+        """
+        LOGGER.info(
+            'Closing blocks before replacing them: %s', ', '.join(blocking))
+        detached = [
+            (key, record) for key, record in six.iteritems(self.flows)
+            if record[0][1]['name'] in blocking
+        ]
+        paused = []  # type: List[Batcher]
+        for _key, (flow, _signal, batcher_key, _receiver) in detached:
+            batcher = self.batchers[flow[0]['name']][batcher_key]
+            if batcher not in paused:
+                batcher.pause()
+                paused.append(batcher)
+
+        records = {}  # type: Dict[str, FlowRecord]
+        try:
+            for batcher in paused:
+                batcher.flush()
+            for _key, (flow, _signal, batcher_key, receiver) in detached:
+                batcher = self.batchers[flow[0]['name']][batcher_key]
+                batcher.batch_ready.disconnect(receiver)
+            for name in blocking:
+                if not self.writers.pop(name).close(timeout):
+                    LOGGER.warning(
+                        'Timeout while waiting for batches to be written')
+                close_block(self.namespace.pop(name), timeout)
+
+            blocks = {block['name']: block for block in config['blocks']}
+            batcher_config = get_batcher_config(config)
+            try:
+                for name in deferred:
+                    namespace[name] = create_block_instance(blocks[name])
+                    writers[name] = create_writer(name, namespace, config)
+                for key, flow in six.iteritems(flows):
+                    input_name, output_name = [block['name'] for block in flow]
+                    if output_name in deferred:
+                        records[key] = (flow, ) + create_flow(
+                            flow,
+                            namespace,
+                            batcher_config,
+                            batchers=batchers.setdefault(input_name, {}),
+                        )
+            except (Exception, SystemExit):
+                LOGGER.error('Unable to replace blocks, restoring them')
+                self.restore_outputs(
+                    blocking,
+                    deferred,
+                    detached,
+                    records,
+                    paused,
+                    namespace,
+                    writers,
+                    batchers,
+                    timeout,
+                )
+                raise
+        finally:
+            # Messages held meanwhile are sent to the new blocks
+            for batcher in paused:
+                batcher.resume()
+        return records
+
+    def restore_outputs(
+            self,
+            blocking,  # type: List[str]
+            deferred,  # type: List[str]
+            detached,  # type: List[Tuple[str, FlowRecord]]
+            records,  # type: Dict[str, FlowRecord]
+            paused,  # type: List[Batcher]
+            namespace,  # type: Dict[str, Any]
+            writers,  # type: Dict[str, BatchWriter]
+            batchers,  # type: Dict[str, Dict[Tuple[int, str], Batcher]]
+            timeout,  # type: float
+            ):
+        # type: (...) -> None
+        """Put back the output blocks that couldn't be replaced.
+
+        :param blocking: Output blocks that were closed
+        :type blocking: list(str)
+        :param deferred: Output blocks that were being created
+        :type deferred: list(str)
+        :param detached: Flows to the closed blocks with their keys
+        :type detached: list((str, tuple))
+        :param records: Flows created for the new blocks by key
+        :type records: dict(str, tuple)
+        :param paused: Batchers of the flows to the closed blocks
+        :type paused: list(rabbithole.batcher.Batcher)
+        :param namespace: Block instances namespace being created
+        :type namespace: dict(str, instance)
+        :param writers: Writers for the output blocks being created
+        :type writers: dict(str, rabbithole.writer.BatchWriter)
+        :param batchers: Batchers being created by input block
+        :type batchers: dict(str, dict)
+        :param timeout: Maximum number of seconds to wait for the new blocks
+        :type timeout: float
+
+        """
+        for record in records.values():
+            flow, _signal, batcher_key, receiver = record
+            input_name = flow[0]['name']
+            batcher = batchers[input_name][batcher_key]
+            if batcher in paused:
+                # Messages held are sent to the restored blocks instead
+                batcher.batch_ready.disconnect(receiver)
+            elif namespace[input_name] is self.namespace.get(input_name):
+                remove_flow(
+                    record, namespace[input_name], batchers[input_name])
+        for name in deferred:
+            if name in writers:
+                writers.pop(name).close(timeout)
+            if name in namespace:
+                close_block(namespace.pop(name), timeout)
+
+        old_blocks = {block['name']: block for block in self.config['blocks']}
+        for name in blocking:
+            self.namespace[name] = create_block_instance(old_blocks[name])
+            self.writers[name] = create_writer(
+                name, self.namespace, self.config)
+        batcher_config = get_batcher_config(self.config)
+        for key, (flow, _signal, _batcher_key, _receiver) in detached:
+            self.flows[key] = (flow, ) + create_flow(
+                flow,
+                self.namespace,
+                batcher_config,
+                batchers=self.batchers[flow[0]['name']],
+            )
+
+    def retire(self, names, timeout):
+        # type: (List[str], float) -> None
+        """Drain blocks and stop keeping track of them.
+
+        :param names: Block names
+        :type names: list(str)
+        :param timeout: Maximum number of seconds to wait for the blocks
+        :type timeout: float
+
+        """
+        if not names:
+            return
+        LOGGER.info('Replacing blocks: %s', ', '.join(names))
+        drain_flows(
+            self.namespace,
+            [self.threads[name] for name in names if name in self.threads],
+            [
+                batcher
+                for name in names
+                for batcher in self.batchers.get(name, {}).values()
+            ],
+            [self.writers[name] for name in names if name in self.writers],
+            timeout,
+            [
+                self.namespace[name].block
+                for name in names if name in self.writers
+            ],
+        )
+        for name in names:
+            del self.namespace[name]
+            self.threads.pop(name, None)
+            self.batchers.pop(name, None)
+            self.writers.pop(name, None)
+
+    def drain(self):
+        # type: () -> None
+        """Drain all the running blocks before exiting."""
+        drain_flows(
+            self.namespace,
+            list(self.threads.values()),
+            [
+                batcher
+                for input_batchers in self.batchers.values()
+                for batcher in input_batchers.values()
+            ],
+            list(self.writers.values()),
+            self.config.get('shutdown_timeout', DEFAULT_SHUTDOWN_TIMEOUT),
+            [self.namespace[name].block for name in self.writers],
+        )
+
+
+def get_changed_blocks(old_config, new_config):
+    # type: (Dict[str, Any], Dict[str, Any]) -> Set[str]
+    """Get the blocks that have to be replaced to apply a new configuration.
+
+    A block in both configurations is replaced if:
+        - its configuration changed
+        - it's used as output only in one of them
+
+    Flows that were added, removed or changed don't replace their blocks,
+    since they're added to and removed from the running ones.
+
+    All of them are replaced if any other setting (other than the batcher
+    ones, which only affect the flows, and the ones in
+    :data:`RELOAD_SETTINGS` and :data:`RESTART_SETTINGS`) changed.
+
+    :param old_config: Configuration being run
+    :type old_config: dict(str)
+    :param new_config: Configuration to apply
+    :type new_config: dict(str)
+    :returns: Block names
+    :rtype: set(str)
+
+    """
+    old_blocks = {block['name']: block for block in old_config['blocks']}
+    new_blocks = {block['name']: block for block in new_config['blocks']}
+    names = set(old_blocks) & set(new_blocks)
+    ignored = ('blocks', 'flows') + tuple(get_batcher_config({})) + (
+        RELOAD_SETTINGS + RESTART_SETTINGS)
+
+    def get_settings(config):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        """Get settings shared by all the blocks."""
+        return {
+            key: value for key, value in six.iteritems(config)
+            if key not in ignored
+        }
+
+    if get_settings(old_config) != get_settings(new_config):
+        return names
+
+    old_outputs = set(get_output_block_names(old_config['flows']))
+    new_outputs = set(get_output_block_names(new_config['flows']))
+    return set(
+        name for name in names
+        if old_blocks[name] != new_blocks[name] or
+        (name in old_outputs) != (name in new_outputs)
+    )
+
+
+def get_conflicting_outputs(old_config, new_config, retired, created):
+    # type: (Dict[str, Any], Dict[str, Any], List[str], List[str]) -> Tuple[List[str], List[str]]  # noqa
+    """Get the output blocks that need a resource held by a retired one.
+
+    Only one block at a time can use a spool directory, so a block that
+    replaces another one with the same spool can only be created once the
+    old one has been closed.
+
+    :param old_config: Configuration being run
+    :type old_config: dict(str)
+    :param new_config: Configuration to apply
+    :type new_config: dict(str)
+    :param retired: Output blocks being replaced or removed
+    :type retired: list(str)
+    :param created: Output blocks being created
+    :type created: list(str)
+    :returns:
+        Retired blocks to close first and created blocks to create afterwards
+    :rtype: tuple(list(str), list(str))
+
+    """
+    old_blocks = {block['name']: block for block in old_config['blocks']}
+    new_blocks = {block['name']: block for block in new_config['blocks']}
+    holders = {}  # type: Dict[str, Set[str]]
+    for name in retired:
+        for resource in get_exclusive_resources(old_blocks[name]):
+            holders.setdefault(resource, set()).add(name)
+    blocking = set()  # type: Set[str]
+    deferred = set()  # type: Set[str]
+    for name in created:
+        for resource in get_exclusive_resources(new_blocks[name]):
+            if resource in holders:
+                blocking.update(holders[resource])
+                deferred.add(name)
+    return sorted(blocking), sorted(deferred)
+
+
+def get_exclusive_resources(block):
+    # type: (Dict[str, Any]) -> Set[str]
+    """Get the resources that only one block instance can use at a time.
+
+    :param block: Block configuration
+    :type block: dict(str)
+    :returns: Absolute paths to the spool directories used by the block
+    :rtype: set(str)
+
+    """
+    spool = block.get('kwargs', {}).get('spool')
+    if not spool or 'directory' not in spool:
+        return set()
+    return set([os.path.abspath(spool['directory'])])
+
+
+def create_writer(name, namespace, config):
+    # type: (str, Dict[str, Any], Dict[str, Any]) -> BatchWriter
+    """Create the writer threads for an output block.
+
+    The block instance in the namespace is replaced with an output that
+    queues its batches to the writer.
+
+    :param name: Output block name
+    :type name: str
+    :param namespace: Block instances namespace
+    :type namespace: dict(str, instance)
+    :param config: Configuration
+    :type config: dict(str)
+    :returns: Writer
+    :rtype: rabbithole.writer.BatchWriter
+
+    """
+    # Blocks might set how many batches they can write in parallel
+    writer = BatchWriter(
+        name,
+        getattr(namespace[name], 'writers', None) or
+        config.get('writer_threads'),
+        config.get('writer_queue_size'),
+    )
+    namespace[name] = QueuedOutput(namespace[name], writer)
+    return writer
+
+
+def move_flow(
+        record,  # type: FlowRecord
+        flow,  # type: List[Dict[str, Any]]
+        namespace,  # type: Dict[str, Any]
+        batchers,  # type: Dict[Tuple[int, str], Batcher]
+        batcher_config,  # type: Dict[str, Any]
+        ):
+    # type: (...) -> FlowRecord
+    """Send the batches of a running flow to the block replacing its output.
+
+    The batcher is paused meanwhile, so that no batch is sent to both of
+    them.
+
+    :param record: Running flow
+    :type record: tuple
+    :param flow: Flow configuration
+    :type flow: list(dict(str))
+    :param namespace: Block instances namespace with the new output block
+    :type namespace: dict(str, instance)
+    :param batchers: Batchers of the input block by signal and configuration
+    :type batchers: dict((int, str), rabbithole.batcher.Batcher)
+    :param batcher_config: Configuration to be passed to batcher objects
+    :type batcher_config: dict(str)
+    :returns: Flow moved to the new output block
+    :rtype: tuple
+
+    """
+    _flow, _signal, batcher_key, receiver = record
+    batcher = batchers[batcher_key]
+    batcher.pause()
+    try:
+        batcher.flush()
+        # The batcher is shared with the new output
+        moved = (flow, ) + create_flow(
+            flow, namespace, batcher_config, batchers=batchers)
+        batcher.batch_ready.disconnect(receiver)
+    finally:
+        batcher.resume()
+    return moved
+
+
+def swap_receivers(batcher, old_receiver, new_receiver):
+    # type: (Batcher, Callable, Callable) -> None
+    """Send the batches of a batcher to a receiver instead of another one.
+
+    :param batcher: Running batcher
+    :type batcher: rabbithole.batcher.Batcher
+    :param old_receiver: Receiver that gets the batches now
+    :type old_receiver: callable
+    :param new_receiver: Receiver that will get the batches
+    :type new_receiver: callable
+
+    """
+    batcher.pause()
+    try:
+        batcher.flush()
+        batcher.batch_ready.connect(new_receiver, weak=False)
+        batcher.batch_ready.disconnect(old_receiver)
+    finally:
+        batcher.resume()
+
+
+def remove_flow(record, input_block_instance, batchers):
+    # type: (FlowRecord, Any, Dict[Tuple[int, str], Batcher]) -> None
+    """Remove a flow from an input block that keeps running.
+
+    Pending messages are sent to the output before it's disconnected. The
+    batcher is closed if no other flow uses it and the input block stops
+    receiving the messages that no flow uses anymore.
+
+    :param record: Running flow
+    :type record: tuple
+    :param input_block_instance: Input block instance
+    :type input_block_instance: instance
+    :param batchers: Batchers of the input block by signal and configuration
+    :type batchers: dict((int, str), rabbithole.batcher.Batcher)
+
+    """
+    flow, signal, batcher_key, receiver = record
+    LOGGER.info('Removing %r flow', get_flow_name(flow))
+    batcher = batchers[batcher_key]
+    batcher.flush()
+    batcher.batch_ready.disconnect(receiver)
+    if not batcher.batch_ready.receivers:
+        signal.disconnect(batcher.message_received_cb)
+        # Messages received meanwhile are rejected to be delivered again
+        batcher.close()
+        del batchers[batcher_key]
+    if signal.receivers:
+        return
+    remove_signal = getattr(input_block_instance, 'remove_signal', None)
+    if remove_signal is None:
+        return
+    try:
+        remove_signal(signal)
+    except Exception:  # pylint:disable=broad-except
+        LOGGER.error(traceback.format_exc())
+        LOGGER.error('Unable to remove signal for %r', get_flow_name(flow))
+
+
+def drain_flows(namespace, threads, batchers, writers, timeout, outputs=None):
+    # type: (Dict[str, Any], List[threading.Thread], List[Batcher], List[BatchWriter], float, Optional[List[Any]]) -> None  # noqa
+    """Stop flows without losing the messages that are being processed.
+
+    The strategy to drain flows is:
+        - stop input blocks, so that no more messages are received
+        - flush every batcher, so that pending messages are sent to the output
+        - wait until the writer threads have written every batch
+        - close output blocks, so that their connections are released
+        - close input blocks once their messages have been acknowledged
+
+    Messages whose batches weren't written before the timeout are never
+    acknowledged, so the server delivers them again later.
+
+    :param namespace: Block instances namespace
+    :type namespace: dict(str, instance)
+    :param threads: Input block threads
+    :type threads: list(threading.Thread)
+    :param batchers: Batchers for all the flows
+    :type batchers: list(rabbithole.batcher.Batcher)
+    :param writers: Writers for all the output blocks
+    :type writers: list(rabbithole.writer.BatchWriter)
+    :param timeout: Maximum number of seconds to wait for the whole process
+    :type timeout: float
+    :param outputs: Output blocks to close once their batches are written
+    :type outputs: list(instance) | None
+
+    """
+    LOGGER.info('Draining flows (timeout: %.2f seconds)...', timeout)
+    deadline = monotonic() + timeout
+
+    def remaining():
+        # type: () -> float
+        """Get seconds until the deadline."""
+        return max(0, deadline - monotonic())
+
+    inputs = [namespace[thread.name] for thread in threads]
+    for block_instance in inputs:
+        stop_method = getattr(block_instance, 'stop', None)
+        if stop_method:
+            stop_method(remaining())
+    for batcher in batchers:
+        batcher.flush()
+    for writer in writers:
+        if not writer.close(remaining()):
+            LOGGER.warning('Timeout while waiting for batches to be written')
+    for block_instance in outputs or []:
+        close_block(block_instance, remaining())
+    for block_instance in inputs:
+        close_block(block_instance, remaining())
+    for thread in threads:
+        thread.join(remaining())
+    LOGGER.info('Flows drained')
+
+
+def close_block(block_instance, timeout):
+    # type: (Any, Optional[float]) -> None
+    """Close block if it has anything to close.
+
+    :param block_instance: Block instance (or output wrapping it)
+    :type block_instance: instance
+    :param timeout: Maximum number of seconds to wait for the block
+    :type timeout: float | None
+
+    """
+    if isinstance(block_instance, QueuedOutput):
+        block_instance = block_instance.block
+    close_method = getattr(block_instance, 'close', None)
+    if close_method:
+        close_method(timeout)
+
+
+def get_batcher_config(config):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """Get the batcher configuration shared by all flows.
+
+    :param config: Configuration
+    :type config: dict(str)
+    :returns: Keyword arguments for the batchers
+    :rtype: dict(str)
+
+    """
+    return {
+        'size_limit': config.get('size_limit'),
+        'time_limit': config.get('time_limit'),
+        'bytes_limit': config.get('bytes_limit'),
+        'adaptive': config.get('adaptive'),
+    }
+
+
+def get_flow_batcher_config(batcher_config, flow):
+    # type: (Dict[str, Any], List[Dict[str, Any]]) -> Dict[str, Any]
+    """Get the batcher configuration of a flow.
+
+    :param batcher_config: Batcher configuration shared by all flows
+    :type batcher_config: dict(str)
+    :param flow: Flow configuration
+    :type flow: list(dict(str))
+    :returns: Keyword arguments for the flow batcher
+    :rtype: dict(str)
+
+    """
+    flow_batcher_config = dict(batcher_config)
+    flow_batcher_config.update(flow[1].get('batcher', {}))
+    return flow_batcher_config
+
+
+def get_flow_key(flow, batcher_config):
+    # type: (List[Dict[str, Any]], Dict[str, Any]) -> str
+    """Get the key used to find out whether a flow changed on reload.
+
+    :param flow: Flow configuration
+    :type flow: list(dict(str))
+    :param batcher_config: Batcher configuration shared by all flows
+    :type batcher_config: dict(str)
+    :returns: Flow and batcher configuration serialized
+    :rtype: str
+
+    """
+    return json.dumps(
+        [flow, get_flow_batcher_config(batcher_config, flow)],
+        sort_keys=True,
+        default=str,
+    )
+
+
+def get_output_block_names(flows):
+    # type: (List[List[Dict[str, Any]]]) -> List[str]
+    """Get the names of the blocks used as output in the flows.
+
+    :param flows: Flows configuration
+    :type flows: list(list(dict(str)))
+    :returns: Output block names
+    :rtype: list(str)
+
+    """
+    return sorted(set(output_block['name'] for _, output_block in flows))
+
+
+def get_flow_name(flow):
+    # type: (List[Dict[str, Any]]) -> str
+    """Get the name used to label the metrics of a flow.
+
+    The name is made of the input block name, the exchange (or the first
+    input block argument) and the output block name (for example,
+    `input/logs/output`).
+
+    :param flow: Flow configuration
+    :type flow: list(dict(str))
+    :returns: Flow name
+    :rtype: str
+
+    """
+    input_block, output_block = flow
+    source = input_block.get('kwargs', {}).get('exchange')
+    if source is None and input_block.get('args'):
+        source = input_block['args'][0]
+    names = [input_block['name'], source, output_block['name']]
+    return '/'.join(str(name) for name in names if name is not None)
+
+
+def start_metrics_server(config):
+    # type: (Dict[str, Any]) -> None
+    """Serve metrics if a port has been set in the configuration.
+
+    :param config: Configuration
+    :type config: dict(str)
+
+    """
+    port = config.get('metrics_port')
+    if not port:
+        return
+    try:
+        start_http_server(port, config.get('metrics_address', '127.0.0.1'))
+    except (IOError, OSError) as error:
+        # Metrics aren't worth stopping the flows
+        LOGGER.error('Unable to serve metrics on port %d: %s', port, error)
+
+
+def create_block_instance(block, block_classes=None):
+    # type: (Dict[str, Any], Optional[Dict[str, Callable[..., Any]]]) -> object  # noqa
     """Create block instance from its configuration.
 
     :param block: Block configuration
     :type block: dict(str)
+    :param block_classes:
+        Mapping from block type to class or factory (:data:`BLOCK_CLASSES` by
+        default)
+    :type block_classes: dict(str, callable) | None
     :return: Block instance
     :rtype: instance
 
@@ -87,7 +1030,9 @@ def create_block_instance(block):
         block.get('args'),
         block.get('kwargs'),
     )
-    block_class = BLOCK_CLASSES[block['type']]
+    if block_classes is None:
+        block_classes = BLOCK_CLASSES
+    block_class = block_classes[block['type']]
 
     try:
         block_instance = block_class(
@@ -108,20 +1053,69 @@ def create_block_instance(block):
     return block_instance
 
 
-def create_flow(flow, namespace, batcher_config):
-    # type: (List[Dict[str, Any]], Dict[str, Any], Dict[str, int]) -> None
+def create_flow(
+        flow,  # type: List[Dict[str, Any]]
+        namespace,  # type: Dict[str, Any]
+        batcher_config,  # type: Dict[str, Any]
+        batcher_factory=None,  # type: Optional[Callable[..., Batcher]]
+        batchers=None,  # type: Optional[Dict[Tuple[int, str], Batcher]]
+        ):
+    # type: (...) -> Tuple[Any, Tuple[int, str], Callable]
     """Create flow by connecting block signals.
 
+    Flows that get the same signal from their input block and use the same
+    batcher configuration share a batcher when a `batchers` mapping is
+    passed, so that every batch is sent to all their outputs at once (each one
+    in its own writer threads) and messages are settled when the slowest
+    output is done with them.
+
     :param flow: Flow configuration
     :type flow: dict(str)
     :param namespace: Block instances namespace
     :type namespace: dict(str, instance)
-    :param batcher_config: Configuration to be passed to batcher objects
+    :param batcher_config:
+        Configuration to be passed to batcher objects, which can be
+        overridden by the `batcher` key in the flow output block
     :type batcher_config: dict(str)
+    :param batcher_factory:
+        Callable used to create the batcher objects (:class:`Batcher` by
+        default)
+    :type batcher_factory: callable | None
+    :param batchers:
+        Batchers already created for other flows by input signal and
+        configuration
+    :type batchers: dict((int, str), rabbithole.batcher.Batcher) | None
+    :returns:
+        Input block signal, key of the batcher and receiver connected to the
+        batcher, so that the flow can be removed later
+    :rtype: tuple(rabbithole.signals.Signal, (int, str), callable)
 
     """
     input_block, output_block = flow
+    output_block_instance = namespace[output_block['name']]
+
+    try:
+        output_cb = output_block_instance(
+            *output_block.get('args', []),
+            **output_block.get('kwargs', {})
+        )
+    except Exception:  # pylint:disable=broad-except
+        LOGGER.error(traceback.format_exc())
+        LOGGER.error(
+            'Unable to get callback from %r block: (args: %r, kwargs: %r)',
+            output_block['name'],
+            output_block.get('args', []),
+            output_block.get('kwargs', {}),
+        )
+        sys.exit(1)
+
     input_block_instance = namespace[input_block['name']]
+    input_kwargs = dict(input_block.get('kwargs', {}))
+
+    # Let the input block keep only the fields used by the output block
+    fields = get_output_fields(output_block_instance, output_block)
+    if fields is not None:
+        input_kwargs['fields'] = fields
 
     try:
         LOGGER.info('Getting %r input block signal...', input_block['name'])
@@ -129,11 +1123,11 @@ def create_flow(flow, namespace, batcher_config):
             '%r input block signal arguments: (args: %s, kwargs: %s)',
             input_block['name'],
             input_block.get('args'),
-            input_block.get('kwargs'),
+            input_kwargs,
         )
         input_signal = input_block_instance(
             *input_block.get('args', []),
-            **input_block.get('kwargs', {})
+            **input_kwargs
         )
     except Exception:  # pylint:disable=broad-except
         LOGGER.error(traceback.format_exc())
@@ -141,30 +1135,103 @@ def create_flow(flow, namespace, batcher_config):
             'Unable to get signal from %r block: (args: %r, kwargs: %r)',
             input_block['name'],
             input_block.get('args', []),
-            input_block.get('kwargs', {}),
+            input_kwargs,
         )
         sys.exit(1)
 
-    output_block_instance = namespace[output_block['name']]
+    if batcher_factory is None:
+        batcher_factory = Batcher
+    flow_batcher_config = get_flow_batcher_config(batcher_config, flow)
+    flow_name = get_flow_name(flow)
+    batcher_key = (
+        id(input_signal),
+        json.dumps(flow_batcher_config, sort_keys=True, default=str),
+    )
+    if batchers is not None and batcher_key in batchers:
+        batcher = batchers[batcher_key]
+        LOGGER.info('Sharing %r batcher with %r', batcher.name, flow_name)
+        # Label the output metrics with this flow name
+        receiver = partial(send_as, FlowSender(batcher, flow_name), output_cb)
+        batcher.batch_ready.connect(receiver, weak=False)
+        return input_signal, batcher_key, receiver
 
     try:
-        output_cb = output_block_instance(
-            *output_block.get('args', []),
-            **output_block.get('kwargs', {})
-        )
+        batcher = batcher_factory(name=flow_name, **flow_batcher_config)
     except Exception:  # pylint:disable=broad-except
         LOGGER.error(traceback.format_exc())
         LOGGER.error(
-            'Unable to get callback from %r block: (args: %r, kwargs: %r)',
+            'Unable to create batcher for %r block: %r',
             output_block['name'],
-            output_block.get('args', []),
-            output_block.get('kwargs', {}),
+            flow_batcher_config,
         )
         sys.exit(1)
-
-    batcher = Batcher(**batcher_config)
     input_signal.connect(batcher.message_received_cb, weak=False)
     batcher.batch_ready.connect(output_cb, weak=False)
+    if batchers is not None:
+        batchers[batcher_key] = batcher
+    return input_signal, batcher_key, output_cb
+
+
+class FlowSender(object):
+
+    """Batcher as seen by the output of a flow that shares it with others.
+
+    :param batcher: Shared batcher
+    :type batcher: rabbithole.batcher.Batcher
+    :param name: Flow name
+    :type name: str
+
+    """
+
+    def __init__(self, batcher, name):
+        # type: (Batcher, str) -> None
+        """Store batcher and flow name."""
+        self.batcher = batcher
+        self.name = name
+
+
+def send_as(sender, callback, _batcher, **kwargs):
+    # type: (object, Callable, object, **Any) -> Any
+    """Call output callback on behalf of another sender.
+
+    :param sender: Sender passed to the callback
+    :type sender: object
+    :param callback: Output callback
+    :type callback: callable
+    :param _batcher: Batcher that sent the batch_ready signal
+    :type _batcher: rabbithole.batcher.Batcher
+    :param kwargs: Keyword arguments sent with the signal
+    :type kwargs: dict(str)
+    :returns: Value returned by the callback
+    :rtype: object
+
+    """
+    return callback(sender, **kwargs)
+
+
+def get_output_fields(output_block_instance, output_block):
+    # type: (object, Dict[str, Any]) -> Optional[List[str]]
+    """Get the message fields that an output block reads in a flow.
+
+    :param output_block_instance: Output block instance
+    :type output_block_instance: object
+    :param output_block: Output block flow configuration
+    :type output_block: dict(str)
+    :returns:
+        Dotted paths to the fields or None if the whole messages are needed
+    :rtype: list(str) | None
+
+    """
+    fields_method = getattr(output_block_instance, 'fields', None)
+    if not callable(fields_method):
+        return None
+    fields = fields_method(
+        *output_block.get('args', []),
+        **output_block.get('kwargs', {})
+    )
+    if not isinstance(fields, list):
+        return None
+    return fields
 
 
 def run_input_blocks(namespace):
@@ -198,9 +1265,11 @@ def parse_arguments(argv):
 
     """
     parser = argparse.ArgumentParser(description=__doc__)
+    # Path kept to be able to reload the configuration
+    config_files = []  # type: List[str]
 
     def yaml_file(path):
-        # type: (str) -> str
+        # type: (str) -> Dict[str, Any]
         """Yaml file argument.
 
         :param path: Path to the yaml file
@@ -210,12 +1279,12 @@ def parse_arguments(argv):
         if not os.path.isfile(path):
             raise argparse.ArgumentTypeError('File not found')
 
-        with open(path) as file_:
-            try:
-                data = yaml.load(file_)
-            except yaml.YAMLError:
-                raise argparse.ArgumentTypeError('YAML parsing error')
+        try:
+            data = load_config(path)
+        except yaml.YAMLError:
+            raise argparse.ArgumentTypeError('YAML parsing error')
 
+        config_files.append(path)
         return data
 
     parser.add_argument(
@@ -238,24 +1307,54 @@ def parse_arguments(argv):
         dest='log_file',
         help='Path to log file',
     )
+    parser.add_argument(
+        '-w', '--workers',
+        dest='workers',
+        type=int,
+        help=('Number of worker processes in which flows are distributed '
+              '(1 by default)'),
+    )
+    parser.add_argument(
+        '-r', '--runtime',
+        dest='runtime',
+        choices=['threading', 'asyncio'],
+        default='threading',
+        help=('Runtime used to run the flows: one thread per input block '
+              'or a single asyncio event loop (%(default)s by default)'),
+    )
+    parser.add_argument(
+        '-m', '--metrics-port',
+        dest='metrics_port',
+        type=int,
+        help=('Local port in which metrics are served in the Prometheus '
+              'text format (each worker process uses the next port)'),
+    )
 
     args = vars(parser.parse_args(argv))
+    args['config_file'] = config_files[-1]
     args['log_level'] = getattr(logging, args['log_level'].upper())
     return args
 
 
 def configure_logging(log_level, log_file):
-    # type: (int, str) -> None
+    # type: (int, str) -> Optional[QueueListener]
     """Configure logging based on command line argument.
 
+    Records are written by a listener thread, so that logging doesn't block
+    message processing.
+
     :param log_level: Log level passed form the command line
     :type log_level: int
     :param log_file: Path to log file
     :type log_level: str
+    :returns: Listener that writes records (None in python 2)
+    :rtype: logging.handlers.QueueListener | None
 
     """
+    # Set root logger level to the one passed through the command line, so
+    # that messages below it are discarded before formatting them
     root_logger = logging.getLogger()
-    root_logger.setLevel(logging.DEBUG)
+    root_logger.setLevel(log_level)
 
     # Log to sys.stderr using log level
     # passed through command line
@@ -264,18 +1363,22 @@ def configure_logging(log_level, log_file):
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
     stream_handler.setLevel(log_level)
-    root_logger.addHandler(stream_handler)
+    handlers = [stream_handler]  # type: List[logging.Handler]
 
     # Log to file if available
     if log_file is not None:
         file_handler = logging.FileHandler(log_file)
         file_handler.setFormatter(formatter)
         file_handler.setLevel(log_level)
-        root_logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    listener = start_queue_listener(root_logger, handlers)
 
     # Disable pika extra verbose logging
     logging.getLogger('pika').setLevel(logging.WARNING)
 
+    return listener
+
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""Decoders: parse JSON message bodies.
+
+The strategy to pick a decoder is:
+    - use the backend requested in the configuration if any
+    - otherwise, use the fastest backend that is installed and fall back to
+      the standard library
+
+All the backends decode the message body directly from bytes and raise a
+`ValueError` subclass when the body isn't valid JSON.
+
+"""
+
+import importlib
+import json
+
+from typing import (  # noqa
+    Any,
+    Callable,
+    Tuple,
+)
+
+#: Backends tried in order when the decoder is set to `auto`
+AUTO_DECODERS = ['orjson', 'ujson', 'rapidjson']
+
+#: Module names of the supported backends
+DECODER_MODULES = {
+    'json': 'json',
+    'orjson': 'orjson',
+    'rapidjson': 'rapidjson',
+    'simplejson': 'simplejson',
+    'ujson': 'ujson',
+}
+
+
+def get_decoder(name='auto'):
+    # type: (str) -> Tuple[str, Callable[[bytes], Any]]
+    """Get function that parses JSON documents.
+
+    :param name:
+        Backend name (one of `json`, `orjson`, `rapidjson`, `simplejson` or
+        `ujson`) or `auto` to use the fastest one that is installed
+    :type name: str
+    :returns: Backend name and function that parses a document
+    :rtype: tuple(str, callable)
+    :raises ValueError: If the backend isn't supported
+    :raises ImportError: If the requested backend isn't installed
+
+    """
+    if name == 'auto':
+        for candidate in AUTO_DECODERS:
+            try:
+                module = importlib.import_module(DECODER_MODULES[candidate])
+            except ImportError:
+                continue
+            return candidate, module.loads
+        return 'json', json.loads
+
+    if name not in DECODER_MODULES:
+        raise ValueError('Unknown JSON decoder: {!r}'.format(name))
+    module = importlib.import_module(DECODER_MODULES[name])
+    return name, module.loads
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+"""JSON lines: replay messages from newline delimited JSON files.
+
+The strategy to replay messages is:
+    - expand the configured glob patterns into a sorted list of files
+    - read each file in large chunks (decompressing it if its name ends with
+      `.gz`) and split the chunks into lines
+    - decode every line and send it through the signal for its exchange, which
+      is either the value of a key field in the message or the exchange for
+      which the files were configured
+
+Messages are sent from the thread that reads the files, so they are read as
+fast as the output can absorb them (writer queues block when they're full) or
+at a target rate if one is set.
+
+"""
+
+import glob
+import gzip
+import io
+import logging
+import threading
+import time
+
+from typing import (  # noqa
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from rabbithole.decoders import get_decoder
+from rabbithole.metrics import (
+    DECODE_ERRORS,
+    DECODE_SECONDS,
+    MESSAGES_RECEIVED,
+    perf_counter,
+)
+from rabbithole.projection import (
+    compile_projection,
+    project,
+)
+from rabbithole.scheduler import monotonic
+from rabbithole.signals import Signal
+
+LOGGER = logging.getLogger(__name__)
+
+
+class JsonLinesReader(object):
+
+    """Replay messages from newline delimited JSON files.
+
+    :param paths:
+        Glob patterns of the files whose messages are sent through the signal
+        for the exchange in their key field (or through every signal if no
+        key field is set)
+    :type paths: str | list(str) | None
+    :param key: Dotted path to the field with the exchange name
+    :type key: str | None
+    :param rate: Maximum number of messages per second (no limit by default)
+    :type rate: float | None
+    :param decoder:
+        JSON decoder backend name or `auto` to use the fastest one installed
+    :type decoder: str
+    :param buffer_size: Size of the chunks read from the files in bytes
+    :type buffer_size: int
+
+    """
+
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(
+            self,
+            paths=None,  # type: Union[str, List[str], None]
+            key=None,  # type: Optional[str]
+            rate=None,  # type: Optional[float]
+            decoder='auto',  # type: str
+            buffer_size=None,  # type: Optional[int]
+            ):
+        # type: (...) -> None
+        """Initialize internal data structures."""
+        self.decoder, self.decode = get_decoder(decoder)
+        self.paths = to_list(paths)
+        self.key = key.split('.') if key else None
+        self.rate = rate
+        self.buffer_size = buffer_size or self.DEFAULT_BUFFER_SIZE
+        self.signals = {}  # type: Dict[str, Signal]
+        self.exchange_paths = []  # type: List[Tuple[str, List[str]]]
+        self.exchange_fields = {}  # type: Dict[str, Optional[Set[str]]]
+        self.projections = {}  # type: Dict[str, Dict[str, Any]]
+        self.metrics = {}  # type: Dict[str, Tuple[Any, Any, Any]]
+        self.sent = 0
+        self.started = 0.0
+        self.stopping = threading.Event()
+        self.finished = threading.Event()
+
+    def __call__(self, exchange, paths=None, fields=None):
+        # type: (str, Union[str, List[str], None], Optional[List[str]]) -> Signal  # noqa
+        """Create signal to send when a message for an exchange is read.
+
+        :param exchange: Exchange name
+        :type exchange: str
+        :param paths:
+            Glob patterns of the files whose messages are all sent through
+            this signal
+        :type paths: str | list(str) | None
+        :param fields:
+            Dotted paths to the message fields used by the flow or None if
+            the whole messages are used
+        :type fields: list(str) | None
+        :returns: The signal that will be send, so that it can be connected
+        :rtype: :class:`rabbithole.signals.Signal`
+
+        """
+        self.add_fields(exchange, fields)
+        if paths is not None:
+            self.exchange_paths.append((exchange, to_list(paths)))
+        if exchange in self.signals:
+            return self.signals[exchange]
+
+        self.metrics[exchange] = (
+            MESSAGES_RECEIVED.labels(exchange),
+            DECODE_SECONDS.labels(exchange),
+            DECODE_ERRORS.labels(exchange),
+        )
+        signal = Signal()
+        self.signals[exchange] = signal
+        return signal
+
+    def add_fields(self, exchange, fields):
+        # type: (str, Optional[List[str]]) -> None
+        """Add fields to keep from the messages sent for an exchange.
+
+        Messages are only projected if all the flows for the exchange set the
+        fields they use.
+
+        :param exchange: Exchange name
+        :type exchange: str
+        :param fields: Dotted paths to the fields used by a flow
+        :type fields: list(str) | None
+
+        """
+        exchange_fields = self.exchange_fields.get(exchange, set())
+        if fields is None or exchange_fields is None:
+            self.exchange_fields[exchange] = None
+            self.projections.pop(exchange, None)
+            return
+
+        exchange_fields.update(fields)
+        self.exchange_fields[exchange] = exchange_fields
+        self.projections[exchange] = compile_projection(exchange_fields)
+
+    def run(self):
+        # type: () -> None
+        """Read all the files and send their messages."""
+        start = self.started = monotonic()
+        files = [
+            (filename, None) for filename in expand(self.paths)
+        ]  # type: List[Tuple[str, Optional[str]]]
+        for path_exchange, paths in self.exchange_paths:
+            files.extend(
+                (filename, path_exchange) for filename in expand(paths))
+        try:
+            for filename, exchange in files:
+                if self.stopping.is_set():
+                    break
+                self.read_file(filename, exchange)
+        finally:
+            self.finished.set()
+
+        elapsed = monotonic() - start
+        LOGGER.info(
+            'Replay finished: %d messages in %.2f seconds (%.0f messages/s)',
+            self.sent,
+            elapsed,
+            self.sent / elapsed if elapsed else 0,
+        )
+
+    def stop(self, timeout=None):
+        # type: (Optional[float]) -> None
+        """Stop reading files after the message being sent.
+
+        :param timeout: Maximum number of seconds to wait for the reader
+        :type timeout: float | None
+
+        """
+        self.stopping.set()
+        if not self.finished.wait(timeout):
+            LOGGER.warning('Timeout while waiting for replay to stop')
+
+    def close(self, timeout=None):
+        # type: (Optional[float]) -> None
+        """Nothing to close since files are closed as soon as they're read.
+
+        :param timeout: Unused, since there's nothing to wait for
+        :type timeout: float | None
+
+        """
+
+    def read_file(self, filename, exchange):
+        # type: (str, Optional[str]) -> None
+        """Send the messages in a file.
+
+        :param filename: Path to the file
+        :type filename: str
+        :param exchange:
+            Exchange for all the messages or None to get it from the key field
+            of each message
+        :type exchange: str | None
+
+        """
+        LOGGER.info('Reading %r...', filename)
+        if filename.endswith('.gz'):
+            file_ = gzip.open(filename, 'rb')  # type: Any
+        else:
+            file_ = io.open(filename, 'rb')
+        with file_:
+            for line in read_lines(file_, self.buffer_size):
+                if self.stopping.is_set():
+                    LOGGER.info('Replay stopped while reading %r', filename)
+                    return
+                if self.rate:
+                    self.throttle()
+                self.line_received(line, exchange)
+
+    def line_received(self, line, exchange):
+        # type: (bytes, Optional[str]) -> None
+        """Decode line and send message through the signal for its exchange.
+
+        :param line: Line with a JSON document
+        :type line: bytes
+        :param exchange:
+            Exchange for the message or None to get it from its key field
+        :type exchange: str | None
+
+        """
+        start = perf_counter()
+        try:
+            payload = self.decode(line)
+        except ValueError:
+            LOGGER.warning('Line decoding error: %r', line)
+            if exchange in self.metrics:
+                self.metrics[exchange][2].inc()
+            return
+        elapsed = perf_counter() - start
+
+        if exchange is not None:
+            exchanges = [exchange]  # type: List[str]
+        elif self.key is not None:
+            key = get_key(payload, self.key)
+            if isinstance(key, (list, dict)):
+                LOGGER.error('Invalid exchange in key field: %r', key)
+                return
+            exchanges = [key]
+        else:
+            exchanges = list(self.signals)
+
+        for name in exchanges:
+            signal = self.signals.get(name)
+            if signal is None:
+                continue
+            received, decode_seconds, _decode_errors = self.metrics[name]
+            received.inc()
+            decode_seconds.observe(elapsed)
+            projection = self.projections.get(name)
+            signal.send(
+                self,
+                payload=(
+                    payload if projection is None
+                    else project(payload, projection)
+                ),
+                size=len(line),
+            )
+        self.sent += 1
+
+    def throttle(self):
+        # type: () -> None
+        """Wait until sending the next message doesn't exceed the rate."""
+        if not self.rate:
+            return
+        delay = self.started + self.sent / float(self.rate) - monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def read_lines(file_, buffer_size):
+    # type: (Any, int) -> Iterator[bytes]
+    """Read file in chunks and split them into non empty lines.
+
+    :param file_: File opened in binary mode
+    :type file_: file
+    :param buffer_size: Size of the chunks in bytes
+    :type buffer_size: int
+    :returns: Lines without the line terminator
+    :rtype: iterator(bytes)
+
+    """
+    pending = b''
+    while True:
+        chunk = file_.read(buffer_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line
+    if pending.strip():
+        yield pending
+
+
+def expand(patterns):
+    # type: (List[str]) -> List[str]
+    """Expand glob patterns into file names.
+
+    :param patterns: Glob patterns
+    :type patterns: list(str)
+    :returns: Sorted file names for each pattern in order
+    :rtype: list(str)
+
+    """
+    filenames = []  # type: List[str]
+    seen = set()  # type: Set[str]
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            LOGGER.warning('No files found: %r', pattern)
+        for filename in matches:
+            if filename not in seen:
+                seen.add(filename)
+                filenames.append(filename)
+    return filenames
+
+
+def get_key(payload, keys):
+    # type: (Any, List[str]) -> Any
+    """Get value from a message.
+
+    :param payload: Decoded message
+    :type payload: object
+    :param keys: Keys in the path to the value
+    :type keys: list(str)
+    :returns: Value or None if the message doesn't have it
+    :rtype: object
+
+    """
+    for key in keys:
+        if not isinstance(payload, dict):
+            return None
+        payload = payload.get(key)
+    return payload
+
+
+def to_list(paths):
+    # type: (Union[str, List[str], None]) -> List[str]
+    """Get list of glob patterns.
+
+    :param paths: A single pattern, a list of them or None
+    :type paths: str | list(str) | None
+    :returns: Patterns
+    :rtype: list(str)
+
+    """
+    if paths is None:
+        return []
+    if isinstance(paths, list):
+        return paths
+    return [paths]
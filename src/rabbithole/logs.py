@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Logs: keep logging out of the message processing hot path.
+
+The strategy to log without slowing down message processing is:
+    - format expensive messages only if their level is enabled
+    - limit the rate of messages that are logged for every single message
+      received
+    - write records to the handlers from a listener thread, so that slow
+      file or terminal output doesn't block the threads that log them
+
+"""
+
+import logging  # noqa
+import multiprocessing.util
+import os
+import threading
+
+from functools import partial
+
+from six.moves import queue
+from typing import (  # noqa
+    Callable,
+    List,
+    Optional,
+)
+
+from rabbithole.scheduler import monotonic
+
+try:
+    from logging.handlers import (
+        QueueHandler,
+        QueueListener,
+    )
+except ImportError:  # python 2
+    QueueHandler = QueueListener = None  # type: ignore
+
+
+class RateLimiter(object):
+
+    """Allow at most a number of events per second.
+
+    :param rate: Maximum number of events per second
+    :type rate: int
+    :param clock: Function that returns current time in seconds
+    :type clock: callable
+
+    """
+
+    def __init__(self, rate, clock=None):
+        # type: (int, Optional[Callable[[], float]]) -> None
+        """Initialize counters."""
+        self.rate = rate
+        self.clock = clock or monotonic
+        self.lock = threading.Lock()
+        self.second = None  # type: Optional[int]
+        self.count = 0
+        self.suppressed = 0
+
+    def allow(self):
+        # type: () -> Optional[int]
+        """Check if an event is allowed.
+
+        :returns:
+            Number of events suppressed since the last one that was allowed
+            or None if the event isn't allowed
+        :rtype: int | None
+
+        """
+        second = int(self.clock())
+        with self.lock:
+            if second != self.second:
+                self.second = second
+                self.count = 0
+            if self.count >= self.rate:
+                self.suppressed += 1
+                return None
+            self.count += 1
+            suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+
+def start_queue_listener(logger, handlers):
+    # type: (logging.Logger, List[logging.Handler]) -> Optional[QueueListener]
+    """Write records to handlers from a listener thread.
+
+    The logger gets a handler that puts records in a queue from which a
+    listener thread gets them and passes them to the actual handlers. In
+    python 2, where queue handlers aren't available, handlers are added
+    directly to the logger.
+
+    :param logger: Logger to which handlers would be added
+    :type logger: logging.Logger
+    :param handlers: Handlers that write records
+    :type handlers: list(logging.Handler)
+    :returns: Listener that writes records or None in python 2
+    :rtype: logging.handlers.QueueListener | None
+
+    """
+    if QueueHandler is None:
+        for handler in handlers:
+            logger.addHandler(handler)
+        return None
+
+    queue_handler = QueueHandler(queue.Queue())
+    logger.addHandler(queue_handler)
+    listener = create_listener(queue_handler, handlers)
+
+    # The listener thread isn't copied when the process is forked
+    # (for example, for worker processes), so a new one is needed
+    register_at_fork = getattr(os, 'register_at_fork', None)
+    if register_at_fork is not None:
+        register_at_fork(after_in_child=partial(
+            create_child_listener, queue_handler, handlers))
+    return listener
+
+
+def create_child_listener(queue_handler, handlers):
+    # type: (QueueHandler, List[logging.Handler]) -> QueueListener
+    """Start listener thread in a forked process.
+
+    The listener is stopped when the process exits, so that the records
+    logged just before a worker process exits are written.
+
+    :param queue_handler: Handler that puts records in a queue
+    :type queue_handler: logging.handlers.QueueHandler
+    :param handlers: Handlers that write records
+    :type handlers: list(logging.Handler)
+    :returns: Listener that writes records
+    :rtype: logging.handlers.QueueListener
+
+    """
+    listener = create_listener(queue_handler, handlers)
+    stop_at_exit(listener)
+    # Worker processes clear the exit finalizers when they start
+    multiprocessing.util.register_after_fork(listener, stop_at_exit)
+    return listener
+
+
+def stop_at_exit(listener):
+    # type: (QueueListener) -> None
+    """Stop listener thread when the process exits.
+
+    An exit finalizer is used instead of an atexit handler, since
+    multiprocessing doesn't run atexit handlers in worker processes.
+
+    :param listener: Listener that writes records
+    :type listener: logging.handlers.QueueListener
+
+    """
+    multiprocessing.util.Finalize(None, listener.stop, exitpriority=0)
+
+
+def create_listener(queue_handler, handlers):
+    # type: (QueueHandler, List[logging.Handler]) -> QueueListener
+    """Start listener thread for the records from a queue handler.
+
+    :param queue_handler: Handler that puts records in a queue
+    :type queue_handler: logging.handlers.QueueHandler
+    :param handlers: Handlers that write records
+    :type handlers: list(logging.Handler)
+    :returns: Listener that writes records
+    :rtype: logging.handlers.QueueListener
+
+    """
+    queue_handler.queue = queue.Queue()
+    listener = QueueListener(
+        queue_handler.queue,
+        *handlers,
+        respect_handler_level=True
+    )
+    listener.start()
+    return listener
@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+
+"""Metrics: measure throughput and latency of every stage in the flows.
+
+The strategy to measure the flows without slowing them down is:
+    - keep counters and histograms in memory, labelled by exchange or flow
+    - get the labelled values once, when an exchange or a flow is created, so
+      that updating them is just an addition under a lock
+    - render the values in the Prometheus text format only when they are
+      requested through the optional HTTP server
+
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from six.moves import (
+    BaseHTTPServer,
+    socketserver,
+)
+from typing import (  # noqa
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+#: High resolution clock used to measure latencies (python 3)
+perf_counter = getattr(time, 'perf_counter', time.time)
+
+#: Histogram buckets for latencies in seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+#: Histogram buckets for batch sizes in number of messages
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class CounterValue(object):
+
+    """Value that can only go up."""
+
+    def __init__(self):
+        # type: () -> None
+        """Initialize value."""
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        # type: (float) -> None
+        """Increment value.
+
+        :param amount: Amount to add
+        :type amount: float
+
+        """
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        # type: (str, str) -> List[str]
+        """Get lines in the text format.
+
+        :param name: Metric name
+        :type name: str
+        :param labels: Formatted labels
+        :type labels: str
+        :returns: Sample lines
+        :rtype: list(str)
+
+        """
+        return ['{}{} {!r}'.format(name, wrap_labels(labels), self.value)]
+
+
+class HistogramValue(object):
+
+    """Distribution of observed values in buckets.
+
+    :param buckets: Upper bounds of the buckets in ascending order
+    :type buckets: tuple(float)
+
+    """
+
+    def __init__(self, buckets):
+        # type: (Sequence[float]) -> None
+        """Initialize counts."""
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        # Last count is for the values above the highest bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # type: (float) -> None
+        """Add value to its bucket.
+
+        :param value: Observed value
+        :type value: float
+
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        # type: (str, str) -> List[str]
+        """Get lines in the text format.
+
+        :param name: Metric name
+        :type name: str
+        :param labels: Formatted labels
+        :type labels: str
+        :returns: Sample lines
+        :rtype: list(str)
+
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        separator = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                name, labels, separator, bound, cumulative))
+        lines.append('{}_sum{} {!r}'.format(name, wrap_labels(labels), total))
+        lines.append('{}_count{} {}'.format(
+            name, wrap_labels(labels), cumulative))
+        return lines
+
+
+class Metric(object):
+
+    """Group of values with the same name and different label values.
+
+    :param name: Metric name
+    :type name: str
+    :param documentation: Description of the metric
+    :type documentation: str
+    :param labelnames: Label names
+    :type labelnames: list(str)
+
+    """
+
+    TYPE = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        # type: (str, str, Sequence[str]) -> None
+        """Initialize values."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # type: Dict[Tuple[str, ...], Any]
+
+    def labels(self, *labelvalues):
+        # type: (*Any) -> Any
+        """Get value for some label values creating it if needed.
+
+        :param labelvalues: One value per label name
+        :type labelvalues: list(str)
+        :returns: Value that can be updated
+        :rtype: CounterValue | HistogramValue
+
+        """
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('Expected label values for: {}'.format(
+                ', '.join(self.labelnames)))
+        key = tuple(str(value) for value in labelvalues)
+        value = self.values.get(key)
+        if value is None:
+            with self.lock:
+                value = self.values.get(key)
+                if value is None:
+                    value = self.create_value()
+                    self.values[key] = value
+        return value
+
+    def create_value(self):
+        # type: () -> Any
+        """Create value for a new set of label values.
+
+        :returns: New value
+        :rtype: CounterValue | HistogramValue
+
+        """
+        raise NotImplementedError
+
+    def render(self):
+        # type: () -> List[str]
+        """Get lines in the text format.
+
+        :returns: Lines with the metric description and all its values
+        :rtype: list(str)
+
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, escape(self.documentation)),
+            '# TYPE {} {}'.format(self.name, self.TYPE),
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for labelvalues, value in values:
+            labels = ','.join(
+                '{}="{}"'.format(labelname, escape(labelvalue, quote=True))
+                for labelname, labelvalue in zip(self.labelnames, labelvalues)
+            )
+            lines.extend(value.samples(self.name, labels))
+        return lines
+
+
+class Counter(Metric):
+
+    """Metric whose values can only go up."""
+
+    TYPE = 'counter'
+
+    def create_value(self):
+        # type: () -> CounterValue
+        """Create counter value.
+
+        :returns: New value
+        :rtype: CounterValue
+
+        """
+        return CounterValue()
+
+
+class Histogram(Metric):
+
+    """Metric whose values are distributions of observations.
+
+    :param name: Metric name
+    :type name: str
+    :param documentation: Description of the metric
+    :type documentation: str
+    :param labelnames: Label names
+    :type labelnames: list(str)
+    :param buckets: Upper bounds of the buckets in ascending order
+    :type buckets: tuple(float)
+
+    """
+
+    TYPE = 'histogram'
+
+    def __init__(
+            self,
+            name,  # type: str
+            documentation,  # type: str
+            labelnames=(),  # type: Sequence[str]
+            buckets=LATENCY_BUCKETS,  # type: Sequence[float]
+            ):
+        # type: (...) -> None
+        """Initialize values."""
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def create_value(self):
+        # type: () -> HistogramValue
+        """Create histogram value.
+
+        :returns: New value
+        :rtype: HistogramValue
+
+        """
+        return HistogramValue(self.buckets)
+
+
+class Registry(object):
+
+    """Collection of metrics that are rendered together."""
+
+    def __init__(self):
+        # type: () -> None
+        """Initialize metrics."""
+        self.lock = threading.Lock()
+        self.metrics = {}  # type: Dict[str, Metric]
+
+    def register(self, metric):
+        # type: (Metric) -> None
+        """Add metric.
+
+        :param metric: Metric to add
+        :type metric: Metric
+        :raises ValueError: If there's already a metric with the same name
+
+        """
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(
+                    'Metric already registered: {!r}'.format(metric.name))
+            self.metrics[metric.name] = metric
+
+    def counter(self, name, documentation, labelnames=()):
+        # type: (str, str, Sequence[str]) -> Counter
+        """Create and add counter.
+
+        :param name: Metric name
+        :type name: str
+        :param documentation: Description of the metric
+        :type documentation: str
+        :param labelnames: Label names
+        :type labelnames: list(str)
+        :returns: Counter
+        :rtype: Counter
+
+        """
+        counter = Counter(name, documentation, labelnames)
+        self.register(counter)
+        return counter
+
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        # type: (str, str, Sequence[str], Optional[Sequence[float]]) -> Histogram  # noqa
+        """Create and add histogram.
+
+        :param name: Metric name
+        :type name: str
+        :param documentation: Description of the metric
+        :type documentation: str
+        :param labelnames: Label names
+        :type labelnames: list(str)
+        :param buckets:
+            Upper bounds of the buckets (:data:`LATENCY_BUCKETS` by default)
+        :type buckets: tuple(float) | None
+        :returns: Histogram
+        :rtype: Histogram
+
+        """
+        histogram = Histogram(
+            name, documentation, labelnames, buckets or LATENCY_BUCKETS)
+        self.register(histogram)
+        return histogram
+
+    def render(self):
+        # type: () -> str
+        """Get all metrics in the Prometheus text format.
+
+        :returns: Metrics exposition
+        :rtype: str
+
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for _name, metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value, quote=False):
+    # type: (str, bool) -> str
+    """Escape text for the Prometheus text format.
+
+    :param value: Text to escape
+    :type value: str
+    :param quote: Whether double quotes have to be escaped (label values)
+    :type quote: bool
+    :returns: Escaped text
+    :rtype: str
+
+    """
+    value = value.replace('\\', r'\\').replace('\n', r'\n')
+    if quote:
+        value = value.replace('"', r'\"')
+    return value
+
+
+def wrap_labels(labels):
+    # type: (str) -> str
+    """Wrap formatted labels in braces unless there aren't any.
+
+    :param labels: Formatted labels
+    :type labels: str
+    :returns: Labels ready to be appended to a metric name
+    :rtype: str
+
+    """
+    return '{{{}}}'.format(labels) if labels else ''
+
+
+#: Registry for the metrics of the flows
+REGISTRY = Registry()
+
+MESSAGES_RECEIVED = REGISTRY.counter(
+    'rabbithole_messages_received_total',
+    'Messages received by the input blocks',
+    ['exchange'],
+)
+DECODE_ERRORS = REGISTRY.counter(
+    'rabbithole_decode_errors_total',
+    'Messages whose body could not be decoded',
+    ['exchange'],
+)
+DECODE_SECONDS = REGISTRY.histogram(
+    'rabbithole_decode_seconds',
+    'Time spent decoding message bodies',
+    ['exchange'],
+)
+BATCH_SIZE = REGISTRY.histogram(
+    'rabbithole_batch_size',
+    'Number of messages in each batch sent to the output',
+    ['flow'],
+    SIZE_BUCKETS,
+)
+BATCH_FLUSHES = REGISTRY.counter(
+    'rabbithole_batch_flushes_total',
+    'Batches sent to the output by the limit that was exceeded',
+    ['flow', 'reason'],
+)
+EXECUTE_SECONDS = REGISTRY.histogram(
+    'rabbithole_sql_execute_seconds',
+    'Time spent writing each batch to the database',
+    ['flow'],
+)
+ROWS_WRITTEN = REGISTRY.counter(
+    'rabbithole_rows_written_total',
+    'Rows written to the database',
+    ['flow'],
+)
+ROWS_REJECTED = REGISTRY.counter(
+    'rabbithole_rows_rejected_total',
+    'Rows rejected by the database',
+    ['flow'],
+)
+BATCH_ERRORS = REGISTRY.counter(
+    'rabbithole_batch_errors_total',
+    'Batches that could not be written to the database',
+    ['flow'],
+)
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serve the metrics in a registry."""
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        # type: () -> None
+        """Send metrics exposition."""
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')  # type: ignore
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        # type: (str, *Any) -> None
+        """Log requests at debug level instead of writing them to stderr."""
+        LOGGER.debug('Metrics request: ' + format, *args)
+
+
+class MetricsServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """HTTP server that serves the metrics in a registry.
+
+    :param address: Address and port to listen to
+    :type address: tuple(str, int)
+    :param registry: Registry with the metrics to serve
+    :type registry: Registry
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, registry):
+        # type: (Tuple[str, int], Registry) -> None
+        """Bind socket."""
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, MetricsRequestHandler)
+        self.registry = registry
+
+
+def start_http_server(port, address='127.0.0.1', registry=None):
+    # type: (int, str, Optional[Registry]) -> MetricsServer
+    """Serve metrics from a daemon thread.
+
+    :param port: Port to listen to
+    :type port: int
+    :param address: Address to listen to (only local connections by default)
+    :type address: str
+    :param registry: Registry with the metrics (:data:`REGISTRY` by default)
+    :type registry: Registry | None
+    :returns: Server, which can be stopped with its `shutdown` method
+    :rtype: MetricsServer
+
+    """
+    server = MetricsServer((address, port), registry or REGISTRY)
+    thread = threading.Thread(name='metrics', target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    LOGGER.info(
+        'Serving metrics on http://%s:%d/metrics',
+        address,
+        server.server_address[1],
+    )
+    return server
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Projection: keep only the message fields that are used by the flows.
+
+The strategy to project messages is:
+    - collect the dotted paths that the output blocks read from the messages
+      (for example, the paths in the sql block parameters)
+    - compile them into a tree of keys when the flows are created
+    - keep only the values in that tree when a message is received
+
+This way, batches only hold the fields that are actually written instead of
+the whole messages, which reduces memory usage when messages are wide.
+
+"""
+
+from typing import (  # noqa
+    Any,
+    Dict,
+    Iterable,
+)
+
+
+def compile_projection(fields):
+    # type: (Iterable[str]) -> Dict[str, Any]
+    """Compile dotted paths into a tree of keys.
+
+    :param fields: Dotted paths to the values to keep
+    :type fields: list(str)
+    :returns:
+        Tree of keys in which leaves are set to None to keep the whole value
+    :rtype: dict(str)
+
+    """
+    tree = {}  # type: Dict[str, Any]
+    for field in fields:
+        keys = field.split('.')
+        node = tree
+        for key in keys[:-1]:
+            child = node.get(key, {})
+            if child is None:
+                # Whole value is already kept
+                break
+            node[key] = child
+            node = child
+        else:
+            node[keys[-1]] = None
+    return tree
+
+
+def project(message, tree):
+    # type: (Any, Dict[str, Any]) -> Any
+    """Keep only the values in the projection tree.
+
+    :param message: Decoded message
+    :type message: object
+    :param tree: Projection tree returned by :func:`compile_projection`
+    :type tree: dict(str)
+    :returns: Message with only the values in the tree
+    :rtype: object
+
+    """
+    if not isinstance(message, dict):
+        return message
+    projected = {}
+    for key, subtree in tree.items():
+        if key not in message:
+            continue
+        value = message[key]
+        if subtree is None:
+            projected[key] = value
+        elif isinstance(value, dict):
+            projected[key] = project(value, subtree)
+    return projected
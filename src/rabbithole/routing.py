@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""Routing: bind queues to the subset of messages that the flows need.
+
+The strategy to route messages is:
+    - bind the queue to the exchange with the routing keys (or topic patterns)
+      and the header arguments set by each flow, so that the server drops the
+      messages that no flow needs
+    - since a queue gets a single copy of each message even if it matches
+      several bindings, match the routing key and headers of every message
+      received against the bindings to find out to which flows it belongs
+
+Bindings without routing keys or header arguments match all messages, which
+is what fanout exchanges do.
+
+"""
+
+import re
+
+import six
+
+from typing import (  # noqa
+    Any,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    Union,
+)
+
+
+class Binding(object):
+
+    """Routing keys or header arguments with which a queue is bound.
+
+    :param exchange_type:
+        Exchange type (`direct`, `topic`, `headers` or `fanout`), used to
+        decide how the routing keys are matched
+    :type exchange_type: str | None
+    :param routing_keys: Routing keys or topic patterns
+    :type routing_keys: str | list(str) | None
+    :param arguments:
+        Binding arguments, such as the headers to match and `x-match`
+    :type arguments: dict(str) | None
+
+    """
+
+    def __init__(self, exchange_type=None, routing_keys=None, arguments=None):
+        # type: (Optional[str], Union[str, List[str], None], Optional[Dict[str, Any]]) -> None  # noqa
+        """Compile routing keys."""
+        if isinstance(routing_keys, six.string_types):
+            routing_keys = [routing_keys]
+        self.exchange_type = exchange_type
+        self.routing_keys = sorted(routing_keys or [])
+        self.arguments = arguments or {}
+        self.key = (
+            tuple(self.routing_keys),
+            tuple(sorted(
+                (name, repr(value))
+                for name, value in self.arguments.items()
+            )),
+        )  # type: Tuple
+        # Fanout exchanges ignore routing keys and arguments
+        self.match_all = (
+            exchange_type == 'fanout' or
+            not (self.routing_keys or self.arguments)
+        )
+
+        self.patterns = None  # type: Optional[List[Pattern]]
+        if self.routing_keys and exchange_type == 'topic':
+            self.patterns = [
+                compile_topic(routing_key)
+                for routing_key in self.routing_keys
+            ]
+
+    def matches(self, routing_key, headers):
+        # type: (str, Optional[Dict[str, Any]]) -> bool
+        """Check if a message matches the binding.
+
+        :param routing_key: Message routing key
+        :type routing_key: str
+        :param headers: Message headers
+        :type headers: dict(str) | None
+        :returns: Whether the message was routed because of this binding
+        :rtype: bool
+
+        """
+        if self.match_all:
+            return True
+        if self.exchange_type == 'headers':
+            return match_headers(self.arguments, headers or {})
+        if self.patterns is not None:
+            return any(
+                pattern.match(routing_key) for pattern in self.patterns)
+        return routing_key in self.routing_keys
+
+
+def compile_topic(pattern):
+    # type: (str) -> Pattern
+    """Compile topic pattern into a regular expression.
+
+    Words are separated by dots, `*` matches exactly one word and `#` matches
+    zero or more words.
+
+    :param pattern: Topic pattern
+    :type pattern: str
+    :returns: Regular expression that matches the same routing keys
+    :rtype: re.Pattern
+
+    """
+    words = []  # type: List[str]
+    for word in pattern.split('.'):
+        # Consecutive `#` match the same keys as a single one
+        if not (word == '#' and words and words[-1] == '#'):
+            words.append(word)
+    if words == ['#']:
+        return re.compile('.*$')
+
+    regex = ''
+    for index, word in enumerate(words):
+        if word == '#':
+            if index:
+                regex += r'(?:\.[^.]*)*'
+            else:
+                regex += r'(?:[^.]*\.)*'
+            continue
+        # A leading `#` already matches the dot that follows it
+        if index and not (index == 1 and words[0] == '#'):
+            regex += r'\.'
+        regex += '[^.]*' if word == '*' else re.escape(word)
+    return re.compile(regex + '$')
+
+
+def match_headers(arguments, headers):
+    # type: (Dict[str, Any], Dict[str, Any]) -> bool
+    """Check if message headers match the binding arguments.
+
+    :param arguments:
+        Binding arguments. Values are compared with the headers and `x-match`
+        sets whether `all` (default) or `any` of them must be equal.
+    :type arguments: dict(str)
+    :param headers: Message headers
+    :type headers: dict(str)
+    :returns: Whether the headers match
+    :rtype: bool
+
+    """
+    matches = [
+        name in headers and (value is None or headers[name] == value)
+        for name, value in arguments.items()
+        if not name.startswith('x-')
+    ]
+    if arguments.get('x-match') == 'any':
+        return any(matches)
+    return all(matches)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+"""Scheduler: run callbacks after a delay from a single thread.
+
+The strategy to schedule callbacks is:
+    - keep them in a heap sorted by deadline
+    - wait in a single thread until the earliest deadline is reached
+    - mark cancelled callbacks and discard them when they reach the top of the
+      heap
+
+This makes possible to serve the time limits of every batcher without
+creating a new thread for each batch. Since callbacks share the same thread,
+they shouldn't block (see :func:`in_scheduled_callback`).
+
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from typing import (  # noqa
+    Callable,
+    List,
+    Optional,
+    Tuple,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# Use a monotonic clock when available (python 3)
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Whether a thread is running a scheduled callback
+_CALLBACK_STATE = threading.local()
+
+
+class ScheduledCall(object):
+
+    """Callback scheduled to run at a given time.
+
+    :param scheduler: Scheduler in which the callback has been scheduled
+    :type scheduler: Scheduler
+    :param deadline: Time at which the callback should run
+    :type deadline: float
+    :param callback: Function to run
+    :type callback: callable
+
+    """
+
+    __slots__ = ('scheduler', 'deadline', 'callback', 'cancelled')
+
+    def __init__(self, scheduler, deadline, callback):
+        # type: (Scheduler, float, Callable[[], None]) -> None
+        """Initialize call."""
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        # type: () -> None
+        """Cancel call so that the callback doesn't run."""
+        self.scheduler.cancel(self)
+
+
+class Scheduler(object):
+
+    """Run callbacks after a delay from a single thread.
+
+    :param clock: Function that returns current time in seconds
+    :type clock: callable
+    :param autostart:
+        Whether to start the scheduler thread when the first callback is
+        scheduled. If disabled, due callbacks only run when
+        :meth:`run_pending` is called.
+    :type autostart: bool
+
+    """
+
+    def __init__(self, clock=None, autostart=True):
+        # type: (Optional[Callable[[], float]], bool) -> None
+        """Initialize internal data structures."""
+        self.clock = clock or monotonic
+        self.autostart = autostart
+
+        self.heap = []  # type: List[Tuple[float, int, ScheduledCall]]
+        self.counter = itertools.count()
+        self.cancelled = 0
+        self.condition = threading.Condition()
+        self.thread = None  # type: Optional[threading.Thread]
+
+    def schedule(self, delay, callback):
+        # type: (float, Callable[[], None]) -> ScheduledCall
+        """Schedule callback to run after a delay.
+
+        :param delay: Delay in seconds
+        :type delay: float
+        :param callback: Function to run
+        :type callback: callable
+        :returns: Scheduled call that can be cancelled
+        :rtype: ScheduledCall
+
+        """
+        call = ScheduledCall(self, self.clock() + delay, callback)
+        with self.condition:
+            item = (call.deadline, next(self.counter), call)
+            heapq.heappush(self.heap, item)
+            # Wake up scheduler thread only if deadline is the earliest one
+            if self.heap[0][2] is call:
+                self.condition.notify()
+            if self.autostart and self.thread is None:
+                self.start()
+        return call
+
+    def cancel(self, call):
+        # type: (ScheduledCall) -> None
+        """Cancel scheduled call.
+
+        :param call: Scheduled call
+        :type call: ScheduledCall
+
+        """
+        with self.condition:
+            if call.cancelled:
+                return
+            call.cancelled = True
+            self.cancelled += 1
+
+            # Discard cancelled calls when they are most of the heap
+            if self.cancelled > len(self.heap) // 2:
+                self.heap = [
+                    item for item in self.heap
+                    if not item[2].cancelled
+                ]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    def start(self):
+        # type: () -> None
+        """Start scheduler thread."""
+        thread = threading.Thread(name='scheduler', target=self.run)
+        thread.daemon = True
+        thread.start()
+        self.thread = thread
+
+    def run(self):
+        # type: () -> None
+        """Run callbacks as their deadlines are reached."""
+        while True:
+            self.run_pending()
+            # Check heap again since it might have changed
+            # while callbacks were running
+            with self.condition:
+                if self.heap:
+                    timeout = self.heap[0][0] - self.clock()
+                    if timeout > 0:
+                        self.condition.wait(timeout)
+                else:
+                    self.condition.wait()
+
+    def run_pending(self):
+        # type: () -> Optional[float]
+        """Run callbacks whose deadline has been reached.
+
+        :returns: Time until the next deadline or None if nothing is scheduled
+        :rtype: float | None
+
+        """
+        while True:
+            with self.condition:
+                now = self.clock()
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                    self.cancelled -= 1
+                if not self.heap:
+                    return None
+                deadline, _, call = self.heap[0]
+                if deadline > now:
+                    return deadline - now
+                heapq.heappop(self.heap)
+                # Mark as cancelled so that cancelling it later is a no-op
+                call.cancelled = True
+
+            _CALLBACK_STATE.running = True
+            try:
+                call.callback()
+            except Exception:  # pylint:disable=broad-except
+                LOGGER.exception('Scheduled callback error')
+            finally:
+                _CALLBACK_STATE.running = False
+
+
+def in_scheduled_callback():
+    # type: () -> bool
+    """Check if the current thread is running a scheduled callback.
+
+    Code that might block, such as queueing a batch for a busy output, uses
+    this to avoid delaying the rest of the callbacks.
+
+    :returns: Whether a scheduled callback is running in this thread
+    :rtype: bool
+
+    """
+    return getattr(_CALLBACK_STATE, 'running', False)
+
+
+_DEFAULT_SCHEDULER = None  # type: Optional[Scheduler]
+_DEFAULT_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_default_scheduler():
+    # type: () -> Scheduler
+    """Get scheduler shared by all the batchers.
+
+    :returns: Default scheduler
+    :rtype: Scheduler
+
+    """
+    global _DEFAULT_SCHEDULER  # pylint:disable=global-statement
+    with _DEFAULT_SCHEDULER_LOCK:
+        if _DEFAULT_SCHEDULER is None:
+            _DEFAULT_SCHEDULER = Scheduler()
+    return _DEFAULT_SCHEDULER
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Signals: send messages and batches to a single receiver directly.
+
+The strategy to reduce the cost of sending a signal is:
+    - keep track of whether the signal has exactly one receiver that is
+      strongly referenced and listens to any sender, which is the case for
+      the signals connected when a flow is created
+    - in that case, call the receiver directly instead of looking up the
+      receivers for the sender and dereferencing them
+
+Signals with several receivers, weakly referenced ones or receivers for
+specific senders keep the blinker behaviour.
+
+Receivers might be connected and disconnected from other threads while
+signals are being sent (for example, when flows are reloaded). Senders that
+need to know how many receivers get a message can take a snapshot of them
+first (see :meth:`Signal.get_receivers`).
+
+"""
+
+import blinker
+
+from typing import (  # noqa
+    Any,
+    Callable,
+    List,
+    Optional,
+    Tuple,
+)
+
+
+class Signal(blinker.Signal):
+
+    """Signal that calls its receiver directly when there's only one.
+
+    :param doc: Signal description
+    :type doc: str | None
+
+    """
+
+    def __init__(self, doc=None):
+        # type: (Optional[str]) -> None
+        """Initialize direct receiver."""
+        super(Signal, self).__init__(doc)
+        self.direct = None  # type: Optional[Callable]
+
+    def connect(self, receiver, sender=blinker.ANY, weak=True):
+        # type: (Callable, Any, bool) -> Callable
+        """Connect receiver and check if it can be called directly.
+
+        :param receiver: Callable invoked when the signal is sent
+        :type receiver: callable
+        :param sender: Sender whose signals are received (any by default)
+        :type sender: object
+        :param weak: Whether the signal holds a weak reference to the receiver
+        :type weak: bool
+        :returns: The receiver
+        :rtype: callable
+
+        """
+        result = super(Signal, self).connect(receiver, sender, weak)
+        if not weak and sender is blinker.ANY and len(self.receivers) == 1:
+            self.direct = receiver
+        else:
+            self.direct = None
+        return result
+
+    def send(self, *sender, **kwargs):
+        # type: (*Any, **Any) -> List[Tuple[Callable, Any]]
+        """Send signal on behalf of a sender.
+
+        :param sender: Object that sends the signal (None by default)
+        :type sender: object
+        :returns: Pairs of receiver and the value it returned
+        :rtype: list((callable, object))
+
+        """
+        direct = self.direct
+        # Receivers might have been disconnected since it was set
+        if direct is not None and len(sender) == 1 and (
+                len(self.receivers) == 1):
+            return [(direct, direct(sender[0], **kwargs))]
+        return super(Signal, self).send(*sender, **kwargs)
+
+    def get_receivers(self, sender):
+        # type: (Any) -> List[Callable]
+        """Get the receivers that the signal would be sent to right now.
+
+        :param sender: Object that sends the signal
+        :type sender: object
+        :returns: Receivers
+        :rtype: list(callable)
+
+        """
+        direct = self.direct
+        if direct is not None and len(self.receivers) == 1:
+            return [direct]
+        return list(self.receivers_for(sender))
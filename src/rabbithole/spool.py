@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+"""Spool: durable append-only queue of records on disk.
+
+The strategy to store records is:
+    - append them to memory mapped segment files that are preallocated with a
+      fixed size, so that appending a record is just a memory copy
+    - prefix each record with its length and checksum, so that a record that
+      was partially written when the process died is detected on restart
+    - create a new segment when the current one is full and remove segments
+      once all their records have been consumed
+    - store the position of the next record to consume in a checkpoint file
+
+This makes possible to accept batches at broker speed while the database is
+slow or unavailable and write them later, even after a restart.
+
+"""
+
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+from typing import (  # noqa
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+#: Record header: payload length and checksum
+HEADER = struct.Struct('>II')
+
+SEGMENT_NAME = '{:010d}.spool'
+SEGMENT_PATTERN = re.compile(r'^(\d{10})\.spool$')
+CHECKPOINT_NAME = 'checkpoint'
+
+# Atomic rename that overwrites destination (python 3)
+replace = getattr(os, 'replace', os.rename)
+
+
+class SpoolFull(Exception):
+
+    """Raised when a record doesn't fit in the spool."""
+
+
+class Segment(object):
+
+    """Memory mapped segment file.
+
+    :param path: Path to the segment file
+    :type path: str
+    :param size: Size of the file to create if it doesn't exist
+    :type size: int
+
+    """
+
+    def __init__(self, path, size):
+        # type: (str, int) -> None
+        """Open and map file into memory."""
+        self.path = path
+        with open(path, 'a+b') as file_:
+            file_.seek(0, os.SEEK_END)
+            if file_.tell() < size:
+                file_.truncate(size)
+        self.file = open(path, 'r+b')
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+    def read(self, offset):
+        # type: (int) -> Optional[Tuple[bytes, int]]
+        """Read record.
+
+        :param offset: Position of the record in the segment
+        :type offset: int
+        :returns:
+            Record payload and position of the next record or None if there
+            isn't a valid record at that position
+        :rtype: tuple(bytes, int) | None
+
+        """
+        if offset + HEADER.size > self.size:
+            return None
+        length, checksum = HEADER.unpack_from(self.map, offset)
+        start = offset + HEADER.size
+        end = start + length
+        if length == 0 or end > self.size:
+            return None
+        payload = self.map[start:end]
+        if zlib.crc32(payload) & 0xffffffff != checksum:
+            return None
+        return payload, end
+
+    def write(self, offset, payload):
+        # type: (int, bytes) -> int
+        """Write record.
+
+        :param offset: Position of the record in the segment
+        :type offset: int
+        :param payload: Record payload
+        :type payload: bytes
+        :returns: Position of the next record
+        :rtype: int
+
+        """
+        start = offset + HEADER.size
+        end = start + len(payload)
+        self.map[start:end] = payload
+        HEADER.pack_into(
+            self.map, offset, len(payload), zlib.crc32(payload) & 0xffffffff)
+        return end
+
+    def fits(self, offset, payload):
+        # type: (int, bytes) -> bool
+        """Check if there's room for a record.
+
+        :param offset: Position of the record in the segment
+        :type offset: int
+        :param payload: Record payload
+        :type payload: bytes
+        :returns: Whether the record fits in the segment
+        :rtype: bool
+
+        """
+        return offset + HEADER.size + len(payload) <= self.size
+
+    def has_data(self, offset):
+        # type: (int) -> bool
+        """Check if there's any data at a given position.
+
+        :param offset: Position in the segment
+        :type offset: int
+        :returns: Whether the record header at that position isn't empty
+        :rtype: bool
+
+        """
+        return (
+            offset + HEADER.size <= self.size and
+            HEADER.unpack_from(self.map, offset)[0] != 0
+        )
+
+    def clear(self, offset):
+        # type: (int) -> None
+        """Remove partially written data after a given position.
+
+        :param offset: Position after the last valid record
+        :type offset: int
+
+        """
+        self.map[offset:] = b'\0' * (self.size - offset)
+
+    def flush(self):
+        # type: () -> None
+        """Flush changes to disk."""
+        self.map.flush()
+
+    def close(self):
+        # type: () -> None
+        """Unmap and close file."""
+        self.map.close()
+        self.file.close()
+
+
+class Spool(object):
+
+    """Durable append-only queue of records on disk.
+
+    Records are appended from any thread and consumed in order by a single
+    reader, which commits them once they have been processed. Records that
+    were read but not committed are read again after a restart.
+
+    :param directory: Directory in which segment files are stored
+    :type directory: str
+    :param segment_size: Size of each segment file in bytes
+    :type segment_size: int
+    :param max_size: Maximum size of all the segment files in bytes
+    :type max_size: int | None
+    :param sync: Flush every record to disk after appending it
+    :type sync: bool
+
+    """
+
+    DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def __init__(
+            self,
+            directory,  # type: str
+            segment_size=None,  # type: Optional[int]
+            max_size=None,  # type: Optional[int]
+            sync=False,  # type: bool
+            ):
+        # type: (...) -> None
+        """Open existing segments and recover write position."""
+        self.directory = directory
+        self.segment_size = segment_size or self.DEFAULT_SEGMENT_SIZE
+        self.max_size = max_size
+        self.sync = sync
+        self.condition = threading.Condition()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.checkpoint = self.load_checkpoint()
+        self.segments = {}  # type: Dict[int, Segment]
+        numbers = self.list_segments()
+        for number in numbers:
+            if number < self.checkpoint[0]:
+                os.remove(self.segment_path(number))
+            else:
+                self.segments[number] = self.open_segment(number)
+        if not self.segments:
+            self.segments[self.checkpoint[0]] = (
+                self.open_segment(self.checkpoint[0]))
+
+        self.write_position = self.recover()
+        self.read_position = self.checkpoint
+
+    def segment_path(self, number):
+        # type: (int) -> str
+        """Get path to a segment file.
+
+        :param number: Segment number
+        :type number: int
+        :returns: Path to the segment file
+        :rtype: str
+
+        """
+        return os.path.join(self.directory, SEGMENT_NAME.format(number))
+
+    def list_segments(self):
+        # type: () -> List[int]
+        """Get numbers of the segment files in the spool directory.
+
+        :returns: Sorted segment numbers
+        :rtype: list(int)
+
+        """
+        numbers = []
+        for filename in os.listdir(self.directory):
+            match = SEGMENT_PATTERN.match(filename)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def open_segment(self, number, size=None):
+        # type: (int, Optional[int]) -> Segment
+        """Open segment file creating it if needed.
+
+        :param number: Segment number
+        :type number: int
+        :param size: Size of the file (segment size by default)
+        :type size: int | None
+        :returns: Segment
+        :rtype: Segment
+
+        """
+        return Segment(self.segment_path(number), size or self.segment_size)
+
+    def load_checkpoint(self):
+        # type: () -> Tuple[int, int]
+        """Load position of the next record to consume.
+
+        :returns: Segment number and offset
+        :rtype: tuple(int, int)
+
+        """
+        path = os.path.join(self.directory, CHECKPOINT_NAME)
+        if not os.path.isfile(path):
+            numbers = self.list_segments()
+            return (numbers[0] if numbers else 0, 0)
+        with open(path) as file_:
+            number, offset = file_.read().split()
+        return int(number), int(offset)
+
+    def recover(self):
+        # type: () -> Tuple[int, int]
+        """Find position after the last valid record.
+
+        Data after that position, if any, belongs to a record that was
+        partially written and is removed.
+
+        :returns: Segment number and offset
+        :rtype: tuple(int, int)
+
+        """
+        number = max(self.segments)
+        segment = self.segments[number]
+        offset = self.checkpoint[1] if number == self.checkpoint[0] else 0
+        while True:
+            record = segment.read(offset)
+            if record is None:
+                break
+            offset = record[1]
+        if segment.has_data(offset):
+            LOGGER.warning(
+                'Discarding partially written record in %r at %d',
+                segment.path,
+                offset,
+            )
+            segment.clear(offset)
+        return number, offset
+
+    @property
+    def size(self):
+        # type: () -> int
+        """Size of all the segment files in bytes."""
+        return sum(segment.size for segment in self.segments.values())
+
+    def append(self, record):
+        # type: (Any) -> None
+        """Append record.
+
+        :param record: JSON serializable record
+        :type record: object
+        :raises SpoolFull: If the spool maximum size would be exceeded
+
+        """
+        payload = json.dumps(record).encode('utf-8')
+        with self.condition:
+            number, offset = self.write_position
+            segment = self.segments[number]
+            if not segment.fits(offset, payload):
+                # Records bigger than a segment get their own segment
+                size = max(self.segment_size, HEADER.size * 2 + len(payload))
+                if self.max_size is not None and (
+                        self.size + size > self.max_size):
+                    raise SpoolFull(
+                        'Spool size limit reached: {}'.format(self.max_size))
+                segment.flush()
+                number, offset = number + 1, 0
+                segment = self.open_segment(number, size)
+                self.segments[number] = segment
+            offset = segment.write(offset, payload)
+            if self.sync:
+                segment.flush()
+            self.write_position = (number, offset)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        # type: (Optional[float]) -> Optional[Tuple[Tuple[int, int], Any]]
+        """Get next record waiting until one is available.
+
+        :param timeout: Maximum time to wait in seconds
+        :type timeout: float | None
+        :returns:
+            Position to commit once the record has been processed and the
+            record or None if no record was available before the timeout
+        :rtype: tuple(tuple(int, int), object) | None
+
+        """
+        with self.condition:
+            while self.read_position == self.write_position:
+                self.condition.wait(timeout)
+                if timeout is not None and (
+                        self.read_position == self.write_position):
+                    return None
+            number, offset = self.read_position
+            write_number = self.write_position[0]
+            segment = self.segments[number]
+
+        # Data before the write position doesn't change,
+        # so it can be read without holding the lock
+        while True:
+            record = segment.read(offset)
+            if record is not None:
+                payload, offset = record
+                self.read_position = (number, offset)
+                return self.read_position, json.loads(payload.decode('utf-8'))
+
+            # Only the last segment is being written
+            if number == write_number:
+                raise RuntimeError('Invalid record in {!r} at {}'.format(
+                    segment.path, offset))
+            if segment.has_data(offset):
+                LOGGER.error(
+                    'Skipping corrupted data in %r at %d',
+                    segment.path,
+                    offset,
+                )
+            with self.condition:
+                number, offset = number + 1, 0
+                segment = self.segments[number]
+
+    def commit(self, position):
+        # type: (Tuple[int, int]) -> None
+        """Mark records before a given position as consumed.
+
+        :param position: Position returned by :meth:`get`
+        :type position: tuple(int, int)
+
+        """
+        number, offset = position
+        path = os.path.join(self.directory, CHECKPOINT_NAME)
+        with open(path + '.tmp', 'w') as file_:
+            file_.write('{} {}'.format(number, offset))
+        replace(path + '.tmp', path)
+
+        with self.condition:
+            self.checkpoint = position
+            for old_number in [n for n in self.segments if n < number]:
+                segment = self.segments.pop(old_number)
+                segment.close()
+                os.remove(segment.path)
+
+    def close(self):
+        # type: () -> None
+        """Flush and close all segments."""
+        with self.condition:
+            for segment in self.segments.values():
+                segment.flush()
+                segment.close()
+            self.segments = {}
@@ -1,15 +1,43 @@
 # -*- coding: utf-8 -*-
 
-"""Database: run queries with batches of rows per exchange."""
+"""Database: run queries with batches of rows per exchange.
+
+By default, a single connection is shared by all the flows that use a database
+block. When a pool size is set, each batch is written using a connection from a
+pool, so that multiple batches can be written concurrently from different
+writer threads.
+
+Each batch is written in its own transaction. When that fails:
+    - transient errors (lost connections, deadlocks, ...) are retried with an
+      exponential backoff
+    - errors caused by the rows themselves (data or integrity errors) cause
+      the batch to be split in halves that are written recursively, so that
+      valid rows are still written and only the rows that fail on their own
+      are rejected
+    - any other error (a syntax error in the query, a missing table, ...)
+      fails the whole batch right away
+
+Optionally, batches can be appended to a spool on disk instead, so that they
+are accepted even when the database is slow or unavailable. A replayer thread
+writes them to the database in the same order and retries them until they are
+written. Batches that keep failing with errors that aren't transient are moved
+to a reject file in the spool directory, so that they don't block the batches
+spooled after them.
+
+"""
 
 import json
 import logging
+import os
+import threading
+import time
 import traceback
 
 from abc import (
     ABCMeta,
     abstractmethod,
 )
+from contextlib import contextmanager
 from functools import partial
 
 import six
@@ -18,16 +46,69 @@ from sqlalchemy import (
     create_engine,
     text,
 )
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import (
+    DataError,
+    IntegrityError,
+    OperationalError,
+    SQLAlchemyError,
+)
+from sqlalchemy.pool import QueuePool
 from typing import (  # noqa
+    Any,
+    Callable,
     Dict,
+    Iterator,
     List,
     Optional,
+    Tuple,
     Union,
 )
 
+from rabbithole.bulk import MultiRowInsert
+from rabbithole.metrics import (
+    BATCH_ERRORS,
+    EXECUTE_SECONDS,
+    ROWS_REJECTED,
+    ROWS_WRITTEN,
+    perf_counter,
+)
+from rabbithole.spool import (
+    Spool,
+    SpoolFull,
+)
+
 LOGGER = logging.getLogger(__name__)
 
+#: SQLSTATE codes of errors that might not happen again: connection
+#: exceptions (08xxx), serialization failures, deadlocks and server shutdowns
+TRANSIENT_SQLSTATES = frozenset([
+    '40001',
+    '40P01',
+    '57P01',
+    '57P02',
+    '57P03',
+])
+
+#: MySQL error codes of errors that might not happen again: lock wait
+#: timeouts, deadlocks, server shutdowns and lost connections
+TRANSIENT_MYSQL_CODES = frozenset([
+    1053,
+    1205,
+    1213,
+    2003,
+    2006,
+    2013,
+])
+
+#: SQLite error messages of errors that might not happen again
+TRANSIENT_SQLITE_MESSAGES = (
+    'database is locked',
+    'database table is locked',
+)
+
+#: File in the spool directory to which rejected spooled batches are appended
+REJECTED_NAME = 'rejected.jsonl'
+
 
 class Database(object):
 
@@ -35,67 +116,375 @@ class Database(object):
 
     :param url: Database connection string
     :type url: str
+    :param pool_size: Number of connections in the pool
+    :type pool_size: int | None
+    :param writers:
+        Number of batches that can be written in parallel (pool size by
+        default)
+    :type writers: int | None
+    :param retries: Number of times a transient error is retried
+    :type retries: int
+    :param retry_delay: Delay before the first retry in seconds
+    :type retry_delay: float
+    :param spool:
+        Keyword arguments to :class:`rabbithole.spool.Spool` to write batches
+        to a spool on disk before writing them to the database
+    :type spool: dict(str) | None
+    :param replay_attempts:
+        Number of times a spooled batch that fails with an error that isn't
+        transient is replayed before moving it to the reject file
+    :type replay_attempts: int
 
     """
 
-    def __init__(self, url):
-        # type: (str) -> None
+    MAX_REPLAY_DELAY = 30
+    # Seconds between checks for the database being closed while replaying
+    REPLAY_POLL_INTERVAL = 0.5
+
+    def __init__(
+            self,
+            url,  # type: str
+            pool_size=None,  # type: Optional[int]
+            writers=None,  # type: Optional[int]
+            retries=3,  # type: int
+            retry_delay=0.5,  # type: float
+            spool=None,  # type: Optional[Dict[str, Any]]
+            replay_attempts=10,  # type: int
+            ):
+        # type: (...) -> None
         """Create database engine."""
-        engine = create_engine(url)
-        self.connection = engine.connect()
+        if pool_size is None:
+            self.engine = create_engine(url)
+            self.connection = self.engine.connect()
+        else:
+            self.engine = create_engine(
+                url,
+                poolclass=QueuePool,
+                pool_size=pool_size,
+                max_overflow=0,
+            )
+            self.connection = None
+        self.lock = threading.Lock()
+        self.pool_size = pool_size
+        self.writers = writers or pool_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.replay_attempts = replay_attempts
         LOGGER.debug('Connected to: %r', url)
 
-    def __call__(self, query, parameters=None):
-        # type: (str, Optional[List]) -> partial
+        self.spool = None  # type: Optional[Spool]
+        self.replayer = None  # type: Optional[threading.Thread]
+        self.stopping = threading.Event()
+        if spool is not None:
+            self.spool = Spool(**spool)
+            self.replayer = threading.Thread(
+                name='spool-replayer',
+                target=self.replay,
+                args=(self.spool, ),
+            )
+            self.replayer.daemon = True
+            self.replayer.start()
+
+    def close(self, timeout=None):
+        # type: (Optional[float]) -> None
+        """Stop the spool replayer and close database connections.
+
+        Batches left in the spool are replayed by the next replayer that uses
+        the same spool directory.
+
+        :param timeout: Maximum number of seconds to wait for the replayer
+        :type timeout: float | None
+
+        """
+        self.stopping.set()
+        if self.replayer is not None:
+            self.replayer.join(timeout)
+            if self.replayer.is_alive():
+                LOGGER.warning('Timeout while waiting for spool replayer')
+        if self.spool is not None:
+            self.spool.close()
+        if self.connection is not None:
+            self.connection.close()
+        self.engine.dispose()
+        LOGGER.debug('Database connections closed')
+
+    @contextmanager
+    def connect(self):
+        # type: () -> Iterator[Any]
+        """Get connection to write a batch.
+
+        The shared connection is locked while in use, since connections
+        aren't thread safe. Pooled connections are returned to the pool
+        afterwards.
+
+        """
+        if self.connection is not None:
+            with self.lock:
+                yield self.connection
+            return
+
+        connection = self.engine.connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def __call__(
+            self,
+            query,  # type: str
+            parameters=None,  # type: Union[List, Dict, None]
+            multirow=False,  # type: bool
+            reject_query=None,  # type: Optional[str]
+            ):
+        # type: (...) -> partial
         """Return callback to use when a batch is ready.
 
+        If a spool is used, the callback appends batches to the spool and the
+        replayer thread writes them later.
+
+        :param query: The query to execute to insert the batch
+        :type query: str
+        :param parameters: Parameters to pass to the query on execution
+        :type parameters: list | dict | None
+        :param multirow:
+            Rewrite the single row INSERT query to insert multiple rows per
+            statement
+        :type multirow: bool
+        :param reject_query:
+            Query to execute for every rejected message with the message
+            serialized as JSON (`:message`) and the error (`:error`)
+        :type reject_query: str | None
+
+        """
+        flow = {  # type: Dict[str, Any]
+            'query': query,
+            'parameters': parameters,
+            'multirow': multirow,
+            'reject_query': reject_query,
+        }
+        if self.spool is not None:
+            return partial(self.spool_batch_cb, spool=self.spool, flow=flow)
+        return self.create_callback(**flow)
+
+    @staticmethod
+    def fields(query, parameters=None, **kwargs):
+        # type: (str, Union[List, Dict, None], **Any) -> Optional[List[str]]
+        """Get the message fields read by the callback for a flow.
+
         :param query: The query to execute to insert the batch
         :type query: str
         :param parameters: Parameters to pass to the query on execution
-        :type parameters: list | None
+        :type parameters: list | dict | None
+        :param kwargs: The rest of arguments used to create the callback
+        :type kwargs: dict(str)
+        :returns:
+            Dotted paths to the values used as parameters or None if the whole
+            messages are used
+        :rtype: list(str) | None
+
+        """
+        mapper = create_parameters_mapper(parameters)
+        if mapper is None:
+            return None
+        return mapper.fields
+
+    def create_callback(self, query, parameters, multirow, reject_query):
+        # type: (str, Union[List, Dict, None], bool, Optional[str]) -> partial
+        """Return callback that writes batches to the database.
+
+        :param query: The query to execute to insert the batch
+        :type query: str
+        :param parameters: Parameters to pass to the query on execution
+        :type parameters: list | dict | None
+        :param multirow:
+            Rewrite the single row INSERT query to insert multiple rows per
+            statement
+        :type multirow: bool
+        :param reject_query: Query to execute for every rejected message
+        :type reject_query: str | None
 
         """
         return partial(
             self.batch_ready_cb,
-            query=text(query),
-            parameters=parameters,
+            **compile_flow(query, parameters, multirow, reject_query)
         )
 
+    @staticmethod
+    def spool_batch_cb(sender, spool, flow, batch):
+        # type: (object, Spool, Dict[str, Any], List[Dict[str, Any]]) -> bool
+        """Append batch that is ready to the spool.
+
+        :param sender: The batcher who sent the batch_ready signal
+        :type sender: rabbithole.batcher.Batcher
+        :param spool: Spool to which the batch is appended
+        :type spool: rabbithole.spool.Spool
+        :param flow: Arguments used to create the database callback
+        :type flow: dict(str)
+        :param batch: Batch of messages
+        :type batch: list(dict(str))
+        :returns: Whether the batch was appended to the spool
+        :rtype: bool
+
+        """
+        try:
+            spool.append({'flow': flow, 'batch': batch})
+        except SpoolFull as error:
+            LOGGER.error('Unable to spool batch: %s', error)
+            return False
+        return True
+
+    def replay(self, spool):
+        # type: (Spool) -> None
+        """Write spooled batches to the database in order.
+
+        Spooled batches contain the arguments used to create their callback,
+        so that batches spooled before a restart can be written even if the
+        flows have changed. Errors are logged and retried, so that the
+        replayer keeps running until the database is closed.
+
+        :param spool: Spool from which batches are read
+        :type spool: rabbithole.spool.Spool
+
+        """
+        flows = {}  # type: Dict[str, Dict[str, Any]]
+        delay = self.retry_delay
+        while not self.stopping.is_set():
+            try:
+                item = spool.get(self.REPLAY_POLL_INTERVAL)
+                if item is None:
+                    continue
+                position, record = item
+                if not self.replay_record(spool, record, flows):
+                    # Not committed, so it's replayed again after a restart
+                    return
+                spool.commit(position)
+            except Exception:  # pylint:disable=broad-except
+                LOGGER.exception(
+                    'Spool replay error, retrying in %.2f seconds...', delay)
+                if self.stopping.wait(delay):
+                    return
+                delay = min(delay * 2, self.MAX_REPLAY_DELAY)
+            else:
+                delay = self.retry_delay
+
+    def replay_record(self, spool, record, flows):
+        # type: (Spool, Dict[str, Any], Dict[str, Dict[str, Any]]) -> bool
+        """Write spooled batch to the database retrying it until it's written.
+
+        Batches that fail :attr:`replay_attempts` times with an error that
+        isn't transient are moved to the reject file.
+
+        :param spool: Spool from which the batch was read
+        :type spool: rabbithole.spool.Spool
+        :param record: Spooled flow and batch
+        :type record: dict(str)
+        :param flows: Compiled flows by their spooled arguments
+        :type flows: dict(str, dict(str))
+        :returns:
+            Whether the batch was written or rejected, that is, whether it
+            can be committed
+        :rtype: bool
+
+        """
+        attempts = 0
+        delay = self.retry_delay
+        while True:
+            error = self.replay_batch(record, flows)
+            if error is None:
+                return True
+            if not is_transient_error(error):
+                attempts += 1
+                if attempts >= self.replay_attempts:
+                    self.reject_record(spool, record, error)
+                    return True
+            LOGGER.warning(
+                'Spooled batch not written, retrying in %.2f seconds...',
+                delay,
+            )
+            if self.stopping.wait(delay):
+                return False
+            delay = min(delay * 2, self.MAX_REPLAY_DELAY)
+
+    def replay_batch(self, record, flows):
+        # type: (Dict[str, Any], Dict[str, Dict[str, Any]]) -> Optional[Exception]  # noqa
+        """Write spooled batch to the database.
+
+        :param record: Spooled flow and batch
+        :type record: dict(str)
+        :param flows: Compiled flows by their spooled arguments
+        :type flows: dict(str, dict(str))
+        :returns: Error that prevented the batch from being written, if any
+        :rtype: Exception | None
+
+        """
+        try:
+            key = json.dumps(record['flow'], sort_keys=True)
+            flow = flows.get(key)
+            if flow is None:
+                flow = compile_flow(**record['flow'])
+                flows[key] = flow
+            # Batches replayed from the spool aren't sent by a batcher
+            self.write_batch('', batch=record['batch'], **flow)
+        except Exception as error:  # pylint:disable=broad-except
+            LOGGER.exception('Spooled batch replay error')
+            BATCH_ERRORS.labels('').inc()
+            return error
+        return None
+
+    @staticmethod
+    def reject_record(spool, record, error):
+        # type: (Spool, Dict[str, Any], Exception) -> None
+        """Append spooled batch that can't be written to the reject file.
+
+        :param spool: Spool from which the batch was read
+        :type spool: rabbithole.spool.Spool
+        :param record: Spooled flow and batch
+        :type record: dict(str)
+        :param error: Last error while writing the batch
+        :type error: Exception
+
+        """
+        path = os.path.join(spool.directory, REJECTED_NAME)
+        LOGGER.error('Spooled batch rejected (%s), moved to %r', error, path)
+        line = json.dumps({'record': record, 'error': str(error)}, default=str)
+        with open(path, 'a') as file_:
+            file_.write(line + '\n')
+            file_.flush()
+            os.fsync(file_.fileno())
+        ROWS_REJECTED.labels('').inc(len(record.get('batch') or []))
+
     def batch_ready_cb(
             self,
             sender,  # type: object
             query,  # type: object
-            parameters,  # type: Optional[List]
+            parameters,  # type: Union[ParametersMapper, List, Dict, None]
             batch,  # type: List[Dict[str, object]]
+            reject_query=None,  # type: object
             ):
+        # type: (...) -> bool
         """Execute insert query for the batch that is ready.
 
         :param sender: The batcher who sent the batch_ready signal
         :type sender: rabbithole.batcher.Batcher
         :param query: The query to execute to insert the batch
-        :type query: :class:`sqlalchemy.sql.elements.TextClause`
+        :type query:
+            :class:`sqlalchemy.sql.elements.TextClause` |
+            :class:`rabbithole.bulk.MultiRowInsert`
         :param parameters: Parameters to pass to the query on execution
-        :type parameters: list | None
+        :type parameters: ParametersMapper | list | dict | None
         :param batch: Batch of messages
         :type batch: list(dict(str))
+        :param reject_query: Query to execute for every rejected message
+        :type reject_query: :class:`sqlalchemy.sql.elements.TextClause` | None
+        :returns:
+            Whether the batch was written. Rejected messages don't make the
+            batch fail, since writing them again would fail as well.
+        :rtype: bool
 
         """
-        if parameters is None:
-            batch_parameters = batch
-        elif isinstance(parameters, list):
-            batch_parameters = ListParametersMapper(parameters).map(batch)
-        elif isinstance(parameters, dict):
-            batch_parameters = DictParametersMapper(parameters).map(batch)
-        else:
-            raise ValueError('Unexpected parameter mapping: %s', parameters)
-
+        flow = getattr(sender, 'name', '')
         try:
-            LOGGER.info(
-                'Executing query: (query: %s, parameters: %s)',
-                query,
-                batch_parameters,
-            )
-            self.connection.execute(query, batch_parameters)
+            self.write_batch(flow, query, parameters, batch, reject_query)
         except SQLAlchemyError:
             LOGGER.error(traceback.format_exc())
             LOGGER.error(
@@ -103,14 +492,405 @@ class Database(object):
                 query,
                 batch,
             )
+            BATCH_ERRORS.labels(flow).inc()
+            return False
+        return True
+
+    def write_batch(
+            self,
+            flow,  # type: str
+            query,  # type: object
+            parameters,  # type: Union[ParametersMapper, List, Dict, None]
+            batch,  # type: List[Dict[str, object]]
+            reject_query=None,  # type: object
+            ):
+        # type: (...) -> None
+        """Execute insert query for a batch.
+
+        :param flow: Name of the flow used to label metrics
+        :type flow: str
+        :param query: The query to execute to insert the batch
+        :type query:
+            :class:`sqlalchemy.sql.elements.TextClause` |
+            :class:`rabbithole.bulk.MultiRowInsert`
+        :param parameters: Parameters to pass to the query on execution
+        :type parameters: ParametersMapper | list | dict | None
+        :param batch: Batch of messages
+        :type batch: list(dict(str))
+        :param reject_query: Query to execute for every rejected message
+        :type reject_query: :class:`sqlalchemy.sql.elements.TextClause` | None
+        :raises SQLAlchemyError: If the batch couldn't be written
+
+        """
+        if not isinstance(parameters, ParametersMapper):
+            parameters = create_parameters_mapper(parameters)
+
+        if parameters is None:
+            batch_parameters = batch
         else:
-            LOGGER.debug('Inserted %d rows', len(batch))
+            batch_parameters = parameters.map(batch)
+
+        start = perf_counter()
+        LOGGER.info(
+            'Executing query: (query: %s, rows: %d)',
+            query,
+            len(batch_parameters),
+        )
+        LOGGER.debug('Query parameters: %s', batch_parameters)
+        with self.connect() as connection:
+            rejected = self.write(connection, query, batch_parameters)
+            EXECUTE_SECONDS.labels(flow).observe(perf_counter() - start)
+            if rejected:
+                self.reject(connection, query, batch, rejected, reject_query)
+
+        LOGGER.debug('Inserted %d rows', len(batch) - len(rejected))
+        ROWS_WRITTEN.labels(flow).inc(len(batch) - len(rejected))
+        if rejected:
+            ROWS_REJECTED.labels(flow).inc(len(rejected))
+
+    def write(self, connection, query, rows):
+        # type: (Any, Any, List) -> List[Tuple[int, SQLAlchemyError]]
+        """Write rows splitting them in halves when some of them are invalid.
+
+        :param connection: Database connection
+        :type connection: sqlalchemy.engine.Connection
+        :param query: The query to execute to insert the rows
+        :type query:
+            :class:`sqlalchemy.sql.elements.TextClause` |
+            :class:`rabbithole.bulk.MultiRowInsert`
+        :param rows: Query parameters for each row
+        :type rows: list
+        :returns: Index and error of every row that couldn't be written
+        :rtype: list(tuple(int, Exception))
+        :raises SQLAlchemyError:
+            If the error isn't caused by the rows themselves, since writing
+            fewer rows would fail the same way
+
+        """
+        try:
+            self.execute(connection, query, rows)
+        except SQLAlchemyError as error:
+            if (is_transient_error(error) or
+                    not isinstance(error, (DataError, IntegrityError))):
+                raise
+            if len(rows) == 1:
+                return [(0, error)]
+            middle = len(rows) // 2
+            return self.write(connection, query, rows[:middle]) + [
+                (index + middle, row_error)
+                for index, row_error
+                in self.write(connection, query, rows[middle:])
+            ]
+        return []
+
+    def execute(self, connection, query, rows):
+        # type: (Any, Any, List) -> None
+        """Execute query in a transaction retrying transient errors.
+
+        :param connection: Database connection
+        :type connection: sqlalchemy.engine.Connection
+        :param query: The query to execute to insert the rows
+        :type query:
+            :class:`sqlalchemy.sql.elements.TextClause` |
+            :class:`rabbithole.bulk.MultiRowInsert`
+        :param rows: Query parameters for each row
+        :type rows: list
+
+        """
+        attempt = 0
+        while True:
+            try:
+                with connection.begin():
+                    if isinstance(query, MultiRowInsert):
+                        query.execute(connection, rows)
+                    else:
+                        connection.execute(query, rows)
+                return
+            except SQLAlchemyError as error:
+                if attempt >= self.retries or not is_transient_error(error):
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                attempt += 1
+                LOGGER.warning(
+                    'Transient error (%s), retrying in %.2f seconds...',
+                    error,
+                    delay,
+                )
+                self.wait(connection, delay)
+
+    def wait(self, connection, delay):
+        # type: (Any, float) -> None
+        """Wait before retrying a query.
+
+        The shared connection is released meanwhile, so that other writers
+        aren't blocked by the backoff.
+
+        :param connection: Database connection
+        :type connection: sqlalchemy.engine.Connection
+        :param delay: Seconds to wait
+        :type delay: float
+
+        """
+        if connection is not self.connection:
+            time.sleep(delay)
+            return
+        self.lock.release()
+        try:
+            time.sleep(delay)
+        finally:
+            self.lock.acquire()
+
+    @staticmethod
+    def reject(connection, query, batch, rejected, reject_query):
+        # type: (Any, Any, List, List[Tuple[int, Any]], Any) -> None
+        """Report messages that couldn't be written.
+
+        :param connection: Database connection
+        :type connection: sqlalchemy.engine.Connection
+        :param query: The query that failed
+        :type query: object
+        :param batch: Batch of messages
+        :type batch: list(dict(str))
+        :param rejected: Index and error of every rejected message
+        :type rejected: list(tuple(int, Exception))
+        :param reject_query: Query to execute for every rejected message
+        :type reject_query: :class:`sqlalchemy.sql.elements.TextClause` | None
+
+        """
+        for index, error in rejected:
+            LOGGER.error(
+                'Message rejected:\n- query: %s\n- message: %r\n- error: %s',
+                query,
+                batch[index],
+                error,
+            )
+
+        if reject_query is None:
+            return
+        try:
+            with connection.begin():
+                connection.execute(reject_query, [
+                    {
+                        'message': json.dumps(batch[index], default=str),
+                        'error': str(error),
+                    }
+                    for index, error in rejected
+                ])
+        except SQLAlchemyError:
+            LOGGER.error(traceback.format_exc())
+            LOGGER.error('Reject query execution error: %s', reject_query)
+
+
+def is_transient_error(error):
+    # type: (Exception) -> bool
+    """Check if an error might not happen again if the query is retried.
+
+    Lost connections are detected by SQLAlchemy for every dialect. Other
+    transient errors (deadlocks, lock timeouts, ...) are detected from the
+    error reported by the driver, since an :class:`OperationalError` might
+    also be caused by the query itself (for example, a missing table).
+
+    :param error: Query execution error
+    :type error: Exception
+    :returns: Whether the query should be retried
+    :rtype: bool
+
+    """
+    if getattr(error, 'connection_invalidated', False):
+        return True
+    if not isinstance(error, OperationalError):
+        return False
+
+    orig = getattr(error, 'orig', None)
+    sqlstate = (
+        getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None))
+    if sqlstate:
+        return sqlstate.startswith('08') or sqlstate in TRANSIENT_SQLSTATES
+    args = getattr(orig, 'args', ())
+    if args and isinstance(args[0], int) and (
+            args[0] in TRANSIENT_MYSQL_CODES):
+        return True
+    message = str(orig).lower()
+    return any(text in message for text in TRANSIENT_SQLITE_MESSAGES)
+
+
+def compile_flow(query, parameters, multirow, reject_query):
+    # type: (str, Union[List, Dict, None], bool, Optional[str]) -> Dict[str, Any]  # noqa
+    """Compile the arguments of a flow to write its batches.
+
+    :param query: The query to execute to insert the batch
+    :type query: str
+    :param parameters: Parameters to pass to the query on execution
+    :type parameters: list | dict | None
+    :param multirow:
+        Rewrite the single row INSERT query to insert multiple rows per
+        statement
+    :type multirow: bool
+    :param reject_query: Query to execute for every rejected message
+    :type reject_query: str | None
+    :returns: Keyword arguments for :meth:`Database.write_batch`
+    :rtype: dict(str)
+
+    """
+    return {
+        'query': MultiRowInsert(query) if multirow else text(query),
+        'parameters': create_parameters_mapper(parameters),
+        'reject_query': (
+            text(reject_query) if reject_query is not None else None),
+    }
+
+
+def create_parameters_mapper(parameters):
+    # type: (Union[List, Dict, None]) -> Optional[ParametersMapper]
+    """Create mapper to extract query parameters from messages.
+
+    :param parameters: Mapping from message to query parameters
+    :type parameters: list | dict | None
+    :returns: Mapper object or None if no mapping is needed
+    :rtype: ParametersMapper | None
+
+    """
+    if parameters is None:
+        return None
+    if isinstance(parameters, list):
+        return ListParametersMapper(parameters)
+    if isinstance(parameters, dict):
+        return DictParametersMapper(parameters)
+    raise ValueError('Unexpected parameter mapping: %s', parameters)
+
+
+#: Functions used to coerce parameter values to the column type
+COERCIONS = {
+    'bool': bool,
+    'float': float,
+    'int': int,
+    'json': json.dumps,
+    'str': six.text_type,
+}  # type: Dict[str, Callable[[Any], Any]]
+
+
+def compile_parameter(parameter):
+    # type: (Union[str, Dict[str, str]]) -> Callable[[object], object]
+    """Compile a parameter mapping into a function that extracts its value.
+
+    The dotted path is split only once and a getter specialized for the path
+    depth is returned, so that extracting the value from every message is as
+    cheap as possible.
+
+    :param parameter:
+        Dotted path to the value in the message or a dictionary with the
+        `path` and the `type` to which the value should be coerced
+    :type parameter: str | dict(str)
+    :returns: Function that gets the parameter value from a message
+    :rtype: callable
+
+    """
+    path = get_parameter_path(parameter)
+    type_name = parameter.get('type') if isinstance(parameter, dict) else None
+
+    # Values coerced to JSON are serialized only once by the coercion
+    getter = _compile_path(tuple(path.split('.')), type_name != 'json')
+    if type_name is None:
+        return getter
+
+    try:
+        coerce = COERCIONS[type_name]
+    except KeyError:
+        raise ValueError('Unexpected parameter type: {}'.format(type_name))
+
+    def coerced_getter(message):
+        # type: (object) -> object
+        """Get parameter value coerced to the expected type."""
+        value = getter(message)
+        if value is None:
+            return None
+        try:
+            return coerce(value)
+        except (TypeError, ValueError):
+            LOGGER.warning(
+                'Unable to coerce %r value to %s: %r', path, type_name, value)
+            return None
+
+    return coerced_getter
+
+
+def get_parameter_path(parameter):
+    # type: (Union[str, Dict[str, str]]) -> str
+    """Get dotted path to the parameter value in the message.
+
+    :param parameter: Parameter mapping
+    :type parameter: str | dict(str)
+    :returns: Dotted path
+    :rtype: str
+
+    """
+    if isinstance(parameter, dict):
+        return parameter['path']
+    return parameter
+
+
+def _compile_path(keys, serialize=True):
+    # type: (Tuple[str, ...], bool) -> Callable[[object], object]
+    """Compile getter for a path that has already been split into keys.
+
+    :param keys: Keys to traverse in the message
+    :type keys: tuple(str)
+    :param serialize: Whether list and dict values are serialized as JSON
+    :type serialize: bool
+    :returns: Function that gets the value from a message
+    :rtype: callable
+
+    """
+    if len(keys) == 1:
+        key = keys[0]
+
+        def getter(message):
+            # type: (object) -> object
+            """Get top level value."""
+            if not isinstance(message, dict):
+                return None
+            value = message.get(key)
+            if serialize and isinstance(value, (list, dict)):
+                return json.dumps(value)
+            return value
+    elif len(keys) == 2:
+        key, subkey = keys
+
+        def getter(message):
+            # type: (object) -> object
+            """Get nested value."""
+            if not isinstance(message, dict):
+                return None
+            value = message.get(key)
+            if not isinstance(value, dict):
+                return None
+            value = value.get(subkey)
+            if serialize and isinstance(value, (list, dict)):
+                return json.dumps(value)
+            return value
+    else:
+        def getter(message):
+            # type: (object) -> object
+            """Get deeply nested value."""
+            value = message
+            for key in keys:
+                if not isinstance(value, dict):
+                    return None
+                value = value.get(key)
+            if serialize and isinstance(value, (list, dict)):
+                return json.dumps(value)
+            return value
+
+    return getter
 
 
 class ParametersMapper(object):
 
     """Base class to map messages to parameters.
 
+    Parameter mappings are compiled on initialization so that a mapper can be
+    reused to map every batch of messages.
+
     :param parameters: Mapping from message to query parameters.
     :type parameters: list(str)
 
@@ -123,47 +903,26 @@ class ParametersMapper(object):
         """Initialize parameters."""
         self.parameters = parameters
 
+    @property
+    def fields(self):
+        # type: () -> List[str]
+        """Dotted paths to the message values used as parameters."""
+        if isinstance(self.parameters, dict):
+            parameters = list(self.parameters.values())  # type: List[Any]
+        else:
+            parameters = list(self.parameters)
+        return [get_parameter_path(parameter) for parameter in parameters]
+
+    @abstractmethod
     def map(self, batch):
         """Get query parameters for a batch of messages.
 
         :param batch: Batch of messages
         :type batch: list(dict(str))
         :returns: All parameters extracted from all messages
-        :rtype: list(list(object | None))
+        :rtype: list
 
         """
-        batch_parameters = [
-            self._map_message_parameters(message)
-            for message in batch
-        ]
-        return batch_parameters
-
-    @abstractmethod
-    def _map_message_parameters(self, message):
-        """Get query parameters for a message."""
-
-    def _map_message_parameter(self, parameter, message):
-        # type: (str, Dict[str, object]) -> Optional[object]
-        """Get query parameter for a message.
-
-        :param parameters: Mapping from message to query parameter.
-        :type parameters: str
-        :param message: A message
-        :type message: dict(str)
-        :returns: The parameter extracted from the message
-        :rtype: object | None
-
-        """
-        keys = parameter.split('.')
-        value = message  # type: Union[Dict[str, object], object]
-        for key in keys:
-            if isinstance(value, dict):
-                value = value.get(key)
-            else:
-                return None
-        if isinstance(value, (list, dict)):
-            value = json.dumps(value)
-        return value
 
 
 class ListParametersMapper(ParametersMapper):
@@ -171,45 +930,66 @@ class ListParametersMapper(ParametersMapper):
     """Map messages to lists of parameters.
 
     :param parameters: Mapping from message to query parameters.
-    :type parameters: list(str)
+    :type parameters: list(str | dict(str))
 
     """
 
-    def _map_message_parameters(self, message):
-        # type: (Dict[str, object]) -> List[Optional[object]]
-        """Get query parameters for a message.
+    def __init__(self, parameters):
+        # type: (List) -> None
+        """Compile parameters."""
+        super(ListParametersMapper, self).__init__(parameters)
+        self.getters = [
+            compile_parameter(parameter)
+            for parameter in parameters
+        ]
 
-        :param message: A message
-        :type message: dict(str)
-        :returns: All parameters extracted from message
-        :rtype: list(object | None)
+    def map(self, batch):
+        # type: (List[Dict[str, object]]) -> List[List[object]]
+        """Get query parameters for a batch of messages.
+
+        :param batch: Batch of messages
+        :type batch: list(dict(str))
+        :returns: All parameters extracted from all messages
+        :rtype: list(list(object | None))
 
         """
-        message_parameters = [
-            self._map_message_parameter(parameter, message)
-            for parameter in self.parameters
+        getters = self.getters
+        return [
+            [getter(message) for getter in getters]
+            for message in batch
         ]
-        return message_parameters
 
 
 class DictParametersMapper(ParametersMapper):
 
-    """Map messages to lists of parameters."""
+    """Map messages to dictionaries of parameters.
+
+    :param parameters: Mapping from message to query parameters.
+    :type parameters: dict(str, str | dict(str))
+
+    """
+
+    def __init__(self, parameters):
+        # type: (Dict) -> None
+        """Compile parameters."""
+        super(DictParametersMapper, self).__init__(parameters)
+        self.getters = [
+            (key, compile_parameter(parameter))
+            for key, parameter in six.iteritems(parameters)
+        ]
 
-    def _map_message_parameters(self, message):
-        # type: (Dict[str, object]) -> Dict[str, Optional[object]]
-        """Get query parameters for a message.
+    def map(self, batch):
+        # type: (List[Dict[str, object]]) -> List[Dict[str, object]]
+        """Get query parameters for a batch of messages.
 
-        :param parameters: Mapping from message to query parameters.
-        :type parameters: list(str)
-        :param message: A message
-        :type message: dict(str)
-        :returns: All parameters extracted from message
-        :rtype: list(object | None)
+        :param batch: Batch of messages
+        :type batch: list(dict(str))
+        :returns: All parameters extracted from all messages
+        :rtype: list(dict(str, object | None))
 
         """
-        message_parameters = {
-            key: self._map_message_parameter(parameter, message)
-            for key, parameter in six.iteritems(self.parameters)
-        }
-        return message_parameters
+        getters = self.getters
+        return [
+            {key: getter(message) for key, getter in getters}
+            for message in batch
+        ]
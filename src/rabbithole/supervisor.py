@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""Supervisor: run flows in multiple worker processes.
+
+The strategy to distribute work is:
+    - run flows that consume from a named queue in every worker, since
+      workers compete for the messages in the queue
+    - assign the rest of flows to workers in a round robin fashion
+    - create in each worker only the blocks used by its flows
+    - restart any worker that exits until the supervisor is interrupted
+    - on SIGTERM, terminate every worker and wait until it has drained its
+      flows
+    - on SIGHUP, reload the configuration and replace only the workers whose
+      flows changed
+    - serve the metrics of each worker on its own port
+
+"""
+
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+
+from typing import (  # noqa
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Supervisor(object):
+
+    """Run flows in multiple worker processes.
+
+    :param config: Configuration
+    :type config: dict(str)
+    :param workers: Number of worker processes
+    :type workers: int
+    :param target: Function that runs the flows in a configuration
+    :type target: callable
+    :param reload_config:
+        Function that loads the configuration again (reloading is disabled if
+        not set)
+    :type reload_config: callable | None
+
+    """
+
+    RESTART_DELAY = 1
+
+    def __init__(
+            self,
+            config,  # type: Dict[str, Any]
+            workers,  # type: int
+            target,  # type: Callable[[Dict[str, Any]], int]
+            reload_config=None,  # type: Optional[Callable[[], Dict[str, Any]]]  # noqa
+            ):
+        # type: (...) -> None
+        """Distribute flows between workers."""
+        flow_count = len(config['flows'])
+        if workers > flow_count and not any(
+                is_shared_flow(flow) for flow in config['flows']):
+            LOGGER.warning(
+                'More workers than flows (%d > %d), using %d workers',
+                workers,
+                flow_count,
+                flow_count,
+            )
+            workers = flow_count
+
+        self.configs = [
+            shard_config(config, index, workers)
+            for index in range(workers)
+        ]
+        self.target = target
+        self.reload_config = reload_config
+        self.processes = [
+            None for _ in self.configs
+        ]  # type: List[Optional[multiprocessing.Process]]
+        self.stopping = threading.Event()
+        self.reloading = threading.Event()
+
+    def run(self):
+        # type: () -> int
+        """Start workers and restart them if they exit.
+
+        :returns: Exit code
+        :rtype: int
+
+        """
+        signal.signal(
+            signal.SIGTERM, lambda _signum, _frame: self.stopping.set())
+        if self.reload_config is not None and hasattr(signal, 'SIGHUP'):
+            signal.signal(
+                signal.SIGHUP, lambda _signum, _frame: self.reloading.set())
+        try:
+            while not self.stopping.is_set():
+                if self.reloading.is_set():
+                    self.reloading.clear()
+                    self.reload()
+                for index, process in enumerate(self.processes):
+                    if process is not None and process.is_alive():
+                        continue
+                    if process is not None:
+                        LOGGER.error(
+                            'Worker %d exited (exit code: %s), restarting...',
+                            index,
+                            process.exitcode,
+                        )
+                    self.processes[index] = self.start_worker(index)
+                time.sleep(self.RESTART_DELAY)
+            LOGGER.info('Terminated')
+        except KeyboardInterrupt:
+            LOGGER.info('Interrupted by user')
+        finally:
+            self.stop()
+
+        return 0
+
+    def reload(self):
+        # type: () -> None
+        """Reload configuration and replace the workers whose flows changed.
+
+        Each new worker is started before terminating the one it replaces, so
+        that its flows keep running while the old worker is drained.
+
+        """
+        if self.reload_config is None:
+            return
+        LOGGER.info('Reloading configuration...')
+        try:
+            config = self.reload_config()
+        except Exception:  # pylint:disable=broad-except
+            LOGGER.exception(
+                'Unable to reload configuration, keeping current workers')
+            return
+
+        workers = len(self.configs)
+        for index in range(workers):
+            worker_config = shard_config(config, index, workers)
+            if worker_config == self.configs[index]:
+                continue
+            LOGGER.info('Worker %d configuration changed, replacing it', index)
+            self.configs[index] = worker_config
+            process = self.processes[index]
+            self.processes[index] = self.start_worker(index)
+            if process is not None and process.is_alive():
+                process.terminate()
+                process.join()
+
+    def start_worker(self, index):
+        # type: (int) -> multiprocessing.Process
+        """Start worker process.
+
+        :param index: Worker index
+        :type index: int
+        :returns: Worker process
+        :rtype: multiprocessing.Process
+
+        """
+        process = multiprocessing.Process(
+            name='worker-{}'.format(index),
+            target=self.target,
+            args=(self.configs[index], ),
+        )
+        process.daemon = True
+        process.start()
+        LOGGER.info('Worker %d started (pid: %d)', index, process.pid)
+        return process
+
+    def stop(self):
+        # type: () -> None
+        """Terminate all workers and wait until they drain their flows."""
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+
+def shard_config(config, index, workers):
+    # type: (Dict[str, Any], int, int) -> Dict[str, Any]
+    """Get the subset of the configuration assigned to a worker.
+
+    :param config: Configuration
+    :type config: dict(str)
+    :param index: Worker index
+    :type index: int
+    :param workers: Number of worker processes
+    :type workers: int
+    :returns: Configuration with the flows assigned to the worker
+    :rtype: dict(str)
+
+    """
+    flows = []
+    position = 0
+    for flow in config['flows']:
+        if is_shared_flow(flow):
+            flows.append(flow)
+            continue
+        if position % workers == index:
+            flows.append(flow)
+        position += 1
+
+    block_names = set(
+        block['name']
+        for flow in flows
+        for block in flow
+    )
+    worker_config = dict(config)
+    worker_config['flows'] = flows
+    worker_config['blocks'] = [
+        block for block in config['blocks']
+        if block['name'] in block_names
+    ]
+    worker_config.pop('workers', None)
+    if worker_config.get('metrics_port'):
+        # Each worker serves its own metrics
+        worker_config['metrics_port'] += index
+    return worker_config
+
+
+def is_shared_flow(flow):
+    # type: (List[Dict[str, Any]]) -> bool
+    """Check if a flow can run in multiple workers at the same time.
+
+    :param flow: Flow configuration
+    :type flow: list(dict(str))
+    :returns: Whether the flow input is a named queue
+    :rtype: bool
+
+    """
+    input_block = flow[0]
+    return input_block.get('kwargs', {}).get('queue') is not None
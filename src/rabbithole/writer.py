@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+
+"""Writer: hand off batches to dedicated writer threads.
+
+The strategy to write batches is:
+    - put them in a bounded queue as soon as they are ready
+    - get them from the queue and send them to the output in writer threads
+
+This way, the next batch can be filled while the previous one is being written
+and a slow output doesn't block message intake. When the queue is full,
+putting a new batch blocks until there's room for it, which propagates
+backpressure to the input.
+
+Batches sent when a time limit is exceeded are put from the scheduler thread
+shared by all the batchers, which must not block, so they are queued even if
+the queue is full. They still count as pending, so the input blocks until the
+queue has room again. Each batcher has at most one time limit running, which
+bounds how much the queue can exceed its size.
+
+"""
+
+import logging
+import threading
+
+from collections import deque
+from functools import partial
+
+from six.moves import (  # pylint:disable=redefined-builtin
+    queue,
+    range,
+)
+from typing import (  # noqa
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from rabbithole.scheduler import (
+    in_scheduled_callback,
+    monotonic,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Future(object):
+
+    """Result of a batch that is written asynchronously.
+
+    Only the subset of the `concurrent.futures.Future` interface needed to
+    settle messages is implemented.
+
+    """
+
+    def __init__(self):
+        # type: () -> None
+        """Initialize internal data structures."""
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []  # type: List[Callable[[Future], None]]
+        self._result = None  # type: Any
+        self._exception = None  # type: Optional[BaseException]
+
+    def add_done_callback(self, callback):
+        # type: (Callable[[Future], None]) -> None
+        """Run callback when the future is done.
+
+        :param callback: Function that gets the future as argument
+        :type callback: callable
+
+        """
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancelled(self):
+        # type: () -> bool
+        """Futures are never cancelled."""
+        return False
+
+    def result(self, timeout=None):
+        # type: (Optional[float]) -> Any
+        """Wait for the result.
+
+        :param timeout: Maximum time to wait in seconds
+        :type timeout: float | None
+        :returns: Value returned by the output callback
+        :rtype: object
+
+        """
+        self.done.wait(timeout)
+        if self._exception is not None:
+            raise self._exception  # pylint:disable=raising-bad-type
+        return self._result
+
+    def exception(self, timeout=None):
+        # type: (Optional[float]) -> Optional[BaseException]
+        """Wait for the exception.
+
+        :param timeout: Maximum time to wait in seconds
+        :type timeout: float | None
+        :returns: Exception raised by the output callback if any
+        :rtype: Exception | None
+
+        """
+        self.done.wait(timeout)
+        return self._exception
+
+    def set_result(self, result):
+        # type: (Any) -> None
+        """Set result and run callbacks.
+
+        :param result: Value returned by the output callback
+        :type result: object
+
+        """
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        # type: (BaseException) -> None
+        """Set exception and run callbacks.
+
+        :param exception: Exception raised by the output callback
+        :type exception: Exception
+
+        """
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        # type: () -> None
+        """Mark future as done and run callbacks."""
+        with self.lock:
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:  # pylint:disable=broad-except
+                LOGGER.exception('Future callback error')
+
+
+class BatchWriter(object):
+
+    """Write batches from a bounded queue in dedicated threads.
+
+    Batches submitted with the same ordering key are written one after the
+    other in the same order in which they were submitted, while batches
+    with different keys (or without any key) are written concurrently.
+
+    :param name: Name used for the writer threads
+    :type name: str
+    :param threads: Number of writer threads
+    :type threads: int
+    :param max_pending: Maximum number of batches waiting to be written
+    :type max_pending: int
+
+    """
+
+    DEFAULT_THREADS = 1
+    DEFAULT_MAX_PENDING = 2
+
+    def __init__(self, name, threads=None, max_pending=None):
+        # type: (str, Optional[int], Optional[int]) -> None
+        """Start writer threads."""
+        self.queue = queue.Queue()  # type: queue.Queue
+        self.max_pending = max_pending or self.DEFAULT_MAX_PENDING
+        self.pending = 0
+        self.slots = threading.Condition()
+        self.keys_lock = threading.Lock()
+        self.keys = {}  # type: Dict[Hashable, Deque[Tuple]]
+        self.threads = []  # type: List[threading.Thread]
+        for index in range(threads or self.DEFAULT_THREADS):
+            thread = threading.Thread(
+                name='{}-writer-{}'.format(name, index),
+                target=self.run,
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args, **kwargs):
+        # type: (Callable, *Any, **Any) -> Future
+        """Queue function call to be run by a writer thread.
+
+        Blocks while the queue is full, unless called from a scheduled
+        callback.
+
+        :param function: Function to call
+        :type function: callable
+        :returns: Future for the function result
+        :rtype: Future
+
+        """
+        return self.submit_ordered(None, function, *args, **kwargs)
+
+    def submit_ordered(self, key, function, *args, **kwargs):
+        # type: (Optional[Hashable], Callable, *Any, **Any) -> Future
+        """Queue function call to be run after previous calls with same key.
+
+        Blocks while the queue is full, unless called from a scheduled
+        callback.
+
+        :param key: Ordering key (None if ordering isn't needed)
+        :type key: object
+        :param function: Function to call
+        :type function: callable
+        :returns: Future for the function result
+        :rtype: Future
+
+        """
+        with self.slots:
+            # The scheduler thread is shared by the batchers of every output
+            if not in_scheduled_callback():
+                while self.pending >= self.max_pending:
+                    self.slots.wait()
+            self.pending += 1
+        return self._enqueue(key, function, *args, **kwargs)
+
+    def try_submit_ordered(self, key, function, *args, **kwargs):
+        # type: (Optional[Hashable], Callable, *Any, **Any) -> Optional[Future]
+        """Queue function call unless the queue is full.
+
+        :param key: Ordering key (None if ordering isn't needed)
+        :type key: object
+        :param function: Function to call
+        :type function: callable
+        :returns: Future for the function result or None if it wasn't queued
+        :rtype: Future | None
+
+        """
+        with self.slots:
+            if self.pending >= self.max_pending:
+                return None
+            self.pending += 1
+        return self._enqueue(key, function, *args, **kwargs)
+
+    def _enqueue(self, key, function, *args, **kwargs):
+        # type: (Optional[Hashable], Callable, *Any, **Any) -> Future
+        """Queue function call once it has been counted as pending.
+
+        :param key: Ordering key (None if ordering isn't needed)
+        :type key: object
+        :param function: Function to call
+        :type function: callable
+        :returns: Future for the function result
+        :rtype: Future
+
+        """
+        future = Future()
+        item = (key, future, partial(function, *args, **kwargs))
+        if key is not None:
+            with self.keys_lock:
+                # Wait for the thread that is writing batches for this key
+                if key in self.keys:
+                    self.keys[key].append(item)
+                    return future
+                self.keys[key] = deque()
+        self.queue.put(item)
+        return future
+
+    def run(self):
+        # type: () -> None
+        """Run queued function calls until the writer is closed."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            # Keep running calls for the same key in this thread
+            while item is not None:
+                key, future, function = item
+                with self.slots:
+                    self.pending -= 1
+                    self.slots.notify()
+                try:
+                    result = function()
+                except Exception as exception:  # pylint:disable=broad-except
+                    LOGGER.exception('Output callback error')
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+                item = self.next_item(key)
+
+    def next_item(self, key):
+        # type: (Optional[Hashable]) -> Optional[Tuple]
+        """Get next call for the given key.
+
+        :param key: Ordering key
+        :type key: object
+        :returns: Next call or None if there are no more calls for that key
+        :rtype: tuple | None
+
+        """
+        if key is None:
+            return None
+        with self.keys_lock:
+            pending = self.keys[key]
+            if pending:
+                return pending.popleft()
+            del self.keys[key]
+        return None
+
+    def close(self, timeout=None):
+        # type: (Optional[float]) -> bool
+        """Write pending batches and stop writer threads.
+
+        :param timeout: Maximum time to wait for all the threads in seconds
+        :type timeout: float | None
+        :returns: Whether all the pending batches were written in time
+        :rtype: bool
+
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        deadline = None if timeout is None else monotonic() + timeout
+        for thread in self.threads:
+            thread.join(
+                None if deadline is None else max(0, deadline - monotonic()))
+        return not any(thread.is_alive() for thread in self.threads)
+
+
+class QueuedOutput(object):
+
+    """Send batches to an output block through a batch writer.
+
+    :param block: Output block instance
+    :type block: object
+    :param writer: Writer that runs the output block callbacks
+    :type writer: BatchWriter
+
+    """
+
+    def __init__(self, block, writer):
+        # type: (Any, BatchWriter) -> None
+        """Store block and writer."""
+        self.block = block
+        self.writer = writer
+
+    def __call__(self, *args, **kwargs):
+        # type: (*Any, **Any) -> Callable
+        """Return callback that queues batches for the output block callback.
+
+        :param args: Positional arguments to the output block
+        :type args: list
+        :param kwargs:
+            Keyword arguments to the output block. An `ordering_key` can be
+            passed to make sure that batches for flows with the same key are
+            written in order. If `wait` is false, the output is best-effort:
+            messages are settled without waiting for their batches to be
+            written and batches are dropped when the queue is full.
+        :type kwargs: dict(str)
+
+        """
+        ordering_key = kwargs.pop('ordering_key', None)
+        wait = kwargs.pop('wait', True)
+        callback = self.block(*args, **kwargs)
+        if not wait:
+            return partial(self.submit_best_effort, ordering_key, callback)
+        return partial(self.writer.submit_ordered, ordering_key, callback)
+
+    def submit_best_effort(self, ordering_key, callback, *args, **kwargs):
+        # type: (Optional[Hashable], Callable, *Any, **Any) -> None
+        """Queue batch without blocking or waiting for it to be written.
+
+        :param ordering_key: Ordering key (None if ordering isn't needed)
+        :type ordering_key: object
+        :param callback: Output block callback
+        :type callback: callable
+
+        """
+        future = self.writer.try_submit_ordered(
+            ordering_key, callback, *args, **kwargs)
+        if future is None:
+            LOGGER.warning('Writer queue full, best-effort batch dropped')
+
+    def fields(self, *args, **kwargs):
+        # type: (*Any, **Any) -> Optional[List[str]]
+        """Get the message fields read by the output block callback.
+
+        :param args: Positional arguments to the output block
+        :type args: list
+        :param kwargs: Keyword arguments to the output block
+        :type kwargs: dict(str)
+        :returns: Dotted paths or None if the whole messages are needed
+        :rtype: list(str) | None
+
+        """
+        kwargs.pop('ordering_key', None)
+        kwargs.pop('wait', None)
+        fields_method = getattr(self.block, 'fields', None)
+        if fields_method is None:
+            return None
+        return fields_method(*args, **kwargs)
@@ -1,19 +1,33 @@
 from typing import (  # noqa
+    Any,
+    Callable,
     Dict,
+    Iterator,
     List,
     Optional,
+    Tuple,
 )
 
+ANY = object()  # type: Any
+
 
 class Signal(object):
-    def __init__(self):
-        # type: () -> None
-        pass
+    def __init__(self, doc=None):
+        # type: (Optional[str]) -> None
+        self.receivers = {}  # type: Dict[Any, Any]
 
-    def connect(self, receiver, weak):
-        # type: (object, bool) -> None
-        pass
+    def connect(self, receiver, sender=ANY, weak=True):
+        # type: (Callable, Any, bool) -> Callable
+        return receiver
 
-    def send(self, sender, **kwargs):
-        # type: (Optional[object], List[Dict[str, object]]) -> None
+    def disconnect(self, receiver, sender=ANY):
+        # type: (Callable, Any) -> None
         pass
+
+    def receivers_for(self, sender):
+        # type: (Any) -> Iterator[Callable]
+        return iter([])
+
+    def send(self, *sender, **kwargs):
+        # type: (*Any, **Any) -> List[Tuple[Callable, Any]]
+        return []
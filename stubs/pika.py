@@ -9,3 +9,12 @@ class BlockingConnection(object):
 
     def channel(self):
         pass
+
+    def add_callback_threadsafe(self, callback):
+        pass
+
+    def process_data_events(self, time_limit=0):
+        pass
+
+    def close(self):
+        pass
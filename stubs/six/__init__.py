@@ -4,3 +4,7 @@ def iteritems(dictonary):
 
 class StringIO(object):
     pass
+
+
+string_types = (str, )
+text_type = str
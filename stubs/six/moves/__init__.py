@@ -0,0 +1,14 @@
+from typing import Any
+
+
+class builtins(object):
+    pass
+
+
+def range(*args):
+    # type: (*int) -> Any
+    pass
+
+
+BaseHTTPServer = Any  # type: Any
+socketserver = Any  # type: Any
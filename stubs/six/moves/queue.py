@@ -0,0 +1,27 @@
+from typing import Any, Optional  # noqa
+
+
+class Queue(object):
+    def __init__(self, maxsize=0):
+        # type: (int) -> None
+        pass
+
+    def put(self, item, block=True, timeout=None):
+        # type: (Any, bool, Optional[float]) -> None
+        pass
+
+    def put_nowait(self, item):
+        # type: (Any) -> None
+        pass
+
+    def get(self, block=True, timeout=None):
+        # type: (bool, Optional[float]) -> Any
+        pass
+
+
+class Empty(Exception):
+    pass
+
+
+class Full(Exception):
+    pass
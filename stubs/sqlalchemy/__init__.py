@@ -1,4 +1,4 @@
-def create_engine(url):
+def create_engine(url, **kwargs):
     pass
 
 
@@ -1,2 +1,18 @@
 class SQLAlchemyError(Exception):
     pass
+
+
+class DBAPIError(SQLAlchemyError):
+    pass
+
+
+class DataError(DBAPIError):
+    pass
+
+
+class IntegrityError(DBAPIError):
+    pass
+
+
+class OperationalError(DBAPIError):
+    pass
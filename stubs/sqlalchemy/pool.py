@@ -0,0 +1,2 @@
+class QueuePool(object):
+    pass
@@ -2,5 +2,9 @@ def load(file_):
     pass
 
 
+def safe_load(file_):
+    pass
+
+
 class YAMLError(Exception):
     pass
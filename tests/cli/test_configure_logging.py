@@ -3,6 +3,7 @@
 """Logging configuration test cases."""
 
 import logging
+import threading
 
 import pytest
 
@@ -10,54 +11,78 @@ from mock import patch
 from six.moves import builtins
 
 from rabbithole.cli import configure_logging
+from rabbithole.logs import QueueHandler
 
+requires_queue_handler = pytest.mark.skipif(
+    QueueHandler is None,
+    reason='Queue handlers not available',
+)
 
-@pytest.fixture
-def logger():
+
+@pytest.fixture(name='listener')
+def fixture_listener():
     """Remove handlers from root logger after each test case."""
-    yield
+    listeners = []
     root_logger = logging.getLogger()
-    root_logger.handlers = []
+    handlers = root_logger.handlers[:]
+    level = root_logger.level
+    yield listeners
+    for listener in listeners:
+        if listener is not None:
+            listener.stop()
+    root_logger.handlers = handlers
+    root_logger.setLevel(level)
 
 
-@pytest.mark.usefixtures('logger')
-def test_root_level_set_to_debug():
-    """Root logger level set to debug."""
-    configure_logging(logging.ERROR, None)
+def test_root_level_set_to_argument(listener):
+    """Root logger level set to argument value."""
+    listener.append(configure_logging(logging.ERROR, None))
     root_logger = logging.getLogger()
-    assert root_logger.level == logging.DEBUG
+    assert root_logger.level == logging.ERROR
+    assert not logging.getLogger('rabbithole').isEnabledFor(logging.DEBUG)
 
 
-@pytest.mark.usefixtures('logger')
-def test_stream_handler_level():
+@requires_queue_handler
+def test_stream_handler_level(listener):
     """Stream handler level set to argument value."""
     expected_value = logging.ERROR
-    configure_logging(expected_value, None)
-    root_logger = logging.getLogger()
-    # pytest its own handler
-    assert len(root_logger.handlers) == 2
-    handler = root_logger.handlers[1]
-    assert isinstance(handler, logging.StreamHandler)
-    assert handler.level == expected_value
+    listener.append(configure_logging(expected_value, None))
+    assert isinstance(logging.getLogger().handlers[-1], QueueHandler)
+    handlers = listener[0].handlers
+    assert len(handlers) == 1
+    assert isinstance(handlers[0], logging.StreamHandler)
+    assert handlers[0].level == expected_value
 
 
-@pytest.mark.usefixtures('logger')
-def test_file_handler_level():
+@requires_queue_handler
+def test_file_handler_level(listener):
     """File handler level set to argument value."""
     expected_value = logging.ERROR
     with patch('{}.open'.format(builtins.__name__)):
-        configure_logging(expected_value, '<a file>')
-    root_logger = logging.getLogger()
-    # pytest its own handler
-    assert len(root_logger.handlers) == 3
-    handler = root_logger.handlers[2]
-    assert isinstance(handler, logging.FileHandler)
-    assert handler.level == expected_value
+        listener.append(configure_logging(expected_value, '<a file>'))
+    handlers = listener[0].handlers
+    assert len(handlers) == 2
+    assert isinstance(handlers[1], logging.FileHandler)
+    assert handlers[1].level == expected_value
+
+
+@requires_queue_handler
+def test_records_written_in_listener_thread(listener):
+    """Records written by the listener thread."""
+    threads = []
+    listener.append(configure_logging(logging.DEBUG, None))
+    with patch.object(listener[0].handlers[0], 'emit') as emit:
+        emit.side_effect = (
+            lambda record: threads.append(threading.current_thread()))
+        logging.getLogger('rabbithole').debug('<message>')
+        listener[0].stop()
+        listener[:] = []
+    assert threads
+    assert threading.current_thread() not in threads
 
 
-@pytest.mark.usefixtures('logger')
-def test_pika_level_set_warning():
+def test_pika_level_set_warning(listener):
     """Pika logger level is set to warning."""
-    configure_logging(logging.DEBUG, None)
+    listener.append(configure_logging(logging.DEBUG, None))
     pika_logger = logging.getLogger('pika')
     assert pika_logger.level == logging.WARNING
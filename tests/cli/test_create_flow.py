@@ -73,3 +73,96 @@ def test_exit_on_output_cb_error(output_block, kwargs):
     with pytest.raises(SystemExit) as exc_info:
         create_flow(**kwargs)
     assert exc_info.value.code == 1
+
+
+def test_output_fields(input_block, output_block, kwargs):
+    """Fields used by the output block passed to the input block."""
+    kwargs['flow'] = [
+        {'name': 'input', 'kwargs': {'exchange': '<exchange>'}},
+        {'name': 'output', 'kwargs': {'query': '<query>'}},
+    ]
+    output_block.fields.return_value = ['<field>']
+
+    with patch('rabbithole.cli.Batcher'):
+        create_flow(**kwargs)
+
+    output_block.fields.assert_called_once_with(query='<query>')
+    input_block.assert_called_once_with(
+        exchange='<exchange>', fields=['<field>'])
+
+
+def test_output_fields_not_available(input_block, output_block, kwargs):
+    """Fields not passed when the output block doesn't set them."""
+    output_block.fields.return_value = None
+
+    with patch('rabbithole.cli.Batcher'):
+        create_flow(**kwargs)
+
+    input_block.assert_called_once_with()
+
+
+def test_batcher_named_after_flow(kwargs):
+    """Batcher metrics labelled with the flow name."""
+    kwargs['flow'] = [
+        {'name': 'input', 'kwargs': {'exchange': '<exchange>'}},
+        {'name': 'output'},
+    ]
+    kwargs['batcher_config'] = {'size_limit': 10}
+
+    with patch('rabbithole.cli.Batcher') as batcher_cls:
+        create_flow(**kwargs)
+
+    batcher_cls.assert_called_once_with(
+        name='input/<exchange>/output', size_limit=10)
+
+
+def test_batcher_config_override(kwargs):
+    """Batcher configuration overridden by the flow output block."""
+    kwargs['flow'][1]['batcher'] = {'time_limit': 1}
+    kwargs['batcher_config'] = {'size_limit': 10, 'time_limit': 5}
+
+    with patch('rabbithole.cli.Batcher') as batcher_cls:
+        create_flow(**kwargs)
+
+    batcher_cls.assert_called_once_with(
+        name='input/output', size_limit=10, time_limit=1)
+
+
+def test_exit_on_batcher_error(kwargs):
+    """Exit on error trying to create the batcher."""
+    with patch('rabbithole.cli.Batcher') as batcher_cls:
+        batcher_cls.side_effect = TypeError()
+        with pytest.raises(SystemExit) as exc_info:
+            create_flow(**kwargs)
+    assert exc_info.value.code == 1
+
+
+def test_batcher_shared_by_flows(input_block, kwargs):
+    """Flows with the same input signal and configuration share a batcher."""
+    block = Mock(return_value=Mock(return_value=True))
+    kwargs['namespace']['archive'] = block
+    kwargs['batchers'] = {}
+    create_flow(**kwargs)
+    kwargs['flow'] = [{'name': 'input'}, {'name': 'archive'}]
+    create_flow(**kwargs)
+
+    input_block.return_value.connect.assert_called_once()
+    (batcher, ) = kwargs['batchers'].values()
+    batcher.send_batch(['payload'], [], 'size')
+    kwargs['namespace']['output'].return_value.assert_called_once_with(
+        batcher, batch=['payload'])
+    sender = block.return_value.call_args[0][0]
+    assert sender.batcher is batcher
+    assert sender.name == 'input/archive'
+
+
+def test_batcher_not_shared_with_different_config(input_block, kwargs):
+    """Flows with different batcher configurations get their own batcher."""
+    kwargs['batchers'] = {}
+    create_flow(**kwargs)
+    kwargs['flow'] = [{'name': 'input'}, {'name': 'output', 'batcher': {
+        'size_limit': 1}}]
+    create_flow(**kwargs)
+
+    assert input_block.return_value.connect.call_count == 2
+    assert len(kwargs['batchers']) == 2
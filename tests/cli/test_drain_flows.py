@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""Drain flows test cases."""
+
+from mock import MagicMock as Mock
+
+from rabbithole.cli import drain_flows
+
+
+def test_flows_drained_in_order():
+    """Inputs stopped, batches flushed and written, then inputs closed."""
+    manager = Mock()
+    thread = manager.thread
+    thread.name = '<input>'
+    namespace = {'<input>': manager.input, '<output>': manager.output}
+    manager.writer.close.return_value = True
+
+    drain_flows(namespace, [thread], [manager.batcher], [manager.writer], 30)
+
+    assert [
+        name for name, _args, _kwargs in manager.mock_calls
+        if not name.endswith('__bool__')
+    ] == [
+        'input.stop',
+        'batcher.flush',
+        'writer.close',
+        'input.close',
+        'thread.join',
+    ]
+    timeout = manager.input.stop.call_args[0][0]
+    assert 0 < timeout <= 30
+
+
+def test_blocks_without_stop_method():
+    """Input blocks that can't be stopped are ignored."""
+    block_instance = object()
+    thread = Mock()
+    thread.name = '<input>'
+
+    drain_flows({'<input>': block_instance}, [thread], [], [], 30)
+    thread.join.assert_called_once()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""Changed blocks test cases."""
+
+import copy
+
+from rabbithole.cli import get_changed_blocks
+
+CONFIG = {
+    'size_limit': 10,
+    'blocks': [
+        {'name': 'input', 'type': 'amqp', 'kwargs': {'url': '<url>'}},
+        {'name': 'events', 'type': 'amqp', 'kwargs': {'url': '<url>'}},
+        {'name': 'output', 'type': 'sql', 'kwargs': {'url': '<url>'}},
+    ],
+    'flows': [
+        [
+            {'name': 'input', 'kwargs': {'exchange': 'logs'}},
+            {'name': 'output', 'kwargs': {'query': '<query>'}},
+        ],
+        [
+            {'name': 'events', 'kwargs': {'exchange': 'events'}},
+            {'name': 'output', 'kwargs': {'query': '<query>'}},
+        ],
+    ],
+}
+
+
+def test_nothing_changed():
+    """No block replaced when the configuration is the same."""
+    assert get_changed_blocks(CONFIG, copy.deepcopy(CONFIG)) == set()
+
+
+def test_flow_changed():
+    """No block replaced when a flow changes."""
+    config = copy.deepcopy(CONFIG)
+    config['flows'][0][0]['kwargs']['routing_keys'] = 'error'
+    assert get_changed_blocks(CONFIG, config) == set()
+
+
+def test_flow_added():
+    """No block replaced when a flow is added."""
+    config = copy.deepcopy(CONFIG)
+    config['flows'].append([
+        {'name': 'events', 'kwargs': {'exchange': 'audit'}},
+        {'name': 'output', 'kwargs': {'query': '<query>'}},
+    ])
+    assert get_changed_blocks(CONFIG, config) == set()
+
+
+def test_output_block_changed():
+    """Only the output block is replaced when its configuration changes."""
+    config = copy.deepcopy(CONFIG)
+    config['blocks'][2]['kwargs']['url'] = '<other url>'
+    assert get_changed_blocks(CONFIG, config) == {'output'}
+
+
+def test_role_changed():
+    """Block replaced when it's used as output only in one configuration."""
+    config = copy.deepcopy(CONFIG)
+    config['flows'] = [[
+        {'name': 'input', 'kwargs': {'exchange': 'logs'}},
+        {'name': 'events', 'kwargs': {'exchange': 'copy'}},
+    ]]
+    assert get_changed_blocks(CONFIG, config) == {'events', 'output'}
+
+
+def test_removed_block_not_included():
+    """Removed blocks aren't replaced, they're just drained."""
+    config = copy.deepcopy(CONFIG)
+    del config['blocks'][1]
+    del config['flows'][1]
+    assert get_changed_blocks(CONFIG, config) == set()
+
+
+def test_settings_changed():
+    """All blocks replaced when shared settings change."""
+    config = dict(CONFIG, writer_threads=4)
+    assert get_changed_blocks(CONFIG, config) == {'input', 'events', 'output'}
+
+
+def test_batcher_settings_changed():
+    """No block replaced when only the batcher settings change."""
+    config = dict(CONFIG, size_limit=20, time_limit=5)
+    assert get_changed_blocks(CONFIG, config) == set()
+
+
+def test_reload_settings_changed():
+    """No block replaced when only settings applied on reload change."""
+    config = dict(CONFIG, shutdown_timeout=5, metrics_port=9100)
+    assert get_changed_blocks(CONFIG, config) == set()
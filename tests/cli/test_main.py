@@ -2,26 +2,132 @@
 
 """Main entry point test cases."""
 
-from mock import patch
+import pytest
 
-from rabbithole.cli import main
+from mock import (
+    ANY,
+    MagicMock as Mock,
+    patch,
+)
 
+from rabbithole.cli import (
+    main,
+    run_flows,
+)
 
-def test_exit_on_keyboard_interrupt():
-    """Exit when user hits Ctrl+C."""
+
+@pytest.fixture(name='args')
+def fixture_args():
+    """Patch command line arguments parsing."""
     with patch('rabbithole.cli.parse_arguments') as parse_arguments_, \
-            patch('rabbithole.cli.configure_logging'), \
-            patch('rabbithole.cli.create_block_instance'), \
-            patch('rabbithole.cli.create_flow'), \
+            patch('rabbithole.cli.configure_logging'):
+        args = {
+            'config': {
+                'blocks': [
+                    {'name': '<block#1>'},
+                    {'name': '<block#2>'},
+                ],
+                'flows': [
+                    [{'name': '<block#1>'}, {'name': '<block#2>'}],
+                    [{'name': '<block#1>'}, {'name': '<block#2>'}],
+                ],
+            },
+            'config_file': '<config_file>',
+            'log_level': '<log_level>',
+            'log_file': None,
+            'runtime': 'threading',
+            'workers': None,
+            'metrics_port': None,
+        }
+        parse_arguments_.return_value = args
+        yield args
+
+
+def test_exit_on_keyboard_interrupt(args):
+    """Exit when user hits Ctrl+C."""
+    with patch('rabbithole.cli.create_block_instance') as create_block, \
+            patch('rabbithole.cli.BatchWriter') as batch_writer_cls, \
+            patch('rabbithole.cli.create_flow') as create_flow, \
             patch('rabbithole.cli.run_input_blocks'), \
             patch('rabbithole.cli.time') as time:
-        parse_arguments_().config = {
-            'blocks': [
-                {'name': '<block#1>'},
-                {'name': '<block#2>'},
-            ],
-            'flows': ['<flow#1>', '<flow#2>'],
-        }
+        create_block().writers = None
         time.sleep.side_effect = KeyboardInterrupt
         return_code = main()
         assert return_code == 0
+    assert create_flow.call_count == len(args['config']['flows'])
+    batch_writer_cls.assert_called_once_with('<block#2>', None, None)
+
+
+def test_drain_on_sigterm(args):
+    """Flows drained when SIGTERM is received."""
+    with patch('rabbithole.cli.create_block_instance') as create_block, \
+            patch('rabbithole.cli.BatchWriter') as batch_writer_cls, \
+            patch('rabbithole.cli.create_flow'), \
+            patch('rabbithole.cli.run_input_blocks') as run_input_blocks, \
+            patch('rabbithole.cli.drain_flows') as drain_flows, \
+            patch('rabbithole.cli.signal') as signal, \
+            patch('rabbithole.cli.time') as time:
+        create_block().writers = None
+        thread = Mock()
+        thread.name = '<block#1>'
+        run_input_blocks.return_value = [thread]
+        time.sleep.side_effect = (
+            lambda _delay: signal.signal.call_args_list[0][0][1](15, None))
+        return_code = main()
+        assert return_code == 0
+    drain_flows.assert_called_once_with(
+        ANY,
+        [thread],
+        [],
+        [batch_writer_cls.return_value],
+        30,
+        [create_block.return_value],
+    )
+
+
+def test_reload_on_sighup(args):
+    """Configuration reloaded when SIGHUP is received."""
+    with patch('rabbithole.cli.create_block_instance') as create_block, \
+            patch('rabbithole.cli.BatchWriter'), \
+            patch('rabbithole.cli.create_flow'), \
+            patch('rabbithole.cli.run_input_blocks'), \
+            patch('rabbithole.cli.load_config') as load_config, \
+            patch('rabbithole.cli.RunningFlows') as running_flows_cls, \
+            patch('rabbithole.cli.signal') as signal, \
+            patch('rabbithole.cli.time') as time:
+        create_block().writers = None
+        handlers = {}
+        signal.signal.side_effect = (
+            lambda signum, handler: handlers.update({signum: handler}))
+        signums = iter([signal.SIGHUP, signal.SIGTERM])
+        time.sleep.side_effect = (
+            lambda _delay: handlers[next(signums)](0, None))
+        assert main() == 0
+
+    flows = running_flows_cls.return_value
+    assert flows.update.call_args_list == [
+        ((args['config'], ), {}),
+        ((load_config.return_value, ), {}),
+    ]
+    load_config.assert_called_once_with('<config_file>', {})
+    flows.drain.assert_called_once_with()
+
+
+def test_asyncio_runtime(args):
+    """Flows run by the asyncio runtime when requested."""
+    args['runtime'] = 'asyncio'
+    with patch('rabbithole.aio.main') as asyncio_main:
+        asyncio_main.return_value = 0
+        return_code = main()
+        asyncio_main.assert_called_once_with(args['config'])
+        assert return_code == 0
+
+
+def test_workers(args):
+    """Flows run by the supervisor when multiple workers are requested."""
+    args['workers'] = 2
+    with patch('rabbithole.cli.Supervisor') as supervisor_cls:
+        supervisor_cls().run.return_value = 0
+        return_code = main()
+        supervisor_cls.assert_called_with(args['config'], 2, run_flows, ANY)
+        assert return_code == 0
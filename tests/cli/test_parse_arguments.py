@@ -30,6 +30,18 @@ def test_config_file_invalid():
         parse_arguments(['some file'])
 
 
+def test_config_file_python_tags_rejected():
+    """Only plain YAML is loaded from the configuration file."""
+    with pytest.raises(SystemExit), \
+            patch('rabbithole.cli.sys.stderr'), \
+            patch('rabbithole.cli.os') as os_, \
+            patch('{}.open'.format(builtins.__name__)) as open_:
+        os_.path.isfile.return_value = True
+        open_().__enter__.return_value = StringIO(
+            '!!python/object/apply:os.getcwd []')
+        parse_arguments(['some file'])
+
+
 def test_config_file_load_success():
     """Config file successfully loaded."""
     expected_value = {'a': 'value'}
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""Running flows test cases."""
+
+import copy
+import json
+import threading
+
+import pytest
+
+from mock import (
+    MagicMock as Mock,
+    patch,
+)
+
+from rabbithole.batcher import Batcher
+from rabbithole import cli
+from rabbithole.cli import RunningFlows
+from rabbithole.signals import Signal
+
+CONFIG = {
+    'blocks': [
+        {'name': 'input', 'type': 'amqp'},
+        {'name': 'events', 'type': 'amqp'},
+        {'name': 'output', 'type': 'sql'},
+    ],
+    'flows': [
+        [
+            {'name': 'input', 'kwargs': {'exchange': 'logs'}},
+            {'name': 'output', 'kwargs': {'query': '<query>'}},
+        ],
+        [
+            {'name': 'events', 'kwargs': {'exchange': 'events'}},
+            {'name': 'output', 'kwargs': {'query': '<query>'}},
+        ],
+    ],
+}
+
+
+@pytest.fixture(name='blocks')
+def fixture_blocks():
+    """Patch block creation and threads."""
+    with patch('rabbithole.cli.create_block_instance') as create_block, \
+            patch('rabbithole.cli.BatchWriter') as batch_writer_cls, \
+            patch('rabbithole.cli.create_flow') as create_flow, \
+            patch('rabbithole.cli.run_input_blocks') as run_input_blocks, \
+            patch('rabbithole.cli.drain_flows') as drain_flows:
+        create_block.side_effect = lambda block: Mock(name=block['name'])
+        batch_writer_cls.side_effect = lambda name, *args: Mock(name=name)
+        signals = {}
+
+        def connect_flow(flow, namespace, batcher_config, batchers):
+            """Connect a batcher per input signal to a receiver per flow."""
+            input_block, output_block = flow
+            signal = signals.setdefault(
+                (
+                    id(namespace[input_block['name']]),
+                    json.dumps(input_block, sort_keys=True),
+                ),
+                Signal(),
+            )
+            batcher_key = (
+                id(signal), json.dumps(batcher_config, sort_keys=True))
+            if batcher_key not in batchers:
+                batchers[batcher_key] = Batcher(scheduler=Mock())
+                signal.connect(
+                    batchers[batcher_key].message_received_cb, weak=False)
+            receiver = Mock(name=output_block['name'])
+            batchers[batcher_key].batch_ready.connect(receiver, weak=False)
+            return signal, batcher_key, receiver
+
+        def run_blocks(namespace):
+            """Create a thread per input block."""
+            threads = []
+            for name, block_instance in namespace.items():
+                if not hasattr(block_instance, 'run'):
+                    continue
+                thread = Mock()
+                thread.name = name
+                threads.append(thread)
+            return threads
+
+        create_flow.side_effect = connect_flow
+        run_input_blocks.side_effect = run_blocks
+        yield create_block, create_flow, drain_flows
+
+
+def test_changed_flow_keeps_blocks(blocks):
+    """Changed flow replaced without replacing any block."""
+    create_block, create_flow, drain_flows = blocks
+    flows = RunningFlows()
+    flows.update(CONFIG)
+    assert create_block.call_count == 3
+    assert create_flow.call_count == 2
+    namespace = dict(flows.namespace)
+    events_batchers = dict(flows.batchers['events'])
+    old_flow = flows.flows[sorted(flows.flows)[1]]
+    assert old_flow[0] == CONFIG['flows'][0]
+
+    config = copy.deepcopy(CONFIG)
+    config['flows'][0][0]['kwargs']['routing_keys'] = 'error'
+    create_block.reset_mock()
+    create_flow.reset_mock()
+    flows.update(config)
+
+    create_block.assert_not_called()
+    create_flow.assert_called_once()
+    assert create_flow.call_args[0][0] == config['flows'][0]
+    assert flows.namespace == namespace
+    assert flows.batchers['events'] == events_batchers
+    drain_flows.assert_not_called()
+
+    # Old flow removed from the input block that keeps running
+    _flow, signal, batcher_key, _receiver = old_flow
+    assert batcher_key not in flows.batchers['input']
+    assert not signal.receivers
+    namespace['input'].remove_signal.assert_called_once_with(signal)
+
+
+def test_batches_moved_to_new_output(blocks):
+    """Flows moved to the new output block before closing the old one."""
+    create_block, create_flow, drain_flows = blocks
+    flows = RunningFlows()
+    flows.update(CONFIG)
+    namespace = dict(flows.namespace)
+    batchers = {
+        name: dict(input_batchers)
+        for name, input_batchers in flows.batchers.items()
+    }
+    writer = flows.writers['output']
+    old_receivers = [record[3] for record in flows.flows.values()]
+
+    config = copy.deepcopy(CONFIG)
+    config['blocks'][2]['kwargs'] = {'url': '<other url>'}
+    create_block.reset_mock()
+    create_flow.reset_mock()
+    drain_flows.side_effect = lambda *args: events.append('drained')
+    events = []
+    for batcher in flows.batchers['input'].values():
+        batcher.batch_ready.connect(
+            lambda *args, **kwargs: events.append('sent'), weak=False)
+        batcher.message_received_cb('<sender>', payload={})
+    flows.update(config)
+
+    create_block.assert_called_once_with(config['blocks'][2])
+    assert create_flow.call_count == 2
+    assert flows.namespace['input'] is namespace['input']
+    assert flows.namespace['events'] is namespace['events']
+    assert flows.namespace['output'] is not namespace['output']
+    assert flows.batchers == batchers
+    for record in flows.flows.values():
+        assert record[3] not in old_receivers
+
+    # Pending messages sent to the old output before it's closed
+    assert events == ['sent', 'drained']
+    old_receivers[0].assert_called_once()
+    _namespace, threads, _batchers, writers, _timeout, outputs = (
+        drain_flows.call_args[0])
+    assert threads == []
+    assert writers == [writer]
+    assert outputs == [namespace['output'].block]
+
+
+def test_removed_blocks_drained(blocks):
+    """Blocks removed from the configuration are drained."""
+    _create_block, _create_flow, drain_flows = blocks
+    flows = RunningFlows()
+    flows.update(CONFIG)
+    writer = flows.writers['output']
+    output = flows.namespace['output'].block
+    input_block = flows.namespace['input']
+
+    config = {
+        'blocks': CONFIG['blocks'][:1] + [{'name': 'archive', 'type': 'sql'}],
+        'flows': [[
+            {'name': 'input', 'kwargs': {'exchange': 'logs'}},
+            {'name': 'archive', 'kwargs': {'query': '<query>'}},
+        ]],
+    }
+    flows.update(config)
+
+    assert sorted(flows.namespace) == ['archive', 'input']
+    assert flows.namespace['input'] is input_block
+    _namespace, threads, _batchers, writers, _timeout, outputs = (
+        drain_flows.call_args[0])
+    assert [thread.name for thread in threads] == ['events']
+    assert writers == [writer]
+    assert outputs == [output]
+
+
+def test_batcher_settings_changed(blocks):
+    """Batchers replaced without replacing any block."""
+    create_block, create_flow, drain_flows = blocks
+    flows = RunningFlows()
+    flows.update(CONFIG)
+    old_batchers = [
+        batcher
+        for input_batchers in flows.batchers.values()
+        for batcher in input_batchers.values()
+    ]
+    create_block.reset_mock()
+    create_flow.reset_mock()
+
+    flows.update(dict(CONFIG, size_limit=20))
+    create_block.assert_not_called()
+    assert create_flow.call_count == 2
+    drain_flows.assert_not_called()
+    assert all(batcher.closed for batcher in old_batchers)
+
+
+def test_failed_update_keeps_flows(blocks):
+    """Running flows kept when the new configuration can't be applied."""
+    _create_block, create_flow, drain_flows = blocks
+    flows = RunningFlows()
+    flows.update(CONFIG)
+    namespace = dict(flows.namespace)
+    records = dict(flows.flows)
+
+    config = copy.deepcopy(CONFIG)
+    config['flows'][0][0]['kwargs']['routing_keys'] = 'error'
+    config['flows'].append(copy.deepcopy(config['flows'][0]))
+    config['flows'][2][0]['kwargs']['routing_keys'] = 'warning'
+    connect_flow = create_flow.side_effect
+
+    def fail_on_second_flow(*args, **kwargs):
+        """Connect the first flow and fail to create the second one."""
+        if create_flow.call_count > 3:
+            raise SystemExit(1)
+        return connect_flow(*args, **kwargs)
+
+    create_flow.side_effect = fail_on_second_flow
+    with pytest.raises(SystemExit):
+        flows.update(config)
+
+    assert flows.namespace == namespace
+    assert flows.config is CONFIG
+    assert flows.flows == records
+    for _flow, signal, _batcher_key, _receiver in records.values():
+        assert signal.receivers
+    drain_flows.assert_not_called()
+
+
+def test_replaced_database_closed(tmpdir):
+    """Replaced database closed before a new replayer uses its spool."""
+    output_block = {
+        'name': 'output',
+        'type': 'sql',
+        'kwargs': {
+            'url': 'sqlite:///{}'.format(tmpdir.join('db.sqlite')),
+            'spool': {'directory': str(tmpdir.join('spool'))},
+        },
+    }
+    config = {
+        'blocks': [{'name': 'input', 'type': 'jsonl'}, output_block],
+        'flows': [[
+            {'name': 'input', 'args': ['logs']},
+            {'name': 'output', 'args': ['INSERT INTO logs VALUES (1)']},
+        ]],
+    }
+    running = set(threading.enumerate())
+    flows = RunningFlows()
+    flows.update(config)
+    database = flows.namespace['output'].block
+
+    new_config = copy.deepcopy(config)
+    new_config['blocks'][1]['kwargs']['retries'] = 5
+    with patch.object(database.engine, 'dispose') as dispose:
+        flows.update(new_config)
+    dispose.assert_called_once_with()
+    assert not database.replayer.is_alive()
+    assert flows.namespace['output'].block is not database
+    assert len([
+        thread for thread in threading.enumerate()
+        if thread.name == 'spool-replayer' and thread not in running
+    ]) == 1
+
+    flows.drain()
+    assert not flows.namespace['output'].block.replayer.is_alive()
+
+
+def test_replaced_database_restored(tmpdir):
+    """Database restored when the one that replaces it can't be created."""
+    output_block = {
+        'name': 'output',
+        'type': 'sql',
+        'kwargs': {
+            'url': 'sqlite:///{}'.format(tmpdir.join('db.sqlite')),
+            'spool': {'directory': str(tmpdir.join('spool'))},
+        },
+    }
+    config = {
+        'blocks': [{'name': 'input', 'type': 'jsonl'}, output_block],
+        'flows': [[
+            {'name': 'input', 'args': ['logs']},
+            {'name': 'output', 'args': ['INSERT INTO logs VALUES (1)']},
+        ]],
+    }
+    flows = RunningFlows()
+    flows.update(config)
+    database = flows.namespace['output'].block
+    records = dict(flows.flows)
+
+    new_config = copy.deepcopy(config)
+    new_config['blocks'][1]['kwargs']['retries'] = 5
+    create_block_instance = cli.create_block_instance
+
+    def fail_on_new_block(block):
+        """Fail to create the new database."""
+        if block == new_config['blocks'][1]:
+            raise SystemExit(1)
+        return create_block_instance(block)
+
+    with patch('rabbithole.cli.create_block_instance') as create_block:
+        create_block.side_effect = fail_on_new_block
+        with pytest.raises(SystemExit):
+            flows.update(new_config)
+
+    assert flows.config is config
+    assert not database.replayer.is_alive()
+    restored = flows.namespace['output'].block
+    assert restored is not database
+    assert restored.replayer.is_alive()
+    (batcher, ) = flows.batchers['input'].values()
+    assert list(batcher.batch_ready.receivers) != []
+    assert list(flows.flows) == list(records)
+    flows.drain()
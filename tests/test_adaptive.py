@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""Adaptive batch limits test cases."""
+
+import pytest
+
+from rabbithole.adaptive import AimdPolicy
+
+
+@pytest.fixture(name='policy')
+def fixture_policy():
+    """Create policy with a 1 second target latency."""
+    policy = AimdPolicy(
+        target_latency=1.0, min_size=10, max_size=1000, increase=10)
+    policy.size_limit = 100
+    return policy
+
+
+def test_increase_when_full(policy):
+    """Size limit increased after a full batch is written in time."""
+    assert policy.batch_written(100, 'size', 0.01, 0.1, True) == (
+        110, pytest.approx(0.9))
+
+
+def test_no_increase_when_time_exceeded(policy):
+    """Size limit kept when batches aren't filled before the time limit."""
+    assert policy.batch_written(50, 'time', 0.1, 0.1, True)[0] == 100
+
+
+def test_decrease_when_slow(policy):
+    """Size limit decreased when writing is slower than the target."""
+    assert policy.batch_written(100, 'size', 0.01, 2.0, True)[0] == 50
+
+
+def test_decrease_on_failure(policy):
+    """Size limit decreased when a batch couldn't be written."""
+    assert policy.batch_written(100, 'size', 0.01, 0.1, False)[0] == 50
+
+
+def test_limited_to_expected_messages(policy):
+    """Size limit capped to the messages expected within the time limit."""
+    size_limit, time_limit = policy.batch_written(
+        100, 'size', 10.0, 0.5, True)
+    assert time_limit == pytest.approx(0.5)
+    # 10 messages/s during 0.5 seconds, but not below the minimum size
+    assert size_limit == 10
+
+
+def test_bounds(policy):
+    """Size limit kept within bounds."""
+    policy.size_limit = 1000
+    assert policy.batch_written(1000, 'size', 0.01, 0.1, True)[0] == 1000
+    policy.size_limit = 15
+    assert policy.batch_written(15, 'size', 0.01, 5.0, True)[0] == 10
+
+
+def test_invalid_bounds():
+    """Error raised when the minimum size is greater than the maximum."""
+    with pytest.raises(ValueError):
+        AimdPolicy(target_latency=1.0, min_size=10, max_size=5)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Asyncio runtime test cases."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from mock import (
+    ANY,
+    MagicMock as Mock,
+    patch,
+)
+
+asyncio = pytest.importorskip('asyncio')
+
+# pylint:disable=wrong-import-position
+from rabbithole.aio import (  # noqa
+    AsyncioBatcher,
+    AsyncioConsumer,
+    ExecutorOutput,
+    drain_flows,
+)
+
+
+@pytest.fixture(name='loop')
+def fixture_loop():
+    """Create event loop."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(name='connection_cls')
+def fixture_connection_cls():
+    """Patch the asyncio connection adapter."""
+    patcher = patch('rabbithole.aio.AsyncioConnection')
+    connection_cls = patcher.start()
+    yield connection_cls
+    patcher.stop()
+
+
+@pytest.mark.usefixtures('connection_cls')
+def test_exchanges_bound_when_queue_declared(loop):
+    """Exchanges requested before connecting are bound to the queue."""
+    consumer = AsyncioConsumer('amqp://localhost', loop=loop)
+    signal = consumer('<exchange>', exchange_type='fanout')
+    assert consumer('<exchange>') is signal
+
+    consumer.start()
+    channel = Mock()
+    consumer.channel_open_cb(channel)
+    frame = Mock()
+    frame.method.queue = '<queue>'
+    consumer.queue_declared_cb(frame)
+
+    exchange_declare_kwargs = channel.exchange_declare.call_args[1]
+    assert exchange_declare_kwargs['exchange'] == '<exchange>'
+    assert exchange_declare_kwargs['exchange_type'] == 'fanout'
+    exchange_declare_kwargs['callback'](Mock())
+    channel.queue_bind.assert_called_once_with('<queue>', '<exchange>')
+    channel.basic_consume.assert_called_once_with(
+        '<queue>', consumer.message_received_cb)
+
+
+def test_reconnect_on_connection_error(loop):
+    """Reconnection scheduled when connection is lost."""
+    consumer = AsyncioConsumer('amqp://localhost', loop=loop)
+    with patch.object(loop, 'call_later') as call_later:
+        consumer.connection_error_cb(Mock(), Exception('<error>'))
+    call_later.assert_called_once_with(
+        consumer.RECONNECT_DELAY, consumer.start)
+
+
+def test_no_reconnect_after_close(connection_cls, loop):
+    """Connection closed on request isn't reopened."""
+    consumer = AsyncioConsumer('amqp://localhost', loop=loop)
+    consumer.start()
+    connection = connection_cls.return_value
+    connection.is_closed = connection.is_closing = False
+
+    closed = consumer.close_connection()
+    connection.close.assert_called_once_with()
+    with patch.object(loop, 'call_later') as call_later:
+        consumer.connection_error_cb(connection, Exception('<error>'))
+    call_later.assert_not_called()
+    assert closed.done()
+
+
+@pytest.mark.usefixtures('connection_cls')
+def test_drain_flows(loop):
+    """Consumers cancelled and pending batches written before closing."""
+    consumer = AsyncioConsumer('amqp://localhost', loop=loop)
+    consumer.start()
+    consumer.connection.is_closed = True
+    consumer.channel = channel = Mock()
+    consumer.consumer_tags = ['<tag>']
+    channel.basic_cancel.side_effect = (
+        lambda consumer_tag, callback: callback(Mock()))
+
+    block = Mock()
+    executor = ThreadPoolExecutor(max_workers=1)
+    output = ExecutorOutput(block, executor, loop)
+    batcher = AsyncioBatcher(size_limit=5, time_limit=60, loop=loop)
+    batcher.batch_ready.connect(output('<query>'), weak=False)
+    acknowledger = Mock()
+    batcher.message_received_cb('sender', 'payload', 1, acknowledger)
+
+    namespace = {'<input>': consumer, '<output>': output}
+    loop.run_until_complete(drain_flows(namespace, [batcher], 1, loop))
+    executor.shutdown()
+
+    channel.basic_cancel.assert_called_once_with('<tag>', callback=ANY)
+    block.return_value.assert_called_once_with(batcher, batch=['payload'])
+    acknowledger.settle.assert_called_once_with([1], True)
+    block.close.assert_called_once_with(ANY)
+    assert batcher.timer is None
+    assert consumer.closed.done()
+
+
+def test_message_received(loop):
+    """Message decoded, acknowledged and sent through the exchange signal."""
+    consumer = AsyncioConsumer('amqp://localhost', loop=loop)
+    receiver = Mock()
+    consumer('<exchange>').connect(receiver, weak=False)
+    channel = Mock()
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    header_frame = Mock()
+    header_frame.content_type = 'application/json'
+
+    consumer.message_received_cb(
+        channel, method_frame, header_frame, b'{"a": 1}')
+
+    channel.basic_ack.assert_called_once_with(
+        delivery_tag=method_frame.delivery_tag)
+    receiver.assert_called_once_with(consumer, payload={'a': 1}, size=8)
+
+
+def test_batcher_time_limit(loop):
+    """Batch queued by the event loop when time limit is exceeded."""
+    batcher = AsyncioBatcher(size_limit=5, time_limit=0.01, loop=loop)
+    batches = []
+    batcher.batch_ready.connect(
+        lambda sender, batch: batches.append(batch), weak=False)
+
+    batcher.message_received_cb('sender', 'payload')
+    loop.run_until_complete(asyncio.sleep(0.05))
+
+    assert batches == [['payload']]
+    assert batcher.timer is None
+
+
+def test_executor_output(loop):
+    """Output callback run in executor and deliveries settled when done."""
+    block = Mock()
+    block.return_value.return_value = True
+    executor = ThreadPoolExecutor(max_workers=1)
+    output = ExecutorOutput(block, executor, loop)
+
+    batcher = AsyncioBatcher(size_limit=2, loop=loop)
+    batcher.batch_ready.connect(output('<query>'), weak=False)
+    acknowledger = Mock()
+    for delivery_tag in (1, 2):
+        batcher.message_received_cb(
+            'sender', 'payload', delivery_tag, acknowledger)
+    loop.run_until_complete(asyncio.sleep(0.05))
+    executor.shutdown()
+
+    block.assert_called_once_with('<query>')
+    block.return_value.assert_called_once_with(
+        batcher, batch=['payload', 'payload'])
+    acknowledger.settle.assert_called_once_with([1, 2], True)
+
+
+@pytest.mark.usefixtures('connection_cls')
+def test_named_queue_declared(loop):
+    """Named queue declared as durable, bound and consumed once connected."""
+    consumer = AsyncioConsumer('amqp://localhost', loop=loop)
+    consumer('<exchange>', queue='<named>')
+
+    consumer.start()
+    channel = Mock()
+    consumer.channel_open_cb(channel)
+    frame = Mock()
+    frame.method.queue = '<queue>'
+    consumer.queue_declared_cb(frame)
+
+    channel.queue_declare.assert_called_with(
+        '<named>', durable=True, callback=ANY)
+    channel.queue_declare.call_args[1]['callback'](Mock())
+    assert consumer.named_queues == {'<named>': True}
+    channel.exchange_declare.call_args[1]['callback'](Mock())
+    channel.queue_bind.assert_called_once_with('<named>', '<exchange>')
+    assert [call[0][0] for call in channel.basic_consume.call_args_list] == [
+        '<queue>', '<named>']
+
+    # Flows added later are bound right away
+    consumer('<other>', queue='<named>')
+    channel.exchange_declare.call_args[1]['callback'](Mock())
+    channel.queue_bind.assert_called_with('<named>', '<other>')
@@ -3,6 +3,7 @@
 """AMQP input block test cases."""
 
 import json
+import threading
 
 import blinker
 import pytest
@@ -12,7 +13,14 @@ from mock import (
     patch,
 )
 
-from rabbithole.amqp import Consumer
+from sqlalchemy.exc import OperationalError
+
+from rabbithole.amqp import (
+    Acknowledger,
+    Consumer,
+)
+from rabbithole.batcher import Batcher
+from rabbithole.sql import Database
 
 
 @pytest.fixture(name='pika')
@@ -83,6 +91,43 @@ def test_run(channel):
     channel.start_consuming.assert_called_once_with()
 
 
+def test_stop(pika, channel):
+    """Consuming stopped from the connection thread."""
+    connection = pika.BlockingConnection()
+    consumer = Consumer('<server>')
+    consumer('<exchange>')
+    consumer.run()
+
+    consumer.stop(0)
+    assert consumer.stopping.is_set()
+    connection.add_callback_threadsafe.assert_called_once_with(
+        channel.stop_consuming)
+
+
+def test_acknowledger_wait():
+    """Waiting finishes once every message has been settled."""
+    acknowledger = Acknowledger(Mock(), Mock())
+    acknowledger.track(1)
+    assert not acknowledger.wait(0)
+
+    acknowledger.settle([1], True)
+    assert acknowledger.wait(0)
+
+
+def test_close_after_stop(pika, channel):
+    """Connection kept open to send acknowledgements until closed."""
+    connection = pika.BlockingConnection()
+    connection.process_data_events.side_effect = (
+        lambda time_limit: consumer.close())
+    consumer = Consumer('<server>')
+    consumer.stopping.set()
+    consumer.run()
+
+    channel.start_consuming.assert_called_once_with()
+    connection.process_data_events.assert_called_with(time_limit=0)
+    connection.close.assert_called_once_with()
+
+
 @pytest.mark.usefixtures('pika')
 def test_message_content_type():
     """Message discarded when content type is not valid json."""
@@ -150,10 +195,11 @@ def test_message_received():
     consumer = Consumer('<server>')
     signal = consumer(exchange)
 
-    def verify(sender, payload):
+    def verify(sender, payload, size):
         """Verify signal is sent as expected."""
         assert sender == consumer
         assert payload == body
+        assert size == len(json.dumps(body))
 
     signal.connect(verify)
 
@@ -171,3 +217,496 @@ def test_message_received():
 
     channel.basic_ack.assert_called_with(
         delivery_tag=method_frame.delivery_tag)
+
+
+def test_prefetch_count(channel):
+    """Quality of service set when prefetch count is passed."""
+    Consumer('<server>', prefetch_count=100)
+    channel.basic_qos.assert_called_once_with(prefetch_count=100)
+
+
+@pytest.mark.usefixtures('pika')
+def test_decoder():
+    """Message body decoded with the requested backend."""
+    decode = Mock()
+    with patch('rabbithole.amqp.get_decoder') as get_decoder:
+        get_decoder.return_value = ('<decoder>', decode)
+        consumer = Consumer('<server>', decoder='<decoder>')
+    get_decoder.assert_called_once_with('<decoder>')
+    signal = consumer('<exchange>')
+
+    received = []
+    signal.connect(
+        lambda sender, payload, **kwargs: received.append(payload), weak=False)
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    consumer.message_received_cb(Mock(), method_frame, Mock(), b'<body>')
+    decode.assert_called_once_with(b'<body>')
+    assert received == [decode.return_value]
+
+
+@pytest.mark.usefixtures('pika')
+def test_projection():
+    """Only the fields used by the flows of an exchange kept."""
+    consumer = Consumer('<server>')
+    signal = consumer('<exchange>', fields=['a', 'b.c'])
+    assert consumer('<exchange>', fields=['d']) is signal
+
+    received = []
+    signal.connect(
+        lambda sender, payload, **kwargs: received.append(payload), weak=False)
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    body = json.dumps({'a': 1, 'b': {'c': 2, 'e': 3}, 'd': 4, 'f': 5})
+    consumer.message_received_cb(Mock(), method_frame, Mock(), body)
+    assert received == [{'a': 1, 'b': {'c': 2}, 'd': 4}]
+
+    # A flow that needs the whole messages disables the projection
+    consumer('<exchange>')
+    consumer.message_received_cb(Mock(), method_frame, Mock(), body)
+    assert received[-1] == json.loads(body)
+
+
+@pytest.mark.usefixtures('pika')
+def test_payload_log_rate():
+    """Message payloads logged up to the rate limit."""
+    consumer = Consumer('<server>', payload_log_rate=1)
+    consumer('<exchange>')
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+
+    with patch('rabbithole.amqp.LOGGER') as logger:
+        logger.isEnabledFor.return_value = True
+        for _ in range(3):
+            consumer.message_received_cb(Mock(), method_frame, Mock(), '{}')
+        assert logger.debug.call_count == 1
+
+        logger.isEnabledFor.return_value = False
+        with patch.object(consumer, 'log_payload') as log_payload:
+            consumer.message_received_cb(Mock(), method_frame, Mock(), '{}')
+        assert not log_payload.called
+
+
+@pytest.mark.usefixtures('pika')
+def test_message_received_ack_after_commit():
+    """Delivery tag sent with the message instead of acknowledging it."""
+    exchange = '<exchange>'
+    body = '<body>'
+
+    consumer = Consumer('<server>', ack_after_commit=True)
+    signal = consumer(exchange)
+
+    received = []
+
+    def verify(sender, payload, size, delivery_tag, acknowledger):
+        """Verify signal is sent as expected."""
+        received.append((payload, delivery_tag, acknowledger))
+
+    signal.connect(verify)
+
+    channel = Mock()
+    method_frame = Mock()
+    method_frame.exchange = exchange
+    method_frame.delivery_tag = 1
+    header_frame = Mock()
+    header_frame.content_type = 'application/json'
+    consumer.message_received_cb(
+        channel,
+        method_frame,
+        header_frame,
+        json.dumps(body),
+    )
+
+    channel.basic_ack.assert_not_called()
+    assert received == [(body, 1, consumer.acknowledger)]
+    assert consumer.acknowledger.pending == [1]
+
+
+def run_callbacks(connection):
+    """Run callbacks scheduled in the connection thread."""
+    for call in connection.add_callback_threadsafe.call_args_list:
+        callback = call[0][0]
+        callback()
+
+
+def test_acknowledger_multiple_ack():
+    """Settled messages acknowledged at once."""
+    connection = Mock()
+    channel = Mock()
+    acknowledger = Acknowledger(connection, channel)
+    for delivery_tag in range(1, 6):
+        acknowledger.track(delivery_tag)
+
+    acknowledger.settle([1, 2, 3], True)
+    run_callbacks(connection)
+
+    channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+    assert acknowledger.pending == [4, 5]
+
+
+def test_acknowledger_gap():
+    """Messages not acknowledged until previous ones have been settled."""
+    connection = Mock()
+    channel = Mock()
+    acknowledger = Acknowledger(connection, channel)
+    for delivery_tag in range(1, 5):
+        acknowledger.track(delivery_tag)
+
+    acknowledger.settle([3, 4], True)
+    run_callbacks(connection)
+    channel.basic_ack.assert_not_called()
+
+    acknowledger.settle([1, 2], True)
+    run_callbacks(connection)
+    channel.basic_ack.assert_called_once_with(delivery_tag=4, multiple=True)
+    assert acknowledger.pending == []
+    assert acknowledger.settled == {}
+
+
+def test_acknowledger_reject():
+    """Messages rejected when batch couldn't be written."""
+    connection = Mock()
+    channel = Mock()
+    acknowledger = Acknowledger(connection, channel)
+    for delivery_tag in range(1, 4):
+        acknowledger.track(delivery_tag)
+
+    acknowledger.settle([1], True)
+    acknowledger.settle([2, 3], False)
+    run_callbacks(connection)
+
+    channel.basic_nack.assert_any_call(2, requeue=True)
+    channel.basic_nack.assert_any_call(3, requeue=True)
+    channel.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+    assert acknowledger.pending == []
+
+
+def test_dedicated_consumers(pika, channel):
+    """Dedicated queue and connections used when consumers are set."""
+    exchange = '<exchange>'
+
+    consumer = Consumer('<server>')
+    channel.reset_mock()
+    pika.BlockingConnection.reset_mock()
+
+    consumer(exchange, consumers=3)
+    channel.queue_declare.assert_called_once_with(auto_delete=True)
+    assert pika.BlockingConnection.call_count == 3
+    assert channel.basic_consume.call_count == 3
+    assert [name for name, _ in consumer.workers] == [
+        '<exchange>-0',
+        '<exchange>-1',
+        '<exchange>-2',
+    ]
+
+    consumer.run()
+    assert channel.start_consuming.call_count == 4
+
+
+@pytest.mark.parametrize('queue', [None, '<queue>'])
+def test_no_dedicated_consumers(channel, queue):
+    """Error raised when the number of consumers is lower than one."""
+    consumer = Consumer('<server>')
+    channel.reset_mock()
+    with pytest.raises(ValueError):
+        consumer('<exchange>', consumers=0, queue=queue)
+    channel.queue_declare.assert_not_called()
+    channel.queue_bind.assert_not_called()
+
+
+@pytest.mark.usefixtures('pika')
+def test_dedicated_consumers_acknowledger():
+    """Each dedicated connection uses its own acknowledger."""
+    consumer = Consumer('<server>', ack_after_commit=True)
+    consumer('<exchange>', consumers=2)
+    assert len(consumer.acknowledgers) == 1
+
+    with patch('rabbithole.amqp.pika') as pika:
+        pika.BlockingConnection.side_effect = lambda _parameters: Mock()
+        consumer('<other exchange>', consumers=2)
+    assert len(consumer.acknowledgers) == 3
+
+
+def test_routing_keys_bound(channel):
+    """Queue bound once per routing key and a signal created per binding."""
+    channel.queue_declare().method.queue = '<queue>'
+    consumer = Consumer('<server>')
+    errors = consumer(
+        '<exchange>', routing_keys=['*.error', '*.critical'],
+        exchange_type='topic')
+    warnings = consumer(
+        '<exchange>', routing_keys='*.warning', exchange_type='topic')
+
+    assert errors is not warnings
+    channel.exchange_declare.assert_called_once_with(
+        exchange='<exchange>', exchange_type='topic')
+    assert [
+        bind_call[1] for bind_call in channel.queue_bind.call_args_list
+    ] == [
+        {'exchange': '<exchange>', 'queue': '<queue>', 'routing_key': key}
+        for key in ('*.critical', '*.error', '*.warning')
+    ]
+
+
+@pytest.mark.usefixtures('pika')
+def test_message_routed():
+    """Messages sent only through the signals of the bindings they match."""
+    consumer = Consumer('<server>')
+    errors = consumer(
+        '<exchange>', routing_keys='#.error', exchange_type='topic')
+    everything = consumer('<exchange>', exchange_type='topic')
+    receivers = [Mock(), Mock()]
+    errors.connect(receivers[0], weak=False)
+    everything.connect(receivers[1], weak=False)
+
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    for routing_key in ('app.error', 'app.info'):
+        method_frame.routing_key = routing_key
+        consumer.message_received_cb(Mock(), method_frame, Mock(), '{}')
+
+    assert receivers[0].call_count == 1
+    assert receivers[1].call_count == 2
+
+
+def test_dedicated_queues_overlapping_bindings(pika):
+    """Messages only routed through the bindings of the queue they came from.
+
+    Each dedicated queue receives its own copy of a message that matches the
+    bindings of several queues.
+
+    """
+    queue_names = iter(['<errors queue>', '<app queue>'])
+    channels = []
+
+    def create_connection(_parameters):
+        """Create a connection whose channel declares the next queue."""
+        connection = Mock()
+        channels.append(connection.channel())
+        return connection
+
+    pika.BlockingConnection.side_effect = create_connection
+    consumer = Consumer('<server>')
+    channels[0].queue_declare.side_effect = lambda **_kwargs: Mock(
+        method=Mock(queue=next(queue_names)))
+    errors = consumer(
+        '<exchange>', consumers=1, routing_keys='#.error',
+        exchange_type='topic')
+    app = consumer(
+        '<exchange>', consumers=1, routing_keys='app.#',
+        exchange_type='topic')
+    receivers = [Mock(), Mock()]
+    errors.connect(receivers[0], weak=False)
+    app.connect(receivers[1], weak=False)
+
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    method_frame.routing_key = 'app.error'
+    for channel in channels[1:]:
+        callback = channel.basic_consume.call_args[0][0]
+        callback(channel, method_frame, Mock(), '{}')
+
+    assert receivers[0].call_count == 1
+    assert receivers[1].call_count == 1
+
+
+def test_requeue_database_down(channel):
+    """Messages requeued when their batch can't be written to the database."""
+    consumer = Consumer('<server>', ack_after_commit=True)
+    batcher = Batcher(size_limit=1, scheduler=Mock())
+    consumer('<exchange>').connect(batcher.message_received_cb, weak=False)
+    database = Database('sqlite://')
+    database.retry_delay = 0
+    database.connection = Mock()
+    database.connection.execute.side_effect = OperationalError(
+        '<statement>', {}, Exception('<error>'))
+    database.connection.execute.side_effect.connection_invalidated = True
+    batcher.batch_ready.connect(database('<query>'), weak=False)
+
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    method_frame.delivery_tag = 1
+    consumer.message_received_cb(channel, method_frame, Mock(), '{}')
+    run_callbacks(consumer.connection)
+
+    channel.basic_nack.assert_called_once_with(1, requeue=True)
+    channel.basic_ack.assert_not_called()
+
+
+@pytest.mark.usefixtures('pika')
+def test_requeue_disabled():
+    """Rejected messages dropped when requeueing is disabled."""
+    consumer = Consumer('<server>', ack_after_commit=True, requeue=False)
+    consumer('<exchange>', consumers=1)
+    for acknowledger in consumer.acknowledgers.values():
+        acknowledger.track(1)
+        acknowledger.settle([1], False)
+        run_callbacks(acknowledger.connection)
+        acknowledger.channel.basic_nack.assert_called_with(1, requeue=False)
+
+
+def test_acknowledger_several_receivers():
+    """Messages settled once all their receivers have settled them."""
+    connection = Mock()
+    channel = Mock()
+    acknowledger = Acknowledger(connection, channel)
+    acknowledger.track(1, 2)
+    acknowledger.track(2, 2)
+
+    acknowledger.settle([1, 2], True)
+    run_callbacks(connection)
+    channel.basic_ack.assert_not_called()
+
+    acknowledger.settle([1], True)
+    acknowledger.settle([2], False)
+    run_callbacks(connection)
+    channel.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+    channel.basic_nack.assert_called_once_with(2, requeue=True)
+    assert acknowledger.pending == []
+    assert acknowledger.expected == {}
+
+
+@pytest.mark.usefixtures('pika')
+def test_unrouted_message_settled():
+    """Messages that no flow receives settled right away."""
+    consumer = Consumer('<server>', ack_after_commit=True)
+    consumer('<exchange>', routing_keys='logs')
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    method_frame.routing_key = 'events'
+    method_frame.delivery_tag = 1
+    consumer.message_received_cb(Mock(), method_frame, Mock(), '{}')
+
+    assert consumer.acknowledger.pending == []
+
+
+def test_named_queue(channel):
+    """Named queue declared as durable and consumed once."""
+    consumer = Consumer('<server>')
+    signal = consumer('<exchange>', queue='<queue>')
+    assert consumer('<other>', queue='<queue>') is not signal
+
+    channel.queue_declare.assert_called_with(queue='<queue>', durable=True)
+    assert channel.queue_declare.call_count == 2
+    callback = channel.basic_consume.call_args[0][0]
+    assert channel.basic_consume.call_args[1] == {'queue': '<queue>'}
+    assert channel.basic_consume.call_count == 2
+    assert [
+        bind_call[1]['queue']
+        for bind_call in channel.queue_bind.call_args_list
+    ] == ['<queue>', '<queue>']
+
+    # Messages from the named queue aren't sent to flows on other queues
+    shared = consumer('<exchange>')
+    receivers = [Mock(), Mock()]
+    signal.connect(receivers[0], weak=False)
+    shared.connect(receivers[1], weak=False)
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    callback(Mock(), method_frame, Mock(), '{}')
+    assert receivers[0].call_count == 1
+    receivers[1].assert_not_called()
+
+
+def test_named_queue_dedicated_consumers(pika, channel):
+    """Dedicated connections consume from the named queue."""
+    consumer = Consumer('<server>')
+    consumer('<exchange>', queue='<queue>', consumers=2)
+    consumer('<other>', queue='<queue>', consumers=2)
+
+    assert [name for name, _channel in consumer.workers] == [
+        '<queue>-0', '<queue>-1']
+    # Shared queue consumed in the main channel and named one in 2 threads
+    assert channel.basic_consume.call_count == 3
+
+
+def test_flow_added_while_running(pika, channel):
+    """Flows added from another thread use the connection thread."""
+    connection = pika.BlockingConnection()
+    consumer = Consumer('<server>')
+    # Running in a thread other than the current one
+    consumer.thread = threading.Thread()
+
+    def run_in_connection_thread(callback):
+        """Run callback in a new connection thread."""
+        consumer.thread = threading.Thread(target=callback)
+        consumer.thread.start()
+
+    connection.add_callback_threadsafe.side_effect = run_in_connection_thread
+    bound = []
+    channel.queue_bind.side_effect = (
+        lambda **kwargs: bound.append(threading.current_thread()))
+    with patch.object(Consumer, 'start_worker') as start_worker:
+        signal = consumer('<exchange>', consumers=1)
+
+    assert list(consumer.signals.values()) == [signal]
+    assert bound == [consumer.thread]
+    assert consumer.thread is not threading.current_thread()
+    start_worker.assert_called_once_with('<exchange>-0', channel)
+
+
+def test_signal_removed(channel):
+    """Queue unbound and routes dropped for signals that aren't used."""
+    channel.queue_declare().method.queue = '<queue>'
+    consumer = Consumer('<server>')
+    signal = consumer('<exchange>', routing_keys='error')
+    other = consumer('<exchange>', routing_keys='warning')
+
+    consumer.remove_signal(signal)
+    channel.queue_unbind.assert_called_once_with(
+        exchange='<exchange>', queue='<queue>', routing_key='error')
+    assert list(consumer.signals.values()) == [other]
+    assert [
+        route_signal for _binding, route_signal
+        in consumer.routes[None, '<exchange>']
+    ] == [other]
+
+
+@pytest.mark.usefixtures('pika')
+def test_dedicated_queue_removed():
+    """Dedicated connections closed once their queue isn't bound anymore."""
+    consumer = Consumer('<server>', ack_after_commit=True)
+    with patch('rabbithole.amqp.pika') as pika:
+        pika.BlockingConnection.side_effect = lambda _parameters: Mock()
+        signal = consumer('<exchange>', consumers=2)
+    channels = [channel for _name, channel in consumer.workers]
+    connections = [consumer.consuming[channel][0] for channel in channels]
+
+    consumer.remove_signal(signal)
+    assert consumer.workers == []
+    assert consumer.routes == {}
+    for channel, connection in zip(channels, connections):
+        connection.add_callback_threadsafe.assert_called_once_with(
+            channel.stop_consuming)
+
+    # Closed as soon as its messages have been settled
+    acknowledger = consumer.acknowledgers[channels[0]]
+    acknowledger.track(1)
+    connections[0].process_data_events.side_effect = (
+        lambda time_limit: acknowledger.settle([1], True))
+    consumer.consume(channels[0])
+    connections[0].close.assert_called_once_with()
+    assert channels[0] not in consumer.consuming
+    assert channels[1] in consumer.consuming
+
+
+@pytest.mark.usefixtures('pika')
+def test_receivers_listed_before_sending():
+    """Message settled by the receivers it was sent to."""
+    consumer = Consumer('<server>', ack_after_commit=True)
+    signal = consumer('<exchange>')
+    late_receiver = Mock()
+
+    def connect_another(_sender, **kwargs):
+        """Connect a receiver while the message is being sent."""
+        signal.connect(late_receiver, weak=False)
+        kwargs['acknowledger'].settle([kwargs['delivery_tag']], True)
+
+    signal.connect(connect_another, weak=False)
+    method_frame = Mock()
+    method_frame.exchange = '<exchange>'
+    method_frame.delivery_tag = 1
+    consumer.message_received_cb(Mock(), method_frame, Mock(), '{}')
+
+    late_receiver.assert_not_called()
+    assert consumer.acknowledger.pending == []
@@ -11,6 +11,7 @@ from mock import (
 from six.moves import range  # pylint:disable=redefined-builtin
 
 from rabbithole.batcher import Batcher
+from rabbithole.scheduler import Scheduler
 
 
 @pytest.fixture(name='batcher')
@@ -18,7 +19,7 @@ def fixture_batcher():
     """Create a batcher instance."""
     size_limit = 5
     time_limit = 15
-    batcher = Batcher(size_limit, time_limit)
+    batcher = Batcher(size_limit, time_limit, Mock())
     return batcher
 
 
@@ -27,23 +28,47 @@ def test_first_message_received(batcher):
     payload = 'payload'
 
     batcher.batch_ready = Mock()
-    with patch('rabbithole.batcher.threading') as threading:
-        batcher.message_received_cb('sender', payload)
-        threading.Timer.assert_called_once_with(
-            batcher.time_limit,
-            batcher.time_expired_cb,
-        )
+    batcher.message_received_cb('sender', payload)
+    batcher.scheduler.schedule.assert_called_once_with(
+        batcher.time_limit,
+        batcher.time_expired_cb,
+    )
     assert batcher.batch == [payload]
 
 
+def test_timer_cancelled_on_size_limit(batcher):
+    """Timer cancelled when size limit is exceeded."""
+    batcher.batch_ready = Mock()
+    for _ in range(batcher.size_limit):
+        batcher.message_received_cb('sender', 'payload')
+    batcher.scheduler.schedule().cancel.assert_called_once_with()
+    assert batcher.timer is None
+
+
+def test_sub_second_time_limit():
+    """Batch queued by the scheduler when sub-second time limit exceeded."""
+    clock = Mock(return_value=100.0)
+    scheduler = Scheduler(clock=clock, autostart=False)
+    batcher = Batcher(size_limit=5, time_limit=0.25, scheduler=scheduler)
+    batcher.batch_ready = Mock()
+
+    batcher.message_received_cb('sender', 'payload')
+    assert scheduler.run_pending() == 0.25
+    batcher.batch_ready.send.assert_not_called()
+
+    clock.return_value = 100.25
+    assert scheduler.run_pending() is None
+    batcher.batch_ready.send.assert_called_once_with(
+        batcher, batch=['payload'])
+
+
 def test_size_limit_exceeded(batcher):
     """Batch queued when size limit is exceed."""
     payload = 'payload'
 
     batcher.batch_ready = Mock()
-    with patch('rabbithole.batcher.threading'):
-        for _ in range(batcher.size_limit):
-            batcher.message_received_cb('sender', payload)
+    for _ in range(batcher.size_limit):
+        batcher.message_received_cb('sender', payload)
 
     batcher.batch_ready.send.assert_called_with(
         batcher,
@@ -57,14 +82,34 @@ def test_time_limit_exceeded(batcher):
     payload = 'payload'
 
     batcher.batch_ready = Mock()
-    with patch('rabbithole.batcher.threading'):
-        batcher.message_received_cb('sender', payload)
+    batcher.message_received_cb('sender', payload)
     batcher.time_expired_cb()
 
     batcher.batch_ready.send.assert_called_with(batcher, batch=[payload])
     assert batcher.batch == []
 
 
+def test_flush(batcher):
+    """Pending messages sent and timer cancelled when flushed."""
+    batcher.batch_ready = Mock()
+    batcher.message_received_cb('sender', 'payload')
+    batcher.flush()
+
+    batcher.batch_ready.send.assert_called_once_with(
+        batcher, batch=['payload'])
+    batcher.scheduler.schedule().cancel.assert_called_once_with()
+    assert batcher.timer is None
+
+
+def test_flush_empty_batch(batcher):
+    """Nothing sent when there are no pending messages."""
+    batcher.batch_ready = Mock()
+    with patch('rabbithole.batcher.LOGGER') as logger:
+        batcher.flush()
+    batcher.batch_ready.send.assert_not_called()
+    logger.warning.assert_not_called()
+
+
 def test_empty_batch(batcher):
     """Warning written to logs when batch is empty."""
     with patch('rabbithole.batcher.LOGGER') as logger:
@@ -95,3 +140,165 @@ def test_cancelled_timer_not_active(batcher):
         batcher.cancel_timer()
         logger.warning.assert_called_with(
             '[%x] Timer is not active', id(batcher))
+
+
+def test_deliveries_acknowledged(batcher):
+    """Messages acknowledged after batch is written."""
+    payload = 'payload'
+    acknowledger = Mock()
+
+    batcher.batch_ready = Mock()
+    batcher.batch_ready.send.return_value = [('<receiver>', True)]
+    for delivery_tag in range(batcher.size_limit):
+        batcher.message_received_cb(
+            'sender', payload, delivery_tag, acknowledger)
+
+    acknowledger.settle.assert_called_once_with(
+        list(range(batcher.size_limit)), True)
+    assert batcher.deliveries == []
+
+
+def test_deliveries_rejected(batcher):
+    """Messages rejected when batch couldn't be written."""
+    payload = 'payload'
+    acknowledger = Mock()
+
+    batcher.batch_ready = Mock()
+    batcher.batch_ready.send.return_value = [('<receiver>', False)]
+    batcher.message_received_cb('sender', payload, 1, acknowledger)
+    batcher.time_expired_cb()
+
+    acknowledger.settle.assert_called_once_with([1], False)
+
+
+def test_flush_reason_metrics():
+    """Batch size and flush reason recorded for the flow."""
+    batcher = Batcher(size_limit=2, scheduler=Mock(), name='<flow>')
+    batcher.batch_ready = Mock()
+    size_flushes = batcher.flushes['size'].value
+    time_flushes = batcher.flushes['time'].value
+    batch_count = batcher.batch_size.counts[1]
+
+    for _ in range(2):
+        batcher.message_received_cb('sender', 'payload')
+    batcher.message_received_cb('sender', 'payload')
+    batcher.time_expired_cb()
+
+    assert batcher.flushes['size'].value == size_flushes + 1
+    assert batcher.flushes['time'].value == time_flushes + 1
+    # Batch with 2 messages in the (1, 5] bucket
+    assert batcher.batch_size.counts[1] == batch_count + 1
+
+
+def test_size_limit_of_one():
+    """Batch sent as soon as a message is received with size limit of 1."""
+    batcher = Batcher(size_limit=1, scheduler=Mock())
+    batcher.batch_ready = Mock()
+    batcher.message_received_cb('sender', 'payload')
+    batcher.batch_ready.send.assert_called_once_with(
+        batcher, batch=['payload'])
+    batcher.scheduler.schedule.assert_not_called()
+
+
+def test_adaptive_limits():
+    """Limits adjusted once a batch has been written."""
+    batcher = Batcher(
+        size_limit=2,
+        scheduler=Mock(),
+        adaptive={'target_latency': 1.0, 'max_size': 100, 'increase': 3},
+    )
+    assert (batcher.size_limit, batcher.time_limit) == (2, 0.5)
+    batcher.clock = Mock(side_effect=[0.0, 0.2, 0.35])
+    batcher.batch_ready.connect(Mock(return_value=True), weak=False)
+
+    for _ in range(2):
+        batcher.message_received_cb('sender', 'payload')
+
+    # Written in 0.15 seconds and filled at 10 messages/s
+    assert batcher.size_limit == 5
+    assert batcher.time_limit == pytest.approx(0.85)
+
+
+def test_adaptive_limits_size_limit_of_one():
+    """Fill time measured for batches sent as soon as they're started."""
+    batcher = Batcher(
+        size_limit=1,
+        scheduler=Mock(),
+        adaptive={'target_latency': 1.0, 'max_size': 100},
+    )
+    batcher.clock = Mock(side_effect=[10.0, 10.1, 10.2])
+    batcher.batch_written_cb = Mock()
+    batcher.batch_ready.connect(Mock(return_value=True), weak=False)
+
+    batcher.message_received_cb('sender', 'payload')
+    _size, _reason, fill_time, _sent, _success = (
+        batcher.batch_written_cb.call_args[0])
+    assert fill_time == pytest.approx(0.1)
+
+
+def test_bytes_limit():
+    """Batch sent before a message would exceed the bytes limit."""
+    batcher = Batcher(size_limit=10, scheduler=Mock(), bytes_limit=10)
+    batcher.batch_ready = Mock()
+
+    batcher.message_received_cb('sender', 'a', size=4)
+    batcher.message_received_cb('sender', 'b', size=4)
+    batcher.batch_ready.send.assert_not_called()
+
+    batcher.message_received_cb('sender', 'c', size=4)
+    batcher.batch_ready.send.assert_called_once_with(
+        batcher, batch=['a', 'b'])
+    assert batcher.batch == ['c']
+    assert batcher.batch_bytes == 4
+
+
+def test_bytes_limit_oversize_message():
+    """Message larger than the bytes limit sent in a batch on its own."""
+    batcher = Batcher(size_limit=10, scheduler=Mock(), bytes_limit=10)
+    batcher.batch_ready = Mock()
+
+    batcher.message_received_cb('sender', 'a', size=4)
+    batcher.message_received_cb('sender', 'b', size=20)
+
+    assert [
+        call[1]['batch'] for call in batcher.batch_ready.send.call_args_list
+    ] == [['a'], ['b']]
+    assert batcher.batch == []
+    assert batcher.batch_bytes == 0
+
+
+def test_batch_held_while_paused(batcher):
+    """Messages held regardless of the limits until the batcher is resumed."""
+    batcher.batch_ready = Mock()
+    batcher.pause()
+    for _ in range(batcher.size_limit + 1):
+        batcher.message_received_cb('sender', 'payload')
+    batcher.time_expired_cb()
+    batcher.batch_ready.send.assert_not_called()
+
+    batcher.resume()
+    batcher.batch_ready.send.assert_called_once_with(
+        batcher, batch=['payload'] * (batcher.size_limit + 1))
+    assert batcher.batch == []
+
+
+def test_messages_rejected_once_closed(batcher):
+    """Pending messages sent when closed and the rest rejected."""
+    acknowledger = Mock()
+    batcher.batch_ready = Mock()
+    batcher.batch_ready.send.return_value = [('<receiver>', True)]
+    batcher.message_received_cb('sender', 'payload', 1, acknowledger)
+
+    batcher.close()
+    acknowledger.settle.assert_called_once_with([1], True)
+    batcher.message_received_cb('sender', 'payload', 2, acknowledger)
+    acknowledger.settle.assert_called_with([2], False)
+    assert batcher.batch == []
+
+
+def test_batch_without_output_rejected(batcher):
+    """Messages rejected when no output receives their batch."""
+    acknowledger = Mock()
+    batcher.message_received_cb('sender', 'payload', 1, acknowledger)
+    batcher.flush()
+    acknowledger.settle.assert_called_once_with([1], False)
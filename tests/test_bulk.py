@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""Multi-row INSERT test cases."""
+
+import pytest
+
+from mock import (
+    MagicMock as Mock,
+    patch,
+)
+from sqlalchemy import create_engine
+
+from rabbithole.bulk import (
+    MultiRowInsert,
+    get_chunk_sizes,
+    get_parameter_limit,
+)
+
+QUERY = (
+    'INSERT INTO logs (timestamp, message) '
+    'VALUES (CAST(:timestamp AS TEXT), :message) '
+    'ON CONFLICT DO NOTHING'
+)
+
+
+@pytest.fixture(name='engine')
+def fixture_engine():
+    """Create in-memory SQLite engine with a table."""
+    engine = create_engine('sqlite://')
+    engine.execute('CREATE TABLE logs (timestamp TEXT, message TEXT)')
+    return engine
+
+
+def test_query_parsed():
+    """Query split into its parts and parameter names found."""
+    insert = MultiRowInsert(QUERY)
+    assert insert.head == 'INSERT INTO logs (timestamp, message) VALUES '
+    assert insert.row == '(CAST(:timestamp AS TEXT), :message)'
+    assert insert.tail == ' ON CONFLICT DO NOTHING'
+    assert insert.names == ['timestamp', 'message']
+
+
+def test_statement():
+    """Statement contains a VALUES tuple per row."""
+    insert = MultiRowInsert(QUERY)
+    statement = insert.statement(2)
+    assert str(statement) == (
+        'INSERT INTO logs (timestamp, message) VALUES '
+        '(CAST(:timestamp_0 AS TEXT), :message_0), '
+        '(CAST(:timestamp_1 AS TEXT), :message_1) '
+        'ON CONFLICT DO NOTHING'
+    )
+    assert insert.statement(2) is statement
+
+
+def test_parameters():
+    """Parameters flattened from dictionaries and lists."""
+    insert = MultiRowInsert(QUERY)
+    assert insert.parameters([
+        {'timestamp': '<t0>', 'message': '<m0>'},
+        ['<t1>', '<m1>'],
+    ]) == {
+        'timestamp_0': '<t0>',
+        'message_0': '<m0>',
+        'timestamp_1': '<t1>',
+        'message_1': '<m1>',
+    }
+
+
+@pytest.mark.parametrize('query', [
+    'DELETE FROM logs',
+    'INSERT INTO logs (message) VALUES (1',
+    'INSERT INTO logs (message) VALUES (1)',
+])
+def test_invalid_query(query):
+    """Exception raised when query cannot be rewritten."""
+    with pytest.raises(ValueError):
+        MultiRowInsert(query)
+
+
+def test_sqlite_parameter_limit():
+    """SQLite parameter limit depends on the library version."""
+    dialect = Mock()
+    dialect.name = 'sqlite'
+    dialect.dbapi.sqlite_version_info = (3, 31, 1)
+    assert get_parameter_limit(dialect) == 999
+    dialect.dbapi.sqlite_version_info = (3, 32, 0)
+    assert get_parameter_limit(dialect) == 32766
+
+
+def test_rows_inserted_in_chunks(engine):
+    """Rows inserted in chunks that don't exceed the parameter limit."""
+    insert = MultiRowInsert(
+        'INSERT INTO logs (timestamp, message) VALUES (:timestamp, :message)')
+    rows = [
+        {'timestamp': str(index), 'message': '<message>'}
+        for index in range(25)
+    ]
+    connection = engine.connect()
+    with patch('rabbithole.bulk.get_parameter_limit', return_value=20), \
+            patch.object(connection, 'execute', wraps=connection.execute):
+        insert.execute(connection, rows)
+        # Chunks of 10, 10, 4 and 1 rows
+        assert connection.execute.call_count == 4
+
+    count = engine.execute('SELECT COUNT(*) FROM logs').scalar()
+    assert count == 25
+
+
+def test_bulk_insert_strategy(engine):
+    """Dialect specific strategy used when available."""
+    strategy = Mock()
+    insert = MultiRowInsert(QUERY)
+    connection = engine.connect()
+    with patch.dict('rabbithole.bulk.BULK_INSERT_STRATEGIES', sqlite=strategy):
+        insert.execute(connection, [])
+    strategy.assert_called_once_with(connection, insert, [])
+
+
+def test_compiled_statement_cached(engine):
+    """Statement compiled once per number of rows and dialect."""
+    insert = MultiRowInsert(QUERY)
+    compiled = insert.statement(4, engine.dialect)
+    assert insert.statement(4, engine.dialect) is compiled
+    assert len(compiled.params) == 8
+
+
+def test_chunk_sizes():
+    """Rows left after the full chunks split in powers of two."""
+    assert get_chunk_sizes(25, 10) == [10, 10, 4, 1]
+    assert get_chunk_sizes(20, 10) == [10, 10]
+    assert get_chunk_sizes(7, 10) == [4, 2, 1]
+    assert get_chunk_sizes(0, 10) == []
+
+
+def test_statement_cache_bounded(engine):
+    """Only full chunk and power of two statements are cached."""
+    insert = MultiRowInsert(QUERY)
+    chunk_size = insert.chunk_size(engine.dialect)
+    for rows in range(1, 100):
+        insert.statement(rows, engine.dialect)
+    insert.statement(chunk_size, engine.dialect)
+    assert sorted(
+        rows for rows, dialect in insert.statements if dialect is not None
+    ) == [1, 2, 4, 8, 16, 32, 64, chunk_size]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""JSON decoders test cases."""
+
+import json
+
+import pytest
+
+from mock import (
+    MagicMock as Mock,
+    patch,
+)
+
+from rabbithole.decoders import get_decoder
+
+
+def import_module(installed):
+    """Create import function in which only some modules are installed."""
+    def import_module_(name):
+        """Import module if installed."""
+        if name not in installed:
+            raise ImportError(name)
+        return installed[name]
+    return import_module_
+
+
+def test_auto_fastest_backend():
+    """Fastest installed backend used by default."""
+    with patch('rabbithole.decoders.importlib.import_module') as import_:
+        ujson = Mock()
+        import_.side_effect = import_module({'json': json, 'ujson': ujson})
+        assert get_decoder() == ('ujson', ujson.loads)
+
+
+def test_auto_fallback():
+    """Standard library used when no other backend is installed."""
+    with patch('rabbithole.decoders.importlib.import_module') as import_:
+        import_.side_effect = import_module({'json': json})
+        assert get_decoder('auto') == ('json', json.loads)
+
+
+@pytest.mark.parametrize('body', [b'{"a": [1, 2]}', '{"a": [1, 2]}'])
+def test_decode_bytes(body):
+    """Documents decoded from bytes and text."""
+    name, loads = get_decoder('auto')
+    assert loads(body) == {'a': [1, 2]}, name
+
+
+def test_unknown_backend():
+    """Exception raised when backend isn't supported."""
+    with pytest.raises(ValueError):
+        get_decoder('<decoder>')
+
+
+def test_missing_backend():
+    """Exception raised when requested backend isn't installed."""
+    with patch('rabbithole.decoders.importlib.import_module') as import_:
+        import_.side_effect = ImportError('simplejson')
+        with pytest.raises(ImportError):
+            get_decoder('simplejson')
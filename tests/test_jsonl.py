@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""JSON lines input block test cases."""
+
+import gzip
+import io
+import json
+
+import pytest
+
+from mock import (
+    MagicMock as Mock,
+    patch,
+)
+
+from rabbithole.jsonl import (
+    JsonLinesReader,
+    read_lines,
+)
+
+
+def write_lines(path, messages, compress=False):
+    """Write messages to a newline delimited JSON file."""
+    data = b''.join(
+        json.dumps(message).encode('utf-8') + b'\n' for message in messages)
+    open_file = gzip.open if compress else io.open
+    with open_file(str(path), 'wb') as file_:
+        file_.write(data)
+
+
+def connect(signal):
+    """Connect receiver to a signal."""
+    receiver = Mock()
+    signal.connect(receiver, weak=False)
+    return receiver
+
+
+def received(receiver):
+    """Get payloads sent to a receiver."""
+    return [call[1]['payload'] for call in receiver.call_args_list]
+
+
+@pytest.mark.parametrize('buffer_size', [1, 4, 1024])
+def test_read_lines(buffer_size):
+    """Lines split across chunks are joined and empty lines skipped."""
+    file_ = io.BytesIO(b'{"a": 1}\n\n{"b": 2}\r\n{"c": 3}')
+    assert list(read_lines(file_, buffer_size)) == [
+        b'{"a": 1}', b'{"b": 2}\r', b'{"c": 3}']
+
+
+def test_messages_routed_by_key(tmpdir):
+    """Messages sent through the signal for the exchange in their key."""
+    write_lines(tmpdir.join('1.jsonl'), [
+        {'type': 'logs', 'n': 1},
+        {'type': 'events', 'n': 2},
+        {'type': 'unknown', 'n': 3},
+    ])
+    write_lines(tmpdir.join('2.jsonl.gz'), [
+        {'type': 'logs', 'n': 4},
+    ], compress=True)
+
+    reader = JsonLinesReader(
+        str(tmpdir.join('*.jsonl*')), key='type', buffer_size=8)
+    logs = connect(reader('logs'))
+    events = connect(reader('events'))
+    reader.run()
+
+    assert [payload['n'] for payload in received(logs)] == [1, 4]
+    assert [payload['n'] for payload in received(events)] == [2]
+    assert reader.sent == 4
+
+
+def test_messages_sent_to_all_exchanges(tmpdir):
+    """Messages sent through every signal when there's no key field."""
+    write_lines(tmpdir.join('messages.jsonl'), [{'n': 1}])
+    reader = JsonLinesReader(str(tmpdir.join('messages.jsonl')))
+    logs = connect(reader('logs'))
+    events = connect(reader('events'))
+    reader.run()
+
+    assert received(logs) == received(events) == [{'n': 1}]
+
+
+def test_exchange_paths(tmpdir):
+    """Messages in the files set for an exchange sent through its signal."""
+    write_lines(tmpdir.join('logs.jsonl'), [{'n': 1}])
+    write_lines(tmpdir.join('events.jsonl'), [{'n': 2}])
+    reader = JsonLinesReader()
+    logs = connect(reader('logs', paths=str(tmpdir.join('logs.jsonl'))))
+    events = connect(reader('events', paths=[str(tmpdir.join('e*.jsonl'))]))
+    reader.run()
+
+    assert received(logs) == [{'n': 1}]
+    assert received(events) == [{'n': 2}]
+
+
+def test_projection(tmpdir):
+    """Only the fields used by the flows are sent."""
+    write_lines(tmpdir.join('logs.jsonl'), [{'a': {'b': 1, 'c': 2}, 'd': 3}])
+    reader = JsonLinesReader()
+    logs = connect(reader(
+        'logs', paths=str(tmpdir.join('logs.jsonl')), fields=['a.b']))
+    reader.run()
+
+    assert received(logs) == [{'a': {'b': 1}}]
+
+
+def test_stop(tmpdir):
+    """No more messages sent once the reader is stopped."""
+    write_lines(tmpdir.join('logs.jsonl'), [{'n': n} for n in range(3)])
+    reader = JsonLinesReader()
+    logs = connect(reader('logs', paths=str(tmpdir.join('logs.jsonl'))))
+    logs.side_effect = lambda *args, **kwargs: reader.stopping.set()
+    reader.run()
+
+    assert received(logs) == [{'n': 0}]
+    reader.stop(0)
+    assert reader.finished.is_set()
+
+
+def test_decoding_error(tmpdir):
+    """Lines that aren't valid JSON are skipped."""
+    tmpdir.join('logs.jsonl').write_binary(b'{"n": 1}\n<line>\n{"n": 2}\n')
+    reader = JsonLinesReader(decoder='json')
+    logs = connect(reader('logs', paths=str(tmpdir.join('logs.jsonl'))))
+    with patch('rabbithole.jsonl.LOGGER') as logger:
+        reader.run()
+
+    logger.warning.assert_called_once_with(
+        'Line decoding error: %r', b'<line>')
+    assert received(logs) == [{'n': 1}, {'n': 2}]
+
+
+def test_invalid_key(tmpdir):
+    """Messages whose key field isn't an exchange name are skipped."""
+    write_lines(tmpdir.join('logs.jsonl'), [
+        {'type': ['logs'], 'n': 1},
+        {'type': {'name': 'logs'}, 'n': 2},
+        {'type': 'logs', 'n': 3},
+    ])
+    reader = JsonLinesReader(str(tmpdir.join('logs.jsonl')), key='type')
+    logs = connect(reader('logs'))
+    with patch('rabbithole.jsonl.LOGGER') as logger:
+        reader.run()
+
+    assert logger.error.call_count == 2
+    assert received(logs) == [{'type': 'logs', 'n': 3}]
+
+
+def test_rate(tmpdir):
+    """Reading paused to keep the target rate."""
+    write_lines(tmpdir.join('logs.jsonl'), [{'n': n} for n in range(3)])
+    reader = JsonLinesReader(rate=10)
+    reader('logs', paths=str(tmpdir.join('logs.jsonl')))
+    with patch('rabbithole.jsonl.monotonic') as monotonic, \
+            patch('rabbithole.jsonl.time') as time:
+        monotonic.return_value = 100.0
+        reader.run()
+
+    assert [call[0][0] for call in time.sleep.call_args_list] == [
+        pytest.approx(0.1), pytest.approx(0.2)]
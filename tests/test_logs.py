@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""Logging helpers test cases."""
+
+import logging
+
+import pytest
+
+from mock import (
+    MagicMock as Mock,
+    patch,
+)
+from six.moves import queue
+
+from rabbithole.logs import (
+    QueueHandler,
+    RateLimiter,
+    create_child_listener,
+    stop_at_exit,
+)
+
+
+def test_rate_limiter():
+    """Events allowed up to the rate and suppressed events counted."""
+    clock = Mock(return_value=10.0)
+    limiter = RateLimiter(2, clock)
+    assert limiter.allow() == 0
+    assert limiter.allow() == 0
+    assert limiter.allow() is None
+    assert limiter.allow() is None
+
+    clock.return_value = 11.5
+    assert limiter.allow() == 2
+    assert limiter.allow() == 0
+    assert limiter.allow() is None
+
+
+def test_rate_limiter_disabled():
+    """No events allowed when rate is zero."""
+    limiter = RateLimiter(0, Mock(return_value=0))
+    assert limiter.allow() is None
+
+
+@pytest.mark.skipif(
+    QueueHandler is None, reason='Queue handlers not available')
+def test_child_listener_stopped_at_exit():
+    """Records queued before a forked process exits are written."""
+    queue_handler = QueueHandler(queue.Queue())
+    handler = Mock(level=logging.NOTSET)
+    with patch('rabbithole.logs.multiprocessing.util') as util:
+        listener = create_child_listener(queue_handler, [handler])
+    # Registered again when a worker process starts
+    util.register_after_fork.assert_called_once_with(listener, stop_at_exit)
+    finalize = util.Finalize
+    _obj, callback = finalize.call_args[0]
+    assert callback == listener.stop
+    assert finalize.call_args[1] == {'exitpriority': 0}
+
+    record = logging.makeLogRecord(
+        {'msg': '<message>', 'levelno': logging.INFO})
+    queue_handler.handle(record)
+    callback()
+    assert handler.handle.call_count == 1
+    assert handler.handle.call_args[0][0].getMessage() == '<message>'
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""Metrics test cases."""
+
+import pytest
+
+from six.moves.urllib.request import urlopen
+
+from rabbithole.metrics import (
+    Registry,
+    start_http_server,
+)
+
+
+@pytest.fixture(name='registry')
+def fixture_registry():
+    """Create an empty registry."""
+    return Registry()
+
+
+def test_counter(registry):
+    """Counter values rendered per label values."""
+    counter = registry.counter('messages_total', 'Messages', ['exchange'])
+    counter.labels('logs').inc()
+    counter.labels('logs').inc(2)
+    counter.labels('events').inc()
+    assert registry.render() == (
+        '# HELP messages_total Messages\n'
+        '# TYPE messages_total counter\n'
+        'messages_total{exchange="events"} 1.0\n'
+        'messages_total{exchange="logs"} 3.0\n'
+    )
+
+
+def test_histogram(registry):
+    """Histogram buckets rendered as cumulative counts."""
+    histogram = registry.histogram('size', 'Size', buckets=(1, 10))
+    value = histogram.labels()
+    for observation in (1, 5, 20):
+        value.observe(observation)
+    assert registry.render() == (
+        '# HELP size Size\n'
+        '# TYPE size histogram\n'
+        'size_bucket{le="1.0"} 1\n'
+        'size_bucket{le="10.0"} 2\n'
+        'size_bucket{le="+Inf"} 3\n'
+        'size_sum 26.0\n'
+        'size_count 3\n'
+    )
+
+
+def test_label_values_escaped(registry):
+    """Quotes, backslashes and new lines in label values are escaped."""
+    counter = registry.counter('errors_total', 'Errors', ['flow'])
+    counter.labels('a"b\\c\nd').inc()
+    assert 'errors_total{flow="a\\"b\\\\c\\nd"} 1.0' in registry.render()
+
+
+def test_label_values_required(registry):
+    """Error raised when label values don't match label names."""
+    counter = registry.counter('errors_total', 'Errors', ['flow'])
+    with pytest.raises(ValueError):
+        counter.labels()
+
+
+def test_duplicated_metric(registry):
+    """Error raised when a metric with the same name is registered."""
+    registry.counter('errors_total', 'Errors')
+    with pytest.raises(ValueError):
+        registry.counter('errors_total', 'Errors')
+
+
+def test_http_server(registry):
+    """Metrics served over HTTP."""
+    registry.counter('errors_total', 'Errors').labels().inc()
+    server = start_http_server(0, registry=registry)
+    try:
+        response = urlopen(
+            'http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+        assert response.headers['Content-Type'].startswith('text/plain')
+        assert response.read().decode('utf-8') == registry.render()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""Projection test cases."""
+
+import pytest
+
+from rabbithole.projection import (
+    compile_projection,
+    project,
+)
+
+
+@pytest.mark.parametrize('fields, expected', [
+    (['a', 'b.c'], {'a': None, 'b': {'c': None}}),
+    (['a.b', 'a'], {'a': None}),
+    (['a', 'a.b'], {'a': None}),
+    (['a.b.c', 'a.d'], {'a': {'b': {'c': None}, 'd': None}}),
+])
+def test_compile_projection(fields, expected):
+    """Dotted paths compiled into a tree of keys."""
+    assert compile_projection(fields) == expected
+
+
+def test_project():
+    """Only values in the projection kept."""
+    message = {
+        'timestamp': '<timestamp>',
+        'message': {'text': '<text>', 'tags': ['a', 'b']},
+        'source': {'host': '<host>', 'pid': 1234},
+        'context': '<context>',
+        'metrics': {'cpu': 0.5},
+    }
+    tree = compile_projection([
+        'timestamp',
+        'message.text',
+        'source',
+        'context.request',
+        'unknown.value',
+    ])
+    assert project(message, tree) == {
+        'timestamp': '<timestamp>',
+        'message': {'text': '<text>'},
+        'source': {'host': '<host>', 'pid': 1234},
+    }
+
+
+def test_project_not_a_dict():
+    """Messages that aren't dictionaries kept as they are."""
+    assert project(['<message>'], {'a': None}) == ['<message>']
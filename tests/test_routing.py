@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""Routing test cases."""
+
+import pytest
+
+from rabbithole.routing import (
+    Binding,
+    compile_topic,
+    match_headers,
+)
+
+
+@pytest.mark.parametrize('pattern, routing_key, expected', [
+    ('logs.error', 'logs.error', True),
+    ('logs.error', 'logs.errors', False),
+    ('logs.*', 'logs.error', True),
+    ('logs.*', 'logs', False),
+    ('logs.*', 'logs.error.disk', False),
+    ('logs.#', 'logs', True),
+    ('logs.#', 'logs.error.disk', True),
+    ('#.error', 'error', True),
+    ('#.error', 'logs.app.error', True),
+    ('#.error', 'logs.errors', False),
+    ('logs.#.error', 'logs.error', True),
+    ('logs.#.error', 'logs.app.error', True),
+    ('*.error', 'error', False),
+    ('#.#', 'logs.error', True),
+    ('#', '', True),
+])
+def test_topic(pattern, routing_key, expected):
+    """Topic patterns match the same routing keys as in the server."""
+    assert bool(compile_topic(pattern).match(routing_key)) is expected
+
+
+@pytest.mark.parametrize('arguments, expected', [
+    ({'level': 'error', 'app': 'web'}, True),
+    ({'level': 'error', 'app': 'db'}, False),
+    ({'x-match': 'any', 'level': 'error', 'app': 'db'}, True),
+    ({'x-match': 'any', 'level': 'debug', 'app': 'db'}, False),
+    ({'level': None}, True),
+])
+def test_headers(arguments, expected):
+    """Headers match all or any of the binding arguments."""
+    headers = {'level': 'error', 'app': 'web'}
+    assert match_headers(arguments, headers) is expected
+
+
+def test_direct_binding():
+    """Routing keys compared literally in direct exchanges."""
+    binding = Binding('direct', ['logs.*', 'events'])
+    assert binding.matches('events', None)
+    assert not binding.matches('logs.error', None)
+
+
+def test_binding_without_filters():
+    """All messages match bindings without routing keys or arguments."""
+    assert Binding('topic').matches('logs.error', None)
+    assert Binding('fanout', 'logs').matches('events', None)
+
+
+def test_binding_key():
+    """Bindings with the same routing keys and arguments have the same key."""
+    assert Binding('topic', ['b', 'a']).key == Binding(None, ['a', 'b']).key
+    assert Binding(routing_keys='a').key != Binding(arguments={'a': 1}).key
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Scheduler test cases."""
+
+import threading
+
+import pytest
+
+from mock import MagicMock as Mock
+
+from rabbithole.scheduler import (
+    Scheduler,
+    in_scheduled_callback,
+)
+
+
+@pytest.fixture(name='clock')
+def fixture_clock():
+    """Create a fake clock."""
+    return Mock(return_value=0.0)
+
+
+@pytest.fixture(name='scheduler')
+def fixture_scheduler(clock):
+    """Create a scheduler that doesn't start a thread."""
+    return Scheduler(clock=clock, autostart=False)
+
+
+def test_callbacks_run_in_deadline_order(clock, scheduler):
+    """Callbacks run when their deadline is reached in order."""
+    calls = []
+    scheduler.schedule(2, lambda: calls.append('second'))
+    scheduler.schedule(1, lambda: calls.append('first'))
+    scheduler.schedule(3, lambda: calls.append('third'))
+
+    clock.return_value = 2.5
+    assert scheduler.run_pending() == 0.5
+    assert calls == ['first', 'second']
+
+
+def test_cancelled_callback_not_run(clock, scheduler):
+    """Cancelled callbacks don't run."""
+    callback = Mock()
+    call = scheduler.schedule(1, callback)
+    call.cancel()
+    call.cancel()
+
+    clock.return_value = 1
+    assert scheduler.run_pending() is None
+    callback.assert_not_called()
+    assert scheduler.heap == []
+
+
+def test_cancelled_calls_discarded(scheduler):
+    """Cancelled calls are discarded when they are most of the heap."""
+    calls = [scheduler.schedule(delay, Mock()) for delay in range(10)]
+    for call in calls[:6]:
+        call.cancel()
+    assert len(scheduler.heap) == 4
+    assert scheduler.cancelled == 0
+
+
+def test_callback_error_logged(clock, scheduler):
+    """Errors in callbacks don't stop the scheduler."""
+    callback = Mock()
+    scheduler.schedule(1, Mock(side_effect=Exception))
+    scheduler.schedule(1, callback)
+
+    clock.return_value = 1
+    scheduler.run_pending()
+    callback.assert_called_once_with()
+
+
+def test_in_scheduled_callback(clock, scheduler):
+    """Scheduled callbacks can tell they're running in the scheduler."""
+    running = []
+    scheduler.schedule(1, lambda: running.append(in_scheduled_callback()))
+
+    clock.return_value = 1
+    scheduler.run_pending()
+    assert running == [True]
+    assert not in_scheduled_callback()
+
+
+def test_thread():
+    """Callbacks run in the scheduler thread."""
+    scheduler = Scheduler()
+    event = threading.Event()
+    scheduler.schedule(60, Mock())
+    scheduler.schedule(0.01, event.set)
+    assert event.wait(5)
+    assert scheduler.thread.name == 'scheduler'
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""Signal test cases."""
+
+from mock import (
+    MagicMock as Mock,
+    patch,
+)
+
+from rabbithole.signals import Signal
+
+
+def test_single_receiver_called_directly():
+    """Single strongly referenced receiver called without lookup."""
+    signal = Signal()
+    receiver = Mock()
+    signal.connect(receiver, weak=False)
+    assert signal.direct is receiver
+
+    with patch.object(signal, 'receivers_for') as receivers_for:
+        assert signal.send('<sender>', payload='<payload>') == [
+            (receiver, receiver.return_value)]
+    receivers_for.assert_not_called()
+    receiver.assert_called_once_with('<sender>', payload='<payload>')
+
+
+def test_several_receivers():
+    """All receivers called when there are several of them."""
+    signal = Signal()
+    receivers = [Mock(), Mock()]
+    for receiver in receivers:
+        signal.connect(receiver, weak=False)
+    assert signal.direct is None
+
+    signal.send('<sender>', payload='<payload>')
+    for receiver in receivers:
+        receiver.assert_called_once_with('<sender>', payload='<payload>')
+
+
+def test_sender_specific_receiver():
+    """Receivers for a specific sender not called for other senders."""
+    signal = Signal()
+    receiver = Mock()
+    signal.connect(receiver, sender='<sender>', weak=False)
+    assert signal.direct is None
+
+    signal.send('<other>', payload='<payload>')
+    receiver.assert_not_called()
+
+
+def test_disconnected_receiver():
+    """Receiver not called once it has been disconnected."""
+    signal = Signal()
+    receiver = Mock()
+    signal.connect(receiver, weak=False)
+    signal.disconnect(receiver)
+
+    assert signal.send('<sender>', payload='<payload>') == []
+    receiver.assert_not_called()
+
+
+def test_get_receivers():
+    """Receivers listed for a sender, including the direct one."""
+    signal = Signal()
+    receivers = [Mock(), Mock()]
+    signal.connect(receivers[0], weak=False)
+    assert signal.get_receivers('<sender>') == receivers[:1]
+
+    signal.connect(receivers[1], sender='<sender>', weak=False)
+    assert sorted(signal.get_receivers('<sender>'), key=id) == sorted(
+        receivers, key=id)
+    assert signal.get_receivers('<other>') == receivers[:1]
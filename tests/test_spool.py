@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Spool test cases."""
+
+import os
+
+import pytest
+
+from rabbithole.spool import (
+    HEADER,
+    Spool,
+    SpoolFull,
+)
+
+
+@pytest.fixture(name='directory')
+def fixture_directory(tmpdir):
+    """Get spool directory."""
+    return str(tmpdir.join('spool'))
+
+
+def test_records_read_in_order(directory):
+    """Records read in the same order in which they were appended."""
+    spool = Spool(directory, segment_size=1024)
+    for index in range(3):
+        spool.append({'index': index})
+
+    records = [spool.get(timeout=0)[1] for _ in range(3)]
+    assert records == [{'index': 0}, {'index': 1}, {'index': 2}]
+    assert spool.get(timeout=0) is None
+
+
+def test_segments_rotated(directory):
+    """New segment created when the current one is full."""
+    spool = Spool(directory, segment_size=64)
+    for index in range(10):
+        spool.append({'index': index})
+    assert len(os.listdir(directory)) > 1
+
+    position = None
+    for index in range(10):
+        position, record = spool.get(timeout=0)
+        assert record == {'index': index}
+    spool.commit(position)
+    assert sorted(os.listdir(directory)) == [
+        '{:010d}.spool'.format(position[0]),
+        'checkpoint',
+    ]
+
+
+def test_big_record(directory):
+    """Records bigger than a segment written to their own segment."""
+    spool = Spool(directory, segment_size=64)
+    spool.append('x' * 100)
+    spool.append('y')
+    assert spool.get(timeout=0)[1] == 'x' * 100
+    assert spool.get(timeout=0)[1] == 'y'
+
+
+def test_max_size(directory):
+    """Exception raised when the spool is full."""
+    spool = Spool(directory, segment_size=64, max_size=128)
+    spool.append('x' * 40)
+    spool.append('x' * 40)
+    with pytest.raises(SpoolFull):
+        spool.append('x' * 40)
+
+    # There's room again once records have been consumed
+    spool.commit(spool.get(timeout=0)[0])
+    spool.commit(spool.get(timeout=0)[0])
+    spool.append('x' * 40)
+
+
+def test_restart(directory):
+    """Records not committed read again after a restart."""
+    spool = Spool(directory, segment_size=64)
+    for index in range(5):
+        spool.append(index)
+    spool.commit(spool.get(timeout=0)[0])
+    spool.get(timeout=0)
+    spool.close()
+
+    spool = Spool(directory, segment_size=64)
+    assert [spool.get(timeout=0)[1] for _ in range(4)] == [1, 2, 3, 4]
+    assert spool.get(timeout=0) is None
+    spool.append(5)
+    assert spool.get(timeout=0)[1] == 5
+
+
+def test_partial_record_discarded(directory):
+    """Partially written record discarded after a restart."""
+    spool = Spool(directory, segment_size=1024)
+    spool.append('complete')
+    number, offset = spool.write_position
+    segment = spool.segments[number]
+    HEADER.pack_into(segment.map, offset, 10, 0)
+    spool.close()
+
+    spool = Spool(directory, segment_size=1024)
+    assert spool.write_position == (number, offset)
+    assert spool.get(timeout=0)[1] == 'complete'
+    spool.append('next')
+    assert spool.get(timeout=0)[1] == 'next'
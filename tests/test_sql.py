@@ -2,15 +2,32 @@
 
 """Database output block test cases."""
 
+import json
+import time
+
 import pytest
 
 from mock import (
     MagicMock as Mock,
     patch,
 )
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import create_engine
+from sqlalchemy.exc import (
+    OperationalError,
+    ProgrammingError,
+    SQLAlchemyError,
+)
 
-from rabbithole.sql import Database
+from rabbithole.metrics import (
+    ROWS_REJECTED,
+    ROWS_WRITTEN,
+)
+from rabbithole.sql import (
+    Database,
+    DictParametersMapper,
+    ListParametersMapper,
+    is_transient_error,
+)
 
 
 @pytest.fixture(name='database')
@@ -46,7 +63,7 @@ def test_query_executed(database):
     batch = [1, 2, 3]
 
     database.connection = Mock()
-    database.batch_ready_cb('<sender>', query, parameters, batch)
+    assert database.batch_ready_cb('<sender>', query, parameters, batch)
     database.connection.execute.assert_called_once_with(query, batch)
 
 
@@ -156,5 +173,348 @@ def test_error_on_database_error(database):
     database.connection = Mock()
     database.connection.execute.side_effect = exception
     with patch('rabbithole.sql.LOGGER') as logger:
-        database.batch_ready_cb('<sender>', query, parameters, batch)
+        assert not database.batch_ready_cb(
+            '<sender>', query, parameters, batch)
         assert logger.error.call_count == 2
+
+
+def test_parameters_compiled_once(database):
+    """Parameters mapper compiled when callback is created."""
+    with patch('rabbithole.sql.text'):
+        callback = database('<query>', ['message'])
+    assert isinstance(callback.keywords['parameters'], ListParametersMapper)
+
+
+def test_parameters_type_coercion(database):
+    """Parameter values coerced to the requested type."""
+    query = 'query'
+    parameters = {
+        'count': {'path': 'count', 'type': 'int'},
+        'ratio': {'path': 'nested.ratio', 'type': 'float'},
+        'invalid': {'path': 'message', 'type': 'int'},
+        'unknown': {'path': 'unknown', 'type': 'int'},
+    }
+    batch = [
+        {
+            'message': '<message>',
+            'count': '42',
+            'nested': {
+                'ratio': '0.5',
+            },
+        },
+    ]
+
+    database.connection = Mock()
+    database.batch_ready_cb('<sender>', query, parameters, batch)
+    database.connection.execute.assert_called_once_with(
+        query,
+        [
+            {
+                'count': 42,
+                'ratio': 0.5,
+                'invalid': None,
+                'unknown': None,
+            },
+        ],
+    )
+
+
+def test_json_parameter_stored_once_serialized(database):
+    """Values coerced to JSON are serialized only once."""
+    database.engine.execute('CREATE TABLE logs (data TEXT, tags TEXT)')
+    callback = database(
+        'INSERT INTO logs (data, tags) VALUES (:data, :tags)',
+        {
+            'data': {'path': 'data', 'type': 'json'},
+            'tags': {'path': 'nested.tags', 'type': 'json'},
+        },
+    )
+    assert callback('<sender>', batch=[
+        {'data': {'x': 1}, 'nested': {'tags': ['a', 'b']}},
+    ])
+
+    rows = database.engine.execute('SELECT data, tags FROM logs').fetchall()
+    assert [json.loads(value) for value in rows[0]] == [
+        {'x': 1}, ['a', 'b']]
+
+
+@pytest.mark.parametrize('parameters, expected', [
+    (None, None),
+    (['a', {'path': 'b.c', 'type': 'int'}], ['a', 'b.c']),
+    ({'a': 'a', 'c': {'path': 'b.c'}}, ['a', 'b.c']),
+])
+def test_fields(database, parameters, expected):
+    """Fields used as parameters returned for the flow."""
+    fields = database.fields('<query>', parameters)
+    assert fields == expected or sorted(fields) == expected
+
+
+def test_invalid_parameter_type():
+    """Exception raised when parameter type is unknown."""
+    with pytest.raises(ValueError):
+        DictParametersMapper({'count': {'path': 'count', 'type': '<type>'}})
+
+
+def test_deeply_nested_parameters():
+    """Deeply nested parameters mapped as expected."""
+    mapper = ListParametersMapper(['a.b.c', 'a.b', 'a.b.c.d'])
+    batch = [{'a': {'b': {'c': 1}}}, 'not a dict']
+    assert mapper.map(batch) == [
+        [1, '{"c": 1}', None],
+        [None, None, None],
+    ]
+
+
+def test_connection_pool(tmpdir):
+    """Batches written using connections from a pool."""
+    url = 'sqlite:///{}'.format(tmpdir.join('db.sqlite'))
+    database = Database(url, pool_size=2)
+    assert database.connection is None
+    assert database.writers == 2
+
+    database.engine.execute('CREATE TABLE logs (message TEXT)')
+    callback = database(
+        'INSERT INTO logs (message) VALUES (:message)',
+        {'message': 'message'},
+    )
+    assert callback('<sender>', batch=[{'message': 'a'}, {'message': 'b'}])
+    rows = database.engine.execute('SELECT message FROM logs').fetchall()
+    assert [row[0] for row in rows] == ['a', 'b']
+    assert database.engine.pool.checkedout() == 0
+
+
+def test_multirow_insert(database):
+    """Batch inserted with multi-row statements when requested."""
+    database.connection.execute('CREATE TABLE logs (message TEXT)')
+    callback = database(
+        'INSERT INTO logs (message) VALUES (:message)',
+        ['message.text'],
+        multirow=True,
+    )
+    batch = [{'message': {'text': str(index)}} for index in range(10)]
+    assert callback('<sender>', batch=batch)
+    rows = database.connection.execute('SELECT message FROM logs').fetchall()
+    assert [row[0] for row in rows] == [str(index) for index in range(10)]
+
+
+def test_failing_batch_bisected(database):
+    """Valid rows written and invalid ones rejected when a batch fails."""
+    database.connection.execute(
+        'CREATE TABLE logs (message TEXT NOT NULL)')
+    database.connection.execute(
+        'CREATE TABLE rejected (message TEXT, error TEXT)')
+    callback = database(
+        'INSERT INTO logs (message) VALUES (:message)',
+        {'message': 'message'},
+        reject_query=(
+            'INSERT INTO rejected (message, error) VALUES (:message, :error)'),
+    )
+    batch = [{'message': str(index)} for index in range(8)]
+    batch[2] = batch[5] = {}
+
+    with patch.object(
+            database, 'execute', wraps=database.execute) as execute:
+        assert callback('<sender>', batch=batch)
+        assert execute.call_count == 11
+
+    rows = database.connection.execute('SELECT message FROM logs').fetchall()
+    assert [row[0] for row in rows] == ['0', '1', '3', '4', '6', '7']
+    rows = database.connection.execute(
+        'SELECT message, error FROM rejected').fetchall()
+    assert [row[0] for row in rows] == ['{}', '{}']
+    assert 'NOT NULL' in rows[0][1]
+
+
+def test_failing_query_not_bisected(database):
+    """Batch failed at once when the error isn't caused by its rows."""
+    database.connection = Mock()
+    database.connection.execute.side_effect = ProgrammingError(
+        '<statement>', {}, Exception('<error>'))
+
+    assert not database.batch_ready_cb(
+        '<sender>', 'query', None, [1, 2, 3, 4])
+    database.connection.execute.assert_called_once_with('query', [1, 2, 3, 4])
+
+
+def test_row_metrics(database):
+    """Written and rejected rows recorded for the flow of the batch."""
+    database.connection.execute(
+        'CREATE TABLE logs (message TEXT NOT NULL)')
+    callback = database(
+        'INSERT INTO logs (message) VALUES (:message)',
+        {'message': 'message'},
+    )
+    sender = Mock()
+    sender.name = '<flow>'
+    written = ROWS_WRITTEN.labels('<flow>').value
+    rejected = ROWS_REJECTED.labels('<flow>').value
+
+    assert callback(sender, batch=[{'message': 'a'}, {}, {'message': 'b'}])
+    assert ROWS_WRITTEN.labels('<flow>').value == written + 2
+    assert ROWS_REJECTED.labels('<flow>').value == rejected + 1
+
+
+def test_transient_error_retried(database):
+    """Transient errors retried before giving up."""
+    database.retry_delay = 0
+    database.connection = Mock()
+    error = OperationalError(
+        '<statement>', {}, Exception('<error>'), connection_invalidated=True)
+    database.connection.execute.side_effect = [error, error, None]
+
+    assert database.batch_ready_cb('<sender>', 'query', None, [1, 2])
+    assert database.connection.execute.call_count == 3
+
+    database.connection.execute.reset_mock()
+    database.connection.execute.side_effect = error
+    with patch('rabbithole.sql.time.sleep') as sleep:
+        sleep.side_effect = lambda delay: locked.append(database.lock.locked())
+        locked = []
+        assert not database.batch_ready_cb('<sender>', 'query', None, [1, 2])
+    assert database.connection.execute.call_count == database.retries + 1
+    assert locked == [False] * database.retries
+    assert not database.lock.locked()
+
+
+class DriverError(Exception):
+
+    """Error raised by a database driver."""
+
+    def __init__(self, *args, **kwargs):
+        """Set driver specific attributes."""
+        super(DriverError, self).__init__(*args)
+        self.__dict__.update(kwargs)
+
+
+@pytest.mark.parametrize('orig, invalidated, expected', [
+    (DriverError('server closed the connection'), True, True),
+    (DriverError('deadlock detected', pgcode='40P01'), False, True),
+    (DriverError('could not connect', pgcode='08006'), False, True),
+    (DriverError('relation does not exist', pgcode='42P01'), False, False),
+    (DriverError(1213, 'Deadlock found'), False, True),
+    (DriverError(1146, "Table doesn't exist"), False, False),
+    (DriverError('database is locked'), False, True),
+    (DriverError('no such table: logs'), False, False),
+])
+def test_is_transient_error(orig, invalidated, expected):
+    """Only lost connections and errors known to be transient retried."""
+    error = OperationalError(
+        '<statement>', {}, orig, connection_invalidated=invalidated)
+    assert is_transient_error(error) is expected
+
+
+def test_spool(tmpdir):
+    """Batches appended to the spool and written by the replayer."""
+    url = 'sqlite:///{}'.format(tmpdir.join('db.sqlite'))
+    engine = create_engine(url)
+    engine.execute('CREATE TABLE logs (message TEXT)')
+
+    database = Database(
+        url,
+        pool_size=1,
+        spool={'directory': str(tmpdir.join('spool'))},
+    )
+    callback = database(
+        'INSERT INTO logs (message) VALUES (:message)',
+        {'message': 'message'},
+    )
+    assert callback('<sender>', batch=[{'message': 'a'}, {'message': 'b'}])
+    assert callback('<sender>', batch=[{'message': 'c'}])
+
+    for _ in range(100):
+        rows = engine.execute('SELECT message FROM logs').fetchall()
+        if len(rows) == 3:
+            break
+        time.sleep(0.01)
+    assert [row[0] for row in rows] == ['a', 'b', 'c']
+
+
+@pytest.fixture(name='replayed_record')
+def fixture_replayed_record():
+    """Create spooled record."""
+    return {
+        'flow': {
+            'query': 'INSERT INTO logs (message) VALUES (:message)',
+            'parameters': {'message': 'message'},
+            'multirow': False,
+            'reject_query': None,
+        },
+        'batch': [{'message': 'a'}],
+    }
+
+
+def create_spool(database, directory, items):
+    """Create spool that stops the database once all items are read."""
+    items = iter(items)
+
+    def get(timeout):
+        """Get next item or raise it if it's an error."""
+        item = next(items, None)
+        if item is None:
+            database.stopping.set()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    spool = Mock()
+    spool.directory = directory
+    spool.get.side_effect = get
+    return spool
+
+
+def test_replayer_survives_errors(tmpdir, replayed_record):
+    """Replayer keeps running after failing to read the spool."""
+    database = Database('sqlite://', retry_delay=0)
+    database.connection.execute('CREATE TABLE logs (message TEXT)')
+    spool = create_spool(database, str(tmpdir), [
+        RuntimeError('<corrupted>'),
+        ((0, 10), replayed_record),
+    ])
+
+    database.replay(spool)
+    spool.commit.assert_called_once_with((0, 10))
+    rows = database.connection.execute('SELECT message FROM logs').fetchall()
+    assert [row[0] for row in rows] == ['a']
+
+
+def test_spooled_batch_rejected(tmpdir, replayed_record):
+    """Spooled batch moved to the reject file after failing many times."""
+    database = Database('sqlite://', retry_delay=0, replay_attempts=2)
+    spool = create_spool(database, str(tmpdir), [((0, 10), replayed_record)])
+    error = ProgrammingError('<statement>', {}, Exception('<error>'))
+
+    with patch.object(database, 'write_batch') as write_batch:
+        write_batch.side_effect = error
+        database.replay(spool)
+    assert write_batch.call_count == 2
+    spool.commit.assert_called_once_with((0, 10))
+    lines = tmpdir.join('rejected.jsonl').readlines()
+    assert [json.loads(line)['record'] for line in lines] == [replayed_record]
+
+
+def test_spooled_batch_transient_error(tmpdir, replayed_record):
+    """Spooled batch that fails with transient errors is never rejected."""
+    database = Database('sqlite://', retry_delay=0, replay_attempts=2)
+    spool = create_spool(database, str(tmpdir), [((0, 10), replayed_record)])
+    error = OperationalError(
+        '<statement>', {}, Exception('<error>'), connection_invalidated=True)
+
+    with patch.object(database, 'write_batch') as write_batch:
+        write_batch.side_effect = [error, error, error, None]
+        database.replay(spool)
+    assert write_batch.call_count == 4
+    spool.commit.assert_called_once_with((0, 10))
+    assert not tmpdir.join('rejected.jsonl').check()
+
+
+def test_close(tmpdir):
+    """Replayer stopped and engine disposed when the database is closed."""
+    database = Database(
+        'sqlite:///{}'.format(tmpdir.join('db.sqlite')),
+        spool={'directory': str(tmpdir.join('spool'))},
+    )
+    with patch.object(database.engine, 'dispose') as dispose:
+        database.close(5)
+    dispose.assert_called_once_with()
+    assert not database.replayer.is_alive()
+    assert database.connection.closed
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Supervisor test cases."""
+
+from mock import (
+    ANY,
+    MagicMock as Mock,
+    patch,
+)
+
+from rabbithole.supervisor import (
+    Supervisor,
+    shard_config,
+)
+
+CONFIG = {
+    'size_limit': 10,
+    'workers': 2,
+    'blocks': [
+        {'name': 'input'},
+        {'name': 'output'},
+        {'name': 'archive'},
+    ],
+    'flows': [
+        [{'name': 'input'}, {'name': 'output'}],
+        [{'name': 'input'}, {'name': 'archive'}],
+        [{'name': 'input'}, {'name': 'output'}],
+    ],
+}
+
+
+def test_shard_config():
+    """Flows distributed in a round robin fashion."""
+    config = shard_config(CONFIG, 1, 2)
+    assert config == {
+        'size_limit': 10,
+        'blocks': [
+            {'name': 'input'},
+            {'name': 'archive'},
+        ],
+        'flows': [
+            [{'name': 'input'}, {'name': 'archive'}],
+        ],
+    }
+
+
+def test_shard_metrics_port():
+    """Each worker serves its metrics on its own port."""
+    config = dict(CONFIG, metrics_port=9100)
+    assert shard_config(config, 0, 2)['metrics_port'] == 9100
+    assert shard_config(config, 1, 2)['metrics_port'] == 9101
+
+
+def test_workers_limited_to_flows():
+    """Number of workers is limited to the number of flows."""
+    supervisor = Supervisor(CONFIG, 8, Mock())
+    assert len(supervisor.configs) == 3
+
+
+def test_worker_restarted():
+    """Worker restarted when it exits."""
+    target = Mock()
+    supervisor = Supervisor(CONFIG, 1, target)
+    with patch('rabbithole.supervisor.multiprocessing') as multiprocessing, \
+            patch('rabbithole.supervisor.time') as time:
+        process = multiprocessing.Process()
+        process.is_alive.return_value = False
+        time.sleep.side_effect = [None, KeyboardInterrupt]
+        multiprocessing.Process.reset_mock()
+        assert supervisor.run() == 0
+
+    assert multiprocessing.Process.call_count == 2
+    multiprocessing.Process.assert_called_with(
+        name='worker-0',
+        target=target,
+        args=(shard_config(CONFIG, 0, 1), ),
+    )
+    process.join.assert_called_with()
+
+
+def test_shared_flows_in_every_worker():
+    """Flows that consume from a named queue run in every worker."""
+    shared_flow = [
+        {'name': 'input', 'kwargs': {'exchange': 'logs', 'queue': 'logs'}},
+        {'name': 'output'},
+    ]
+    config = dict(CONFIG, flows=CONFIG['flows'] + [shared_flow])
+    supervisor = Supervisor(config, 8, Mock())
+
+    assert len(supervisor.configs) == 8
+    assert all(
+        worker_config['flows'][-1] == shared_flow
+        for worker_config in supervisor.configs
+    )
+    assert [len(worker_config['flows']) for worker_config in (
+        supervisor.configs)] == [2, 2, 2, 1, 1, 1, 1, 1]
+
+
+def test_workers_terminated_on_sigterm():
+    """Workers terminated and joined when the supervisor gets SIGTERM."""
+    supervisor = Supervisor(CONFIG, 1, Mock())
+    with patch('rabbithole.supervisor.multiprocessing') as multiprocessing, \
+            patch('rabbithole.supervisor.signal') as signal, \
+            patch('rabbithole.supervisor.time') as time:
+        process = multiprocessing.Process()
+        process.is_alive.return_value = True
+        time.sleep.side_effect = (
+            lambda _delay: signal.signal.call_args[0][1](15, None))
+        assert supervisor.run() == 0
+
+    signal.signal.assert_called_once_with(signal.SIGTERM, ANY)
+    process.terminate.assert_called_once_with()
+    process.join.assert_called_once_with()
+
+
+def test_changed_workers_replaced_on_reload():
+    """Only workers whose flows changed are replaced on reload."""
+    config = dict(CONFIG, flows=CONFIG['flows'][:2])
+    new_config = dict(config, flows=[
+        config['flows'][0],
+        [{'name': 'input'}, {'name': 'output'}],
+    ])
+    supervisor = Supervisor(config, 2, Mock(), Mock(return_value=new_config))
+    old_processes = [Mock(), Mock()]
+    supervisor.processes = list(old_processes)
+    with patch('rabbithole.supervisor.multiprocessing') as multiprocessing:
+        supervisor.reload()
+
+    assert supervisor.processes[0] is old_processes[0]
+    assert supervisor.processes[1] is multiprocessing.Process.return_value
+    old_processes[0].terminate.assert_not_called()
+    old_processes[1].terminate.assert_called_once_with()
+    old_processes[1].join.assert_called_once_with()
+    assert supervisor.configs[1] == shard_config(new_config, 1, 2)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""Batch writer test cases."""
+
+import threading
+
+from mock import (
+    MagicMock as Mock,
+    patch,
+)
+
+from rabbithole.batcher import Batcher
+from rabbithole.scheduler import Scheduler
+from rabbithole.writer import (
+    BatchWriter,
+    QueuedOutput,
+)
+
+
+def test_batch_written_in_writer_thread():
+    """Output callback run in a writer thread."""
+    threads = []
+
+    def callback(sender, batch):
+        """Record thread in which callback runs."""
+        threads.append(threading.current_thread().name)
+        return len(batch)
+
+    writer = BatchWriter('<output>')
+    future = writer.submit(callback, '<sender>', batch=[1, 2, 3])
+    assert future.result(5) == 3
+    writer.close()
+    assert threads == ['<output>-writer-0']
+
+
+def test_exception_set_in_future():
+    """Exception raised by the output callback set in the future."""
+    exception = Exception('<error>')
+    writer = BatchWriter('<output>')
+    future = writer.submit(Mock(side_effect=exception))
+    assert future.exception(5) is exception
+    writer.close()
+
+
+def test_backpressure():
+    """Submitting a batch blocks while the queue is full."""
+    event = threading.Event()
+    writer = BatchWriter('<output>', threads=1, max_pending=1)
+    writer.submit(event.wait)
+    writer.submit(Mock())
+
+    submitted = threading.Event()
+
+    def submit():
+        """Submit batch when the queue is full."""
+        writer.submit(Mock())
+        submitted.set()
+
+    thread = threading.Thread(target=submit)
+    thread.start()
+    assert not submitted.wait(0.1)
+    event.set()
+    assert submitted.wait(5)
+    thread.join()
+    writer.close()
+
+
+def test_time_limit_not_blocked_by_full_queue():
+    """Time limits of other flows served while an output queue is full."""
+    event = threading.Event()
+    slow_writer = BatchWriter('<slow>', threads=1, max_pending=1)
+    slow_writer.submit(event.wait)
+    slow_writer.submit(Mock())
+    writer = BatchWriter('<output>')
+    written = threading.Event()
+
+    scheduler = Scheduler()
+    slow_batcher = Batcher(size_limit=10, time_limit=0.05, scheduler=scheduler)
+    slow_batcher.batch_ready.connect(
+        lambda sender, batch: slow_writer.submit(Mock(), sender, batch=batch),
+        weak=False,
+    )
+    batcher = Batcher(size_limit=10, time_limit=0.1, scheduler=scheduler)
+    batcher.batch_ready.connect(
+        lambda sender, batch: writer.submit(
+            lambda *args, **kwargs: written.set(), sender, batch=batch),
+        weak=False,
+    )
+    slow_batcher.message_received_cb('sender', 'payload')
+    batcher.message_received_cb('sender', 'payload')
+
+    assert written.wait(1)
+    # Batches queued from the scheduler thread still count as pending
+    assert slow_writer.pending == 2
+    event.set()
+    assert slow_writer.close(5)
+    assert writer.close(5)
+
+
+def test_deliveries_settled_when_written():
+    """Messages settled once the writer thread has written the batch."""
+    block = Mock()
+    block.return_value.return_value = True
+    writer = BatchWriter('<output>')
+    output = QueuedOutput(block, writer)
+
+    batcher = Batcher(size_limit=2, scheduler=Mock())
+    batcher.batch_ready.connect(output('<query>'), weak=False)
+    acknowledger = Mock()
+    for delivery_tag in (1, 2):
+        batcher.message_received_cb(
+            'sender', 'payload', delivery_tag, acknowledger)
+    writer.close()
+
+    block.return_value.assert_called_once_with(
+        batcher, batch=['payload', 'payload'])
+    acknowledger.settle.assert_called_once_with([1, 2], True)
+
+
+def test_ordering_key():
+    """Batches with the same key written in order, other keys concurrently."""
+    events = []
+    event = threading.Event()
+
+    def slow(name):
+        """Wait until released."""
+        event.wait(5)
+        events.append(name)
+
+    writer = BatchWriter('<output>', threads=2, max_pending=10)
+    futures = [
+        writer.submit_ordered('<key>', slow, 'first'),
+        writer.submit_ordered('<key>', events.append, 'second'),
+    ]
+    writer.submit_ordered('<other>', events.append, 'other').result(5)
+    assert events == ['other']
+
+    event.set()
+    for future in futures:
+        future.result(5)
+    writer.close()
+    assert events == ['other', 'first', 'second']
+    assert writer.keys == {}
+
+
+def test_ordering_key_passed_to_writer():
+    """Ordering key removed from the output block arguments."""
+    block = Mock()
+    writer = Mock()
+    output = QueuedOutput(block, writer)
+    callback = output('<query>', ordering_key='<key>')
+    callback('<sender>', batch=[])
+    block.assert_called_once_with('<query>')
+    writer.submit_ordered.assert_called_once_with(
+        '<key>', block(), '<sender>', batch=[])
+
+
+def test_queued_output_fields():
+    """Fields requested to the output block without the ordering key."""
+    block = Mock()
+    output = QueuedOutput(block, Mock())
+    assert output.fields(
+        '<query>', ordering_key='<key>') == block.fields.return_value
+    block.fields.assert_called_once_with('<query>')
+
+
+def test_best_effort_output():
+    """Batches not waited for and dropped when the queue is full."""
+    block = Mock()
+    event = threading.Event()
+    writer = BatchWriter('<output>', threads=1, max_pending=1)
+    writer.submit(event.wait)
+    writer.submit(Mock())
+    output = QueuedOutput(block, writer)
+    callback = output('<query>', wait=False)
+    block.assert_called_once_with('<query>')
+
+    with patch('rabbithole.writer.LOGGER') as logger:
+        assert callback('<sender>', batch=[]) is None
+    logger.warning.assert_called_once_with(
+        'Writer queue full, best-effort batch dropped')
+
+    event.set()
+    writer.close()
+    block.return_value.assert_not_called()